@@ -1,9 +1,11 @@
-import sqlite3
+import logging
+import threading
 
 from OFS.SimpleItem import SimpleItem
 from plone.app.contentrules.browser.formhelper import AddForm, EditForm
 from plone.contentrules.rule.interfaces import IRuleElementData, IExecutable
 from Products.CMFPlone import PloneMessageFactory as _p
+import transaction
 from zope.formlib import form
 from zope.component import adapts
 from zope import interface
@@ -14,6 +16,10 @@ from collective.whathappened.i18n import _
 from collective.whathappened.storage_manager import StorageManager
 from collective.whathappened.subscription import Subscription
 
+logger = logging.getLogger('collective.whathappened')
+
+_local = threading.local()
+
 
 class ISubscriptionAction(interface.Interface):
     """Definition of the configuration available for a subscription action."""
@@ -42,24 +48,49 @@ class SubscriptionActionExecutor(object):
         self.event = event
 
     def __call__(self):
-        subscription = self.element.subscription
         obj = self.event.object
         storage = StorageManager(self.context)
         context_path = '/'.join(obj.getPhysicalPath())
+        wants = self.element.subscription == 'subscribe'
+        changes = _getQueue(storage).setdefault(storage.getUser(), {})
+        # The last change of a path in the transaction wins
+        changes[context_path] = wants
+        return True
+
+
+def _getQueue(storage):
+    """Return the subscription changes queued in the current transaction, by
+    user. They are saved when it is committed, see _flush."""
+    txn = transaction.get()
+    queue = getattr(_local, 'queue', None)
+    if queue is None or queue[0] is not txn:
+        # A new transaction, the changes of an aborted one are dropped
+        queue = _local.queue = (txn, storage, {})
+        txn.addBeforeCommitHook(_flush, (queue,))
+    return queue[2]
+
+
+def _flush(queue):
+    """Save the queued changes with one storage transaction per user. This
+    runs before the commit so that the rules triggered by the
+    SubscriptionsChangedEvent are part of the transaction, the changes they
+    queue again are saved by a new hook."""
+    txn, storage, changes = queue
+    if getattr(_local, 'queue', None) is queue:
+        _local.queue = None
+    for user, subscriptions in changes.items():
         try:
+            storage.setUser(user)
             storage.initialize()
-            if subscription == 'subscribe':
-                storage.saveSubscription(
-                    Subscription(context_path, True)
-                )
-            else:
-                storage.saveSubscription(
-                    Subscription(context_path, False)
-                )
-            storage.terminate()
-        except sqlite3.IntegrityError:
-            return False
-        return True
+            try:
+                storage.saveSubscriptions([
+                    Subscription(where, wants)
+                    for where, wants in sorted(subscriptions.items())
+                ])
+            finally:
+                storage.terminate()
+        except Exception:
+            logger.exception("Could not save the subscriptions of %s" % user)
 
 
 class SubscriptionActionAddForm(AddForm):
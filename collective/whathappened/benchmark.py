@@ -0,0 +1,206 @@
+"""Benchmark a storage backend and the useraction gatherer on synthetic data.
+
+Users, subscriptions, a content tree and a stream of useractions are
+generated at the requested scale. The useractions are served by a stand-in
+for collective.history's UserActionManager so no Zope instance is needed.
+Results are printed as JSON, e.g.::
+
+    bin/whathappened-benchmark --users 50 --actions 20000 > sqlite.json
+"""
+import argparse
+import datetime
+import json
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from collective.whathappened.coalesce import Coalescer
+from collective.whathappened.gatherer_backend import UserActionGathererBackend
+from collective.whathappened.subscription import Subscription
+from collective.whathappened.tests.fake import FakeRequest
+from collective.whathappened.tests.fake import FakeSettings
+from collective.whathappened.tests.fake import FakeSite
+from collective.whathappened.tests.fake import FakeUserAction
+from collective.whathappened.tests.fake import FakeUserActionManager
+from collective.whathappened.useraction_window import UserActionWindow
+
+WHATS = ['created', 'modified', 'liked', 'favorited']
+
+
+class Timer(object):
+
+    def __init__(self):
+        self.results = {}
+
+    def measure(self, name, func, *args):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        stats = self.results.setdefault(name, {
+            'calls': 0,
+            'total': 0.0,
+            'max': 0.0,
+        })
+        stats['calls'] += 1
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+        return result
+
+    def report(self):
+        for stats in self.results.values():
+            stats['mean'] = stats['total'] / stats['calls']
+        return self.results
+
+
+def resolve(dotted):
+    module, _, name = dotted.rpartition('.')
+    return getattr(__import__(module, fromlist=[name]), name)
+
+
+def buildTree(sections, folders, documents):
+    """Return the folders and all the paths of a three levels tree."""
+    containers = []
+    paths = ['/plone']
+    for i in range(sections):
+        section = '/plone/section%d' % i
+        containers.append(section)
+        paths.append(section)
+        for j in range(folders):
+            folder = '%s/folder%d' % (section, j)
+            containers.append(folder)
+            paths.append(folder)
+            for k in range(documents):
+                paths.append('%s/doc%d' % (folder, k))
+    return containers, paths
+
+
+def buildUserActions(paths, users, count, start, duration, rnd):
+    step = float(duration) / max(count, 1)
+    useractions = []
+    for i in range(count):
+        useractions.append(FakeUserAction(
+            i,
+            rnd.choice(WHATS),
+            start + datetime.timedelta(seconds=i * step),
+            rnd.choice(paths),
+            rnd.choice(users),
+            json.dumps({'title': 'Content %d' % i}),
+        ))
+    return useractions
+
+
+def run(options):
+    rnd = random.Random(options.seed)
+    directory = tempfile.mkdtemp()
+    timer = Timer()
+    try:
+        users = ['user%d' % i for i in range(options.users)]
+        containers, paths = buildTree(options.sections, options.folders,
+                                      options.documents)
+        start = datetime.datetime.now() - datetime.timedelta(
+            seconds=options.duration)
+        manager = FakeUserActionManager(buildUserActions(
+            paths, users, options.actions, start, options.duration, rnd
+        ))
+        settings = FakeSettings(WHATS)
+        site = FakeSite(paths, settings)
+        request = FakeRequest()
+        factory = resolve(options.backend)
+        window = None
+        if options.window:
+            # The stand-in useractions are all committed already
+            window = UserActionWindow(options.duration + 60, margin=0)
+        stored = 0
+        for user in users:
+            site.portal_membership.member.id = user
+            storage = factory(site, request)
+            if hasattr(storage, 'directory'):
+                storage.directory = directory
+            storage.setUser(user)
+
+            storage.initialize()
+            subscribed = rnd.sample(containers,
+                                    min(options.subscriptions,
+                                        len(containers)))
+            for where in subscribed:
+                timer.measure('saveSubscription', storage.saveSubscription,
+                              Subscription(where, True))
+            timer.measure('terminate', storage.terminate)
+
+            gatherer = UserActionGathererBackend(site, request, manager,
+                                                 storage, window)
+            gatherer.setUser(user)
+            notifications = timer.measure('getNewNotifications',
+                                          gatherer.getNewNotifications,
+                                          start)
+            if options.coalesce:
+                coalescer = Coalescer(['parent'], options.coalesce * 60)
+                notifications = timer.measure('coalesce', coalescer.coalesce,
+                                              notifications)
+
+            storage.initialize()
+            for notification in notifications:
+                timer.measure('storeNotification', storage.storeNotification,
+                              notification)
+            timer.measure('terminate', storage.terminate)
+            stored += len(notifications)
+
+            storage.initialize()
+            timer.measure('getHotNotifications',
+                          storage.getHotNotifications)
+            timer.measure('getAllNotifications',
+                          storage.getAllNotifications)
+            timer.measure('getUnseenNotifications',
+                          storage.getUnseenNotifications)
+            timer.measure('getUnseenCount', storage.getUnseenCount)
+            for notification in notifications[:options.seen]:
+                timer.measure('setSeen', storage.setSeen, notification.where)
+            timer.measure('setSeen(subtree)', storage.setSeen,
+                          rnd.choice(containers), True)
+            timer.measure('setSeen(all)', storage.setSeen)
+            timer.measure('terminate', storage.terminate)
+    finally:
+        shutil.rmtree(directory)
+    return {
+        'backend': options.backend,
+        'scale': vars(options),
+        'notifications': stored,
+        'results': timer.report(),
+    }
+
+
+def parse(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--backend',
+        default='collective.whathappened.storage_backend.SqliteStorageBackend',
+        help="Dotted name of the storage backend class.")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--subscriptions', type=int, default=10,
+                        help="Subscribed folders per user.")
+    parser.add_argument('--sections', type=int, default=10)
+    parser.add_argument('--folders', type=int, default=10,
+                        help="Folders per section.")
+    parser.add_argument('--documents', type=int, default=20,
+                        help="Documents per folder.")
+    parser.add_argument('--actions', type=int, default=5000,
+                        help="Number of useractions.")
+    parser.add_argument('--duration', type=int, default=7 * 24 * 3600,
+                        help="Seconds the useractions are spread over.")
+    parser.add_argument('--seen', type=int, default=10,
+                        help="Paths set as seen per user.")
+    parser.add_argument('--coalesce', type=int, default=0,
+                        help="Merge window in minutes, 0 to not merge.")
+    parser.add_argument('--window', action='store_true',
+                        help="Gather from a window of the useractions "
+                             "shared by the users.")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    results = run(parse(argv))
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
@@ -0,0 +1,13 @@
+from Products.Five.browser import BrowserView
+
+from collective.whathappened.digest import DigestSender
+
+
+class DigestView(BrowserView):
+    """Send the notification digests, e.g. from a clock server."""
+
+    def __call__(self):
+        sender = DigestSender(self.context, self.request)
+        sent = sender.run()
+        self.request.response.setHeader('Content-Type', 'text/plain')
+        return '%d digests sent' % sent
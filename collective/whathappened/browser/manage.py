@@ -47,10 +47,8 @@ class ManageForm(AutoExtensibleForm, form.Form):
         storage = StorageManager(self.context)
         storage.initialize()
         subscriptions = storage.getSubscriptions()
-        for s in subscriptions:
-            if s.where not in data['subscriptions']:
-                s.wants = None
-                storage.saveSubscription(s)
+        storage.unsubscribe([s.where for s in subscriptions
+                             if s.where not in data['subscriptions']])
         storage.terminate()
         self.request.response.redirect('@@collective_whathappened_manage')
 
@@ -0,0 +1,136 @@
+import datetime
+import json
+import time
+
+from DateTime import DateTime
+from Products.Five.browser import BrowserView
+from zope import component
+
+from collective.history.manager import UserActionManager
+from collective.whathappened.instrumentation import IMetricsSink
+from collective.whathappened.storage_manager import StorageManager
+
+
+def _timestamp(when):
+    if hasattr(when, 'timeTime'):
+        return int(when.timeTime())
+    return int(time.mktime(when.timetuple()))
+
+
+def _format(timestamp):
+    if timestamp is None:
+        return ''
+    return datetime.datetime.fromtimestamp(timestamp).strftime(
+        '%Y-%m-%d %H:%M'
+    )
+
+
+class MetricsView(BrowserView):
+    """Notification volume and storage health of all the users.
+
+    Statistics are cached by storage file and only recomputed for the files
+    which changed, within 'budget' seconds per hit. The storages left over
+    are reported with their previous statistics, the ones which were never
+    computed are left out and counted as stale, so the view stays cheap on
+    sites with many users."""
+
+    budget = 2.0
+    top = 50
+
+    def __call__(self):
+        self.update()
+        return self.index()
+
+    def update(self):
+        storage = StorageManager(self.context, self.request)
+        deadline = time.time() + self.budget
+        self.users = []
+        self.stale = 0
+        for user in storage.listUsers():
+            storage.setUser(user)
+            stats = storage.getStats(refresh=time.time() < deadline)
+            if stats is None:
+                self.stale += 1
+                continue
+            self.users.append(dict(stats))
+        self.users.sort(key=lambda stats: stats['size'], reverse=True)
+        self.newestUserAction = self._newestUserAction()
+        for stats in self.users:
+            stats['lag'] = self._lag(stats['last_gather'])
+        self.totals = self._totals()
+        self.slowest = self._slowest()
+
+    def _newestUserAction(self):
+        gathers = [stats['last_gather'] for stats in self.users
+                   if stats['last_gather']]
+        if not gathers:
+            return None
+        manager = UserActionManager(self.context, self.request)
+        manager.update()
+        # Only the newest one is read
+        brains = manager.search(when={
+            'query': DateTime(max(gathers)),
+            'range': 'min'
+        }, sort_on='when', sort_order='reverse', sort_limit=1)
+        for brain in brains[:1]:
+            return _timestamp(brain.when)
+        return max(gathers)
+
+    def _lag(self, lastGather):
+        """Seconds between the newest useraction and the last gathering."""
+        if lastGather is None or self.newestUserAction is None:
+            return None
+        return max(self.newestUserAction - lastGather, 0)
+
+    def _totals(self):
+        totals = {
+            'users': len(self.users),
+            'stale': self.stale,
+            'notifications': 0,
+            'unseen': 0,
+            'subscriptions': 0,
+            'size': 0,
+            'oldest_unseen': None,
+            'max_lag': None,
+        }
+        for stats in self.users:
+            for key in ('notifications', 'unseen', 'subscriptions', 'size'):
+                totals[key] += stats[key]
+            if stats['oldest_unseen'] is not None:
+                totals['oldest_unseen'] = min(
+                    totals['oldest_unseen'] or stats['oldest_unseen'],
+                    stats['oldest_unseen']
+                )
+            if stats['lag'] is not None:
+                totals['max_lag'] = max(totals['max_lag'] or 0, stats['lag'])
+        return totals
+
+    def _slowest(self):
+        sink = component.queryUtility(IMetricsSink, name='user_timings')
+        if sink is None:
+            return []
+        return sink.slowest(10)
+
+    def biggest(self):
+        return self.users[:self.top]
+
+    def format(self, timestamp):
+        return _format(timestamp)
+
+    def asDict(self):
+        return {
+            'generated': int(time.time()),
+            'newest_useraction': self.newestUserAction,
+            'totals': self.totals,
+            'users': self.users,
+            'slowest': self.slowest,
+        }
+
+
+class MetricsJSON(MetricsView):
+    """The metrics as JSON, for monitoring tools."""
+
+    def __call__(self):
+        self.update()
+        self.request.response.setHeader('Content-Type', 'application/json')
+        return json.dumps(self.asDict())
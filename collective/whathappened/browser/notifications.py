@@ -1,5 +1,6 @@
 import datetime
 import logging
+import time
 import urllib
 
 from collections import OrderedDict
@@ -10,19 +11,35 @@ from Products.CMFCore.utils import getToolByName
 from Products.Five.browser import BrowserView
 from plone.app.layout.viewlets import common
 from plone.app.redirector.interfaces import IRedirectionStorage
+from plone.registry.interfaces import IRegistry
 from zope.component import getMultiAdapter, queryUtility
 from zope.browser.interfaces import IBrowserView
 from zope import component
 from zope.i18nmessageid import MessageFactory
 from zope.i18n import translate
 
+from collective.whathappened import deferred
 from collective.whathappened.gatherer_manager import GathererManager
+from collective.whathappened.scheduler import getScheduler
+from collective.whathappened.settings import ISettings
+from collective.whathappened.storage_backend import GATHER_CURSOR
+from collective.whathappened.storage_backend import GATHERED_UNTIL
+from collective.whathappened.storage_backend import LAST_ARCHIVE
+from collective.whathappened.storage_backend import LAST_GATHER
 from collective.whathappened.storage_manager import StorageManager
+from collective.whathappened.storage_manager import getRequestStorage
 from collective.whathappened.utility import IDisplay
 from collective.whathappened.exceptions import NotificationValueError
+from collective.whathappened.instrumentation import count
+from collective.whathappened.instrumentation import timed
 
 PLMF = MessageFactory('plonelocales')
-SESSION_LAST_CHECK = 'collective.whathappened.lastcheck'
+# Format of the times the gatherings resume from in the storage meta
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+# Seconds between two archivings of a storage
+ARCHIVE_INTERVAL = 24 * 3600
+# Archived notifications added to the listing by each "load older"
+ARCHIVE_PAGE = 50
 
 
 def show(context, request, notification):
@@ -33,6 +50,11 @@ def show(context, request, notification):
 
 
 class AllView(BrowserView):
+    # Only the notifications about this path and the paths below it are
+    # listed if set
+    path = None
+    setAllSeenUrl = '@@collective_whathappened_set_all_seen'
+
     def __init__(self, context, request):
         self.context = context
         self.request = request
@@ -48,14 +70,37 @@ class AllView(BrowserView):
         if mtool.getAuthenticatedMember().getId() is None:
             raise Unauthorized
         self.gatherer = GathererManager(self.context, self.request)
-        self.storage = StorageManager(self.context, self.request)
-        self.storage.initialize()
+        self.storage = getRequestStorage(self.context, self.request)
         self.updateNotifications()
-        self.notifications = self.storage.getAllNotifications()
+        self.notifications = self.storage.getAllNotifications(self.path)
+        self.archived = self._getArchived()
+        if self.archived:
+            # One more than asked for tells if there are older ones left
+            archived = self.storage.getArchivedNotifications(
+                self.archived + 1, self.path
+            )
+            self.hasOlder = len(archived) > self.archived
+            self.notifications.extend(archived[:self.archived])
+            # Unseen notifications are never archived and may be older
+            self.notifications.sort(key=lambda n: n.getWhenTimestamp(),
+                                    reverse=True)
+        else:
+            self.hasOlder = self.storage.hasArchivedNotifications(self.path)
         self._validate_notifications()
-        self.storage.terminate()
+        self.unseenCount = self.storage.getUnseenCount(self.path)
         self.notificationsCount = len(self.notifications)
 
+    def _getArchived(self):
+        """Number of archived notifications asked for."""
+        try:
+            return max(int(self.request.form.get('archived', 0)), 0)
+        except ValueError:
+            return 0
+
+    def olderUrl(self):
+        return '%s?archived=%d' % (self.request.get('ACTUAL_URL', ''),
+                                   self.archived + ARCHIVE_PAGE)
+
     def _validate_notifications(self):
         for notification in self.notifications:
             try:
@@ -91,46 +136,62 @@ class AllView(BrowserView):
         self.navigation_root = '/'.join(path)
 
     def updateNotifications(self):
-        lastCheck = _getLastCheck(self.context, self.storage)
-        newNotifications = self.gatherer.getNewNotifications(lastCheck)
-        if newNotifications is not None:
-            for notification in newNotifications:
-                self.storage.storeNotification(notification)
+        _updateNotifications(self.context, self.storage, self.gatherer)
+
+
+class SectionView(AllView):
+    """The notifications about the context and the contents below it."""
+
+    setAllSeenUrl = '@@collective_whathappened_set_all_seen?section=1'
+
+    def update(self):
+        self.path = '/'.join(self.context.getPhysicalPath())
+        super(SectionView, self).update()
 
 
 class SetAllSeen(BrowserView):
     def __call__(self):
-        storage = StorageManager(self.context, self.request)
-        storage.initialize()
-        storage.setSeen()
-        storage.terminate()
-        url = '@@collective_whathappened_notifications_all'
+        storage = getRequestStorage(self.context, self.request)
+        if self.request.form.get('section'):
+            storage.setSeen('/'.join(self.context.getPhysicalPath()),
+                            subtree=True)
+            url = '@@collective_whathappened_notifications_section'
+        else:
+            storage.setSeen()
+            url = '@@collective_whathappened_notifications_all'
         self.request.response.redirect(url)
 
 
 class HotViewlet(common.PersonalBarViewlet):
+    @timed('HotViewlet.update')
     def update(self):
         super(HotViewlet, self).update()
         if self.anonymous:
             return
-        self.storage = StorageManager(self.context, self.request)
-        self.storage.initialize()
-        #self.setSeen()
-        self.storage.terminate()
-        self.notifications = getHotNotifications(self.context, self.request)
+        self.storage = getRequestStorage(self.context, self.request)
+        self.setSeen()
+        gather = self.isGatherDue()
+        defer = gather and _getSetting('deferred_gathering', False)
+        self.notifications = getHotNotifications(self.context, self.request,
+                                                 gather and not defer)
+        if defer:
+            deferred.schedule(self.context, self.request)
         self.unseenCount = getUnseenCount(self.context, self.request)
-        self.storage.initialize()
         self.updateUserActions()
-        self.storage.terminate()
+
+    def isGatherDue(self):
+        scheduler = getScheduler(self.context)
+        scheduler.configure(_getSetting('gather_min_interval', 0),
+                            _getSetting('gather_max_interval', 0),
+                            _getSetting('gather_max_per_minute', 0))
+        return scheduler.due(self.portal_state.member().getId())
 
     def setSeen(self):
-        #path = '/'.join(self.context.getPhysicalPath())
-        portal_path = '/'.join(self.portal_state.portal().getPhysicalPath())
-        portal_url = self.portal_state.portal_url()
-        path = self.request['ACTUAL_URL'][len(portal_url):]
-        if not path.startswith(portal_path):
-            path = portal_path + path
-        self.storage.setSeen(path)
+        """Visiting a content sets its notifications as seen."""
+        path = '/'.join(self.context.getPhysicalPath())
+        # Most pages have none, reading spares a write to the storage
+        if self.storage.getUnseenCount(path):
+            self.storage.setSeen(path)
 
     def updateUserActions(self):
         if self.user_name is not None:
@@ -138,18 +199,16 @@ class HotViewlet(common.PersonalBarViewlet):
 
 
 def getUnseenCount(context, request):
-    storage = StorageManager(context, request)
-    storage.initialize()
-    unseenCount = storage.getUnseenCount()
-    storage.terminate()
-    return unseenCount
+    return getRequestStorage(context, request).getUnseenCount()
 
 
+@timed('validateNotification')
 def validateNotification(context, notification):
     path = notification.where
     content = None
 #        if path.startswith(portal_path):
 #            path = path[len(portal_path)+1:]
+    count('traversals')
     try:
         content = context.restrictedTraverse(str(path))
     except Unauthorized:
@@ -163,6 +222,7 @@ def validateNotification(context, notification):
         old_path = str(path)  # Whole path needed (with portal_path)
         new_path = redirection_storage.get(old_path)
         if new_path:
+            count('traversals')
             try:
                 content = context.restrictedTraverse(new_path)
             except KeyError:
@@ -176,11 +236,11 @@ def validateNotification(context, notification):
     return content
 
 
-def getHotNotifications(context, request):
-    gatherer = GathererManager(context, request)
-    storage = StorageManager(context, request)
-    storage.initialize()
-    _updateNotifications(context, storage, gatherer)
+def getHotNotifications(context, request, gather=True):
+    storage = getRequestStorage(context, request)
+    if gather:
+        gatherer = GathererManager(context, request)
+        _updateNotifications(context, storage, gatherer)
     hotNotifications = storage.getHotNotifications()
     #portal_path = _getPortalPath(context, request)
     notifications = []
@@ -203,7 +263,6 @@ def getHotNotifications(context, request):
             'url': _redirectUrl(context, request, url, notification.where),
             'seen': notification.seen
         })
-    storage.terminate()
     return notifications
 
 
@@ -219,12 +278,60 @@ def _redirectUrl(context, request, url, path):
     return redirect
 
 
-def _updateNotifications(context, storage, gatherer):
-    lastCheck = _getLastCheck(context, storage)
+def gatherNotifications(context, request, scheduled=True):
+    """Store the new notifications of the current user. The gatherings not
+    triggered by a page view, e.g. the digests, are not 'scheduled' and not
+    recorded by the scheduler."""
+    gatherer = GathererManager(context, request)
+    storage = StorageManager(context, request)
+    storage.initialize()
+    try:
+        _updateNotifications(context, storage, gatherer, scheduled)
+    finally:
+        storage.terminate()
+
+
+def _updateNotifications(context, storage, gatherer, scheduled=True):
+    started = datetime.datetime.now()
+    lastCheck = _getLastCheck(storage)
     newNotifications = gatherer.getNewNotifications(lastCheck)
     if newNotifications is not None:
         for notification in newNotifications:
             storage.storeNotification(notification)
+    resumeFrom = gatherer.resumeFrom
+    if scheduled:
+        mtool = getToolByName(context, 'portal_membership')
+        getScheduler(context).record(mtool.getAuthenticatedMember().getId(),
+                                     bool(newNotifications),
+                                     gatherer.subscriptionCount)
+    if resumeFrom is not None:
+        resumeFrom = _dumpTime(resumeFrom)
+    if resumeFrom != storage.getMeta(GATHER_CURSOR):
+        storage.setMeta(GATHER_CURSOR, resumeFrom)
+    # Useractions stored while gathering are gathered the next time
+    gatheredUntil = gatherer.gatheredUntil or started
+    storage.setMeta(GATHERED_UNTIL, _dumpTime(gatheredUntil))
+    storage.setMeta(LAST_GATHER, int(time.time()))
+    _archiveNotifications(storage)
+
+
+def _archiveNotifications(storage):
+    """Archive the old seen notifications, at most once a day."""
+    now = int(time.time())
+    if storage.getMeta(LAST_ARCHIVE, 0) > now - ARCHIVE_INTERVAL:
+        return
+    days = _getSetting('archive_after_days', None)
+    if days:
+        storage.archiveNotifications(now - days * 24 * 3600)
+    storage.setMeta(LAST_ARCHIVE, now)
+
+
+def _getSetting(name, default):
+    registry = component.queryUtility(IRegistry)
+    if registry is None:
+        return default
+    settings = registry.forInterface(ISettings, check=False)
+    return getattr(settings, name, default)
 
 
 def _getPortalPath(context, request):
@@ -235,12 +342,25 @@ def _getPortalPath(context, request):
     return '/'.join(path)
 
 
-def _getLastCheck(context, storage):
-    sdm = getToolByName(context, 'session_data_manager')
-    session = sdm.getSessionData()
-    if session is None or not SESSION_LAST_CHECK in session.keys():
-        lastCheck = storage.getLastNotificationTime()
-    else:
-        lastCheck = session[SESSION_LAST_CHECK]
-    session[SESSION_LAST_CHECK] = datetime.datetime.now()
-    return lastCheck
+def _getLastCheck(storage):
+    """Return where to gather from: the cursor of the last gathering if it
+    stopped early, else up to where it saw all the useractions."""
+    since = storage.getMeta(GATHER_CURSOR)
+    if since is None:
+        since = storage.getMeta(GATHERED_UNTIL)
+    if since is None:
+        return storage.getLastNotificationTime()
+    return _loadTime(since)
+
+
+def _dumpTime(value):
+    """Return a datetime as a meta value, to the microsecond so the next
+    gathering does not walk again the end of the last one."""
+    return value.strftime(TIME_FORMAT)
+
+
+def _loadTime(value):
+    if isinstance(value, basestring):
+        return datetime.datetime.strptime(value, TIME_FORMAT)
+    # Stored in seconds by older versions
+    return datetime.datetime.fromtimestamp(value)
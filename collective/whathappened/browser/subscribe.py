@@ -2,14 +2,19 @@ import sqlite3
 
 from zope import component
 from zope import interface
+from zope.annotation.interfaces import IAnnotations
 
 from Products.Five.browser import BrowserView
 from Products.statusmessages.interfaces import IStatusMessage
 
 from collective.whathappened.subscription import Subscription
+from collective.whathappened.subscription import parentPaths
 from collective.whathappened.storage_manager import StorageManager
 from collective.whathappened.i18n import _
 
+# Request annotation caching the subscriptions by path, shared by the views
+SUBSCRIPTIONS_KEY = 'collective.whathappened.subscriptions'
+
 
 class ISubscribe(interface.Interface):
 
@@ -60,6 +65,7 @@ class Subscribe(BrowserView):
         self.subscribed_canonical_show = False
         self.subscription_canonical = None
         self.plone_tools_loaded = False
+        self.updated = False
 
     def __call__(self):
         self.update()
@@ -78,6 +84,7 @@ class Subscribe(BrowserView):
                 mapping={'path': self.context_path.decode('utf-8')}
             ))
         self.storage.terminate()
+        IAnnotations(self.request).pop(SUBSCRIPTIONS_KEY, None)
         self.request.response.redirect(self.nextURL())
 
     def nextURL(self):
@@ -92,12 +99,11 @@ class Subscribe(BrowserView):
 
     def update(self):
         self.initialize()
-        if self.is_anon:
+        if self.is_anon or self.updated:
             return
-        self.storage.initialize()
         self.checkSubscription()
         self.checkCanonicalSubscription()
-        self.storage.terminate()
+        self.updated = True
 
     def initialize(self):
         if not self.plone_tools_loaded:
@@ -110,6 +116,7 @@ class Subscribe(BrowserView):
                 (self.context, self.request),
                 name="plone_context_state"
             )
+            self.plone_tools_loaded = True
         if self.storage is None:
             self.storage = StorageManager(self.context)
         if self.context_path is None:
@@ -121,28 +128,38 @@ class Subscribe(BrowserView):
         if self.is_anon is None:
             self.is_anon = self.portal_state.anonymous()
 
-    def _getSubscribed(self, path):
-        subscription = self.storage.getSubscription(path)
+    def _getSubscriptions(self, path):
+        """Return the subscriptions by path, None for the paths without
+        subscription. 'path' and its parents are looked up once per request,
+        for all the subscribe views and their canonical checks."""
+        annotations = IAnnotations(self.request)
+        subscriptions = annotations.setdefault(SUBSCRIPTIONS_KEY, {})
+        if path not in subscriptions:
+            self.storage.initialize()
+            found = self.storage.getSubscriptionsInTree(path)
+            self.storage.terminate()
+            for where in [path] + parentPaths(path):
+                subscriptions[where] = found.get(where)
+        return subscriptions
+
+    def _getSubscribed(self, subscription):
         if subscription is None:
             return False
         return subscription.wants
 
-    def _hasParentSubscription(self, path):
-        path = path.rpartition('/')[0]
-        while len(path) > 0 and path != '/':
-            if '/' not in path:
-                break
-            subscription = self.storage.getSubscription(path)
+    def _hasParentSubscription(self, path, subscriptions):
+        for parent in parentPaths(path):
+            subscription = subscriptions[parent]
             if subscription is not None and subscription.wants:
                 return True
-            path = path.rpartition('/')[0]
         return False
 
     def checkSubscription(self):
-        path = '/'.join(self.context.getPhysicalPath())
-        self.subscribed = self._getSubscribed(path)
-        self.subscription = self.storage.getSubscription(path)
-        if self._hasParentSubscription(path):
+        path = self.context_path
+        subscriptions = self._getSubscriptions(path)
+        self.subscription = subscriptions[path]
+        self.subscribed = self._getSubscribed(self.subscription)
+        if self._hasParentSubscription(path, subscriptions):
             self.subscribed_show = False
         else:
             self.subscribed_show = True
@@ -150,9 +167,12 @@ class Subscribe(BrowserView):
     def checkCanonicalSubscription(self):
         if self.is_default_page:
             path = '/'.join(self.canonical.getPhysicalPath())
-            self.subscribed_canonical = self._getSubscribed(path)
-            self.subscription_canonical = self.storage.getSubscription(path)
-            if self._hasParentSubscription(path):
+            subscriptions = self._getSubscriptions(path)
+            self.subscription_canonical = subscriptions[path]
+            self.subscribed_canonical = self._getSubscribed(
+                self.subscription_canonical
+            )
+            if self._hasParentSubscription(path, subscriptions):
                 self.subscribed_canonical_show = False
             else:
                 self.subscribed_canonical_show = True
@@ -0,0 +1,113 @@
+import json
+
+from collective.whathappened.notification import Notification
+
+
+def _parent(notification):
+    return notification.where.rpartition('/')[0]
+
+
+def _who(notification):
+    return tuple(sorted(notification.who))
+
+
+KEYS = {
+    'where': lambda notification: notification.where,
+    'parent': _parent,
+    'who': _who,
+    'gatherer': lambda notification: notification.gatherer,
+}
+
+
+def _commonPath(paths):
+    """Return the deepest path containing all the given paths."""
+    common = paths[0].split('/')
+    for path in paths[1:]:
+        elements = path.split('/')
+        i = 0
+        while i < len(common) and i < len(elements) \
+                and common[i] == elements[i]:
+            i += 1
+        common = common[:i]
+    return '/'.join(common)
+
+
+class _Group(object):
+    """Notifications waiting to be merged into one."""
+
+    def __init__(self, notification):
+        self.start = notification.getWhenTimestamp()
+        self.notifications = [notification]
+
+    def merge(self):
+        if len(self.notifications) == 1:
+            return self.notifications[0]
+        last = self.notifications[-1]
+        who = []
+        counts = {}
+        infos = set()
+        for notification in self.notifications:
+            for user in notification.who:
+                if user not in who:
+                    who.append(user)
+            counts[notification.where] = max(
+                counts.get(notification.where, 0), notification.count
+            )
+            infos.add(json.dumps(notification.info, sort_keys=True))
+        wheres = counts.keys()
+        if len(infos) == 1:
+            info = last.info
+        else:
+            info = None
+        return Notification(
+            last.what,
+            _commonPath(wheres),
+            last.getWhenTimestamp(),
+            who,
+            last.user,
+            last.gatherer,
+            info=info,
+            count=sum(counts.values()),
+        )
+
+
+class Coalescer(object):
+    """Merge the notifications about the same 'what' sharing the configured
+    keys and happening within 'window' seconds of the first one of their
+    group.
+
+    The merged notification is located at the deepest path common to all its
+    notifications, its who are merged and its count is the number of
+    distinct contents it stands for. Notifications are always grouped by
+    folder at least, else the merged one could move up to the portal."""
+
+    def __init__(self, keys, window):
+        if 'where' not in keys and 'parent' not in keys:
+            keys = list(keys) + ['parent']
+        self.keys = [KEYS[key] for key in keys if key in KEYS]
+        self.window = window
+
+    def _key(self, notification):
+        key = [notification.what]
+        for getter in self.keys:
+            key.append(getter(notification))
+        return tuple(key)
+
+    def coalesce(self, notifications):
+        if self.window <= 0 or len(notifications) < 2:
+            return notifications
+        notifications = sorted(notifications,
+                               key=lambda n: n.getWhenTimestamp())
+        current = {}
+        groups = []
+        for notification in notifications:
+            key = self._key(notification)
+            group = current.get(key)
+            timestamp = notification.getWhenTimestamp()
+            if group is None or timestamp - group.start > self.window:
+                group = _Group(notification)
+                current[key] = group
+                groups.append(group)
+            else:
+                group.notifications.append(notification)
+        return [merged.merge() for merged in groups]
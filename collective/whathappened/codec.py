@@ -0,0 +1,46 @@
+"""Compact encoding of the notification info.
+
+The info is stored as canonical JSON, compressed with zlib when it is long
+enough to gain from it. Notifications are compared by a 64 bits hash of the
+canonical JSON rather than by the stored value. The info is only decoded
+when it is accessed, see Notification.info.
+"""
+import hashlib
+import json
+import struct
+import zlib
+
+# Shorter JSON is stored as text, zlib would not make it much smaller
+COMPRESS_MIN = 200
+
+
+def canonical(info):
+    """Return the JSON of info, the same for equal infos."""
+    return json.dumps(info, sort_keys=True, separators=(',', ':'))
+
+
+def infoHash(info):
+    """Return a signed 64 bits integer hash of info."""
+    return _hash(canonical(info))
+
+
+def _hash(text):
+    return struct.unpack('>q', hashlib.sha1(text).digest()[:8])[0]
+
+
+def encode(info):
+    """Return the value to store for info, JSON text or compressed bytes,
+    and its hash."""
+    text = canonical(info)
+    if len(text) >= COMPRESS_MIN:
+        return buffer(zlib.compress(text)), _hash(text)
+    return text, _hash(text)
+
+
+def decode(value):
+    """Return the info stored as value by encode, or as plain JSON text."""
+    if value is None:
+        return None
+    if isinstance(value, buffer):
+        value = zlib.decompress(value)
+    return json.loads(value)
@@ -0,0 +1,150 @@
+"""Gather the notifications after the response is sent.
+
+When the deferred gathering is enabled, the personal bar only reads the
+storage and the gathering of the user is queued once the request ends. A
+few worker threads run the queued gatherings, each in its own ZODB
+connection. A user is queued at most once until their gathering is done,
+the new notifications show up on the next page they view.
+"""
+import logging
+import Queue
+import threading
+
+import transaction
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from Products.CMFCore.utils import getToolByName
+from Testing.makerequest import makerequest
+from zope.annotation.interfaces import IAnnotations
+from zope.component.hooks import setSite
+
+logger = logging.getLogger('collective.whathappened')
+
+ANNOTATION = 'collective.whathappened.deferred'
+# Worker threads per process
+WORKERS = 2
+# Gatherings waiting for a worker, the next ones are dropped
+QUEUE_SIZE = 1000
+
+
+class GatheringPool(object):
+    """Worker threads calling 'func' with the queued arguments. The same
+    arguments are queued at most once until their call is done."""
+
+    def __init__(self, func, workers=WORKERS, size=QUEUE_SIZE):
+        self.func = func
+        self.workers = workers
+        self.queue = Queue.Queue(size)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def submit(self, *args):
+        """Queue a call, return False if it is already queued or the queue
+        is full."""
+        with self.lock:
+            if args in self.pending:
+                return False
+            try:
+                self.queue.put_nowait(args)
+            except Queue.Full:
+                logger.warning("Deferred gatherings queue full, "
+                               "dropping %r" % (args,))
+                return False
+            self.pending.add(args)
+            self._start()
+        return True
+
+    def _start(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work,
+                                      name='whathappened-gatherer-%d' %
+                                      len(self.threads))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            args = self.queue.get()
+            try:
+                self.func(*args)
+            except Exception:
+                logger.exception("Deferred gathering %r failed" % (args,))
+            finally:
+                with self.lock:
+                    self.pending.discard(args)
+                self.queue.task_done()
+
+    def join(self):
+        """Wait until all the queued calls are done."""
+        self.queue.join()
+
+
+def gather(sitePath, userId):
+    """Gather the new notifications of a user of the site, as this user."""
+    import Zope2
+    from collective.whathappened.browser.notifications import \
+        gatherNotifications
+
+    app = makerequest(Zope2.app())
+    try:
+        site = app.unrestrictedTraverse(sitePath)
+        setSite(site)
+        user = getUser(site, app, userId)
+        if user is None:
+            logger.warning("Deferred gathering: no user %s for %s"
+                           % (userId, sitePath))
+            return
+        newSecurityManager(app.REQUEST, user)
+        gatherNotifications(site, app.REQUEST)
+        transaction.commit()
+    except Exception:
+        transaction.abort()
+        raise
+    finally:
+        noSecurityManager()
+        setSite(None)
+        app._p_jar.close()
+
+
+def getUser(site, app, userId):
+    """Return the user wrapped in its acl_users, looked up in the site then
+    in Zope like the publisher does."""
+    for acl_users in (getToolByName(site, 'acl_users'), app.acl_users):
+        user = acl_users.getUserById(userId)
+        if user is not None:
+            return user.__of__(acl_users)
+    return None
+
+
+_pool = None
+_lock = threading.Lock()
+
+
+def getPool():
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                _pool = GatheringPool(gather)
+    return _pool
+
+
+def schedule(context, request):
+    """Gather the notifications of the current user once the request
+    ends."""
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    mtool = getToolByName(context, 'portal_membership')
+    member = mtool.getAuthenticatedMember()
+    IAnnotations(request)[ANNOTATION] = (
+        '/'.join(portal.getPhysicalPath()),
+        member.getId(),
+    )
+
+
+def requestEnded(event):
+    """Queue the gathering scheduled during the request."""
+    args = IAnnotations(event.request).get(ANNOTATION)
+    if args is not None:
+        getPool().submit(*args)
@@ -0,0 +1,190 @@
+"""Email digests of the notifications the users have not seen.
+
+Every run gathers the new notifications of each user, since the users
+away from the site do not gather them by viewing pages, then mails them the
+unseen notifications they were not mailed yet, and sets them as mailed in
+their storage. The notifications merged with new ones are mailed again.
+Mails are sent through the MailHost of the site, 'batch' at a time, at most
+'rate' mails per second. Run it periodically, e.g. from cron::
+
+    bin/instance whathappened-digest Plone --rate 5
+
+or by calling @@whathappened-digest on the site as a manager.
+"""
+import argparse
+import datetime
+import logging
+import sys
+import time
+
+from AccessControl.SecurityManagement import getSecurityManager
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import setSecurityManager
+from Products.CMFCore.utils import getToolByName
+from zope.browser.interfaces import IBrowserView
+from zope.i18n import translate
+
+from collective.whathappened.browser.notifications import \
+    gatherNotifications
+from collective.whathappened.browser.notifications import show
+from collective.whathappened.browser.notifications import validateNotification
+from collective.whathappened.exceptions import NotificationValueError
+from collective.whathappened.i18n import _
+from collective.whathappened.storage_manager import StorageManager
+
+logger = logging.getLogger('collective.whathappened')
+
+
+class DigestSender(object):
+    """Mail the users their unseen notifications."""
+
+    def __init__(self, context, request, rate=10, batch=50, limit=50,
+                 days=7, sleep=time.sleep):
+        self.context = context
+        self.request = request
+        self.rate = rate
+        self.batch = batch
+        # Notifications per mail, the next ones are in the next digest
+        self.limit = limit
+        # Older notifications are never mailed
+        self.days = days
+        self.sleep = sleep
+        self.portal = getToolByName(context, 'portal_url').getPortalObject()
+        self.mtool = getToolByName(context, 'portal_membership')
+        self.mailhost = getToolByName(context, 'MailHost')
+        self.storage = StorageManager(context, request)
+        self.sent = 0
+        self.batchStart = None
+
+    def run(self):
+        """Send the digests of all the users, return the number of mails."""
+        self.sent = 0
+        self.batchStart = time.time()
+        since = datetime.datetime.now() - datetime.timedelta(self.days)
+        since = int(time.mktime(since.timetuple()))
+        for user in self.storage.listUsers():
+            try:
+                self.sendDigest(user, since)
+            except Exception:
+                logger.exception("Could not send the digest of %s" % user)
+        return self.sent
+
+    def sendDigest(self, user, since):
+        member = self.mtool.getMemberById(user)
+        if member is None or not member.getProperty('email'):
+            return
+        self._asUser(member, self.gather)
+        self.storage.setUser(user)
+        self.storage.initialize()
+        try:
+            notifications = self.storage.getUnmailedNotifications(
+                since, self.limit
+            )
+            if not notifications:
+                return
+            lines = self._asUser(member, self.render, notifications)
+            if lines:
+                self.send(member, lines)
+            self.storage.setMailed([n.id for n in notifications])
+        finally:
+            self.storage.terminate()
+
+    def gather(self):
+        """Store the new notifications of the current user."""
+        gatherNotifications(self.context, self.request, scheduled=False)
+
+    def _asUser(self, member, func, *args):
+        """Call func with the permissions of the member."""
+        securityManager = getSecurityManager()
+        # Wrapped in the acl_users defining it, e.g. the one of Zope
+        user = member.getUser()
+        try:
+            newSecurityManager(self.request, user)
+            return func(*args)
+        finally:
+            setSecurityManager(securityManager)
+
+    def render(self, notifications):
+        """Return a line per notification the user can still view."""
+        lines = []
+        for notification in notifications:
+            try:
+                content = validateNotification(self.portal, notification)
+            except NotificationValueError:
+                continue
+            if IBrowserView.providedBy(content):
+                url = content.context.absolute_url() + '/@@' + content.__name__
+            else:
+                url = content.absolute_url()
+            title = translate(show(content, self.request, notification),
+                              context=self.request)
+            lines.append(u"- %s\n  %s" % (title, url))
+        return lines
+
+    def send(self, member, lines):
+        site = self.portal.Title().decode('utf-8')
+        subject = translate(_(u"${count} new notifications on ${site}",
+                              mapping={'count': len(lines), 'site': site}),
+                            context=self.request)
+        name = member.getProperty('fullname') or member.getId()
+        header = translate(_(u"Hello ${name}, here is what happened since "
+                             u"your last visit:",
+                             mapping={'name': name.decode('utf-8')}),
+                           context=self.request)
+        body = u"\n\n".join([header, u"\n".join(lines)])
+        sender = '"%s" <%s>' % (self.portal.getProperty('email_from_name'),
+                                self.portal.getProperty('email_from_address'))
+        self.mailhost.send(body.encode('utf-8'),
+                           mto=member.getProperty('email'),
+                           mfrom=sender,
+                           subject=subject.encode('utf-8'),
+                           charset='utf-8',
+                           immediate=True)
+        self.sent += 1
+        self._throttle()
+
+    def _throttle(self):
+        """Wait at the end of each batch so at most 'rate' mails are sent per
+        second. A rate of 0 means no limit."""
+        if self.rate <= 0 or self.batch <= 0 or self.sent % self.batch:
+            return
+        wait = self.batchStart + float(self.batch) / self.rate - time.time()
+        if wait > 0:
+            self.sleep(wait)
+        self.batchStart = time.time()
+
+
+def parse(argv):
+    parser = argparse.ArgumentParser(
+        prog='whathappened-digest',
+        description="Mail the users their unseen notifications.")
+    parser.add_argument('site', help="Path of the Plone site in Zope.")
+    parser.add_argument('--rate', type=float, default=10,
+                        help="Maximum mails sent per second, 0 for no "
+                             "limit.")
+    parser.add_argument('--batch', type=int, default=50,
+                        help="Mails sent between two rate checks.")
+    parser.add_argument('--limit', type=int, default=50,
+                        help="Maximum notifications per mail.")
+    parser.add_argument('--days', type=int, default=7,
+                        help="Only mail the notifications of the last days.")
+    return parser.parse_args(argv)
+
+
+def main(app, args):
+    """zopectl command, see the module docstring."""
+    from AccessControl.SpecialUsers import system
+    from Testing.makerequest import makerequest
+    from zope.component.hooks import setSite
+    import transaction
+
+    options = parse(args)
+    app = makerequest(app)
+    site = app.unrestrictedTraverse(options.site)
+    setSite(site)
+    newSecurityManager(None, system)
+    sender = DigestSender(site, app.REQUEST, options.rate, options.batch,
+                          options.limit, options.days)
+    sent = sender.run()
+    transaction.commit()
+    sys.stderr.write("%d digests sent\n" % sent)
@@ -11,6 +11,23 @@ class SubscribedEvent(ObjectEvent):
     interface.implements(ISubscribedEvent)
 
 
+class ISubscriptionsChangedEvent(interface.Interface):
+    """Subscriptions of a user were changed at once."""
+
+    user = interface.Attribute("The id of the user")
+    subscriptions = interface.Attribute(
+        "The changed subscriptions, wants is None for the removed ones."
+    )
+
+
+class SubscriptionsChangedEvent(object):
+    interface.implements(ISubscriptionsChangedEvent)
+
+    def __init__(self, user, subscriptions):
+        self.user = user
+        self.subscriptions = subscriptions
+
+
 class IBlacklistedEvent(IObjectEvent):
     pass
 
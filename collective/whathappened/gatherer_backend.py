@@ -1,4 +1,5 @@
 import json
+import time
 
 from AccessControl.unauthorized import Unauthorized
 
@@ -12,8 +13,18 @@ from Products.CMFCore.utils import getToolByName
 from collective.history.manager import UserActionManager
 from collective.history.useraction import IUserAction
 
+from collective.whathappened.instrumentation import count
 from collective.whathappened.notification import Notification
 from collective.whathappened.storage_manager import StorageManager
+from collective.whathappened.subscription import GROUP
+from collective.whathappened.subscription import ROLE
+from collective.whathappened.subscription import findSubscription
+from collective.whathappened.subscription import mergeShared
+from collective.whathappened.useraction_window import RecentUserAction
+from collective.whathappened.useraction_window import getWindow
+
+# Default window of the gatherer, the one shared by the site
+SITE_WINDOW = object()
 
 
 class IGathererBackend(interface.Interface):
@@ -21,10 +32,21 @@ class IGathererBackend(interface.Interface):
     for a specific user and to transform it into notifications"""
 
     id = schema.ASCIILine(title=u"id")
+    resumeFrom = interface.Attribute(
+        "Datetime the next gathering should start from when the last one "
+        "stopped early to stay within its budget, else None."
+    )
+    gatheredUntil = interface.Attribute(
+        "Datetime up to which the last gathering saw all the useractions "
+        "when it did not stop early, None if up to when it started."
+    )
 
     def getNewNotifications(lastCheck):
         """Get a list of new notifications since lastCheck.
-        lastCheck is a datetime object."""
+        lastCheck is a datetime object.
+
+        Gathering may stop before the newest useractions to stay within the
+        budget of the settings, see resumeFrom."""
 
     def getId():
         """Get the unique id of the gatherer"""
@@ -40,16 +62,30 @@ class UserActionGathererBackend(BrowserView):
 
     id = "useraction"
 
-    def __init__(self, context, request):
+    def __init__(self, context, request, manager=None, storage=None,
+                 window=SITE_WINDOW):
+        """The useraction manager, the storage and the window (None for
+        none) can be given, e.g. to work on stand-ins."""
         self.context = context
         self.request = request
         settings_url = '@@get-whathappened-settings'
         self.settings = self.context.restrictedTraverse(settings_url)()
         self.mtool = getToolByName(self.context, 'portal_membership')
         self.user = self.mtool.getAuthenticatedMember().getId()
-        self.manager = UserActionManager(self.context, self.request)
-        self.manager.update()
-        self.storage = StorageManager(self.context, self.request)
+        if manager is None:
+            manager = UserActionManager(self.context, self.request)
+            manager.update()
+        self.manager = manager
+        if storage is None:
+            storage = StorageManager(self.context, self.request)
+        self.storage = storage
+        self.subscriptions = {}
+        self.sharedSubscriptions = {}
+        self.resumeFrom = None
+        self.gatheredUntil = None
+        if window is SITE_WINDOW:
+            window = getWindow(self.context)
+        self.window = window
 
     def _createNotificationFromUserAction(self, useraction):
         if not IUserAction.providedBy(useraction):
@@ -69,33 +105,81 @@ class UserActionGathererBackend(BrowserView):
         )
         return notification
 
+    def _getPrincipals(self):
+        """Return the principal ids of the groups and roles of the user."""
+        member = self.mtool.getMemberById(self.user)
+        if member is None:
+            return []
+        principals = [GROUP % group for group in member.getGroups()]
+        principals += [ROLE % role for role in member.getRoles()]
+        return principals
+
+    def _loadSubscriptions(self):
+        self.subscriptions = dict((subscription.where, subscription)
+                                  for subscription
+                                  in self.storage.getSubscriptions())
+        self.sharedSubscriptions = mergeShared(
+            self.storage.getSharedSubscriptions(self._getPrincipals())
+        )
+
     def _getSubscriptionInTree(self, path):
-        while '/' in path and path != '/':
-            subscription = self.storage.getSubscription(path)
-            if subscription is not None:
-                break
-            path = path.rpartition('/')[0]
-        return subscription
+        return findSubscription(path, self.subscriptions,
+                                self.sharedSubscriptions)
 
     def getNewNotifications(self, lastCheck):
-        brains = self.manager.search(when={
-            'query': DateTime(lastCheck),
-            'range': 'min'
-        })
+        self.resumeFrom = None
+        self.gatheredUntil = None
+        maxBrains = self.settings.gather_max_useractions or 0
+        maxTime = (self.settings.gather_max_time or 0) / 1000.0
+        start = time.time()
+        brains, completeUntil = self._search(lastCheck)
         notifications = []
         self.storage.initialize()
-        for brain in brains:
+        self._loadSubscriptions()
+        walkedUntil = lastCheck
+        for walked, brain in enumerate(brains):
+            overBudget = ((maxBrains and walked >= maxBrains) or
+                          (maxTime and time.time() - start > maxTime))
+            # Only stop before a later time than the useractions walked, so
+            # resuming from it neither walks them again nor skips any.
+            if overBudget and brain.when > walkedUntil:
+                self.resumeFrom = brain.when
+                break
+            walkedUntil = max(walkedUntil, brain.when)
             subscription = self._getSubscriptionInTree(brain.where_path)
             if not self._useractionIsCorrect(subscription, brain, lastCheck):
                 continue
-            useraction = self.manager.get(brain.id)
+            useraction = self._getUserAction(brain)
             if useraction.who == self.user:
                 continue
             notification = self._createNotificationFromUserAction(useraction)
             notifications.append(notification)
         self.storage.terminate()
+        if self.resumeFrom is None:
+            # The useractions since the last refresh of the window are
+            # gathered next time.
+            self.gatheredUntil = completeUntil
         return notifications
 
+    def _search(self, lastCheck):
+        """Return the brains of the useractions since lastCheck, oldest
+        first, and the datetime up to which they are complete, or None if
+        they are up to date."""
+        if self.window is not None:
+            found = self.window.search(self.manager, lastCheck)
+            if found is not None:
+                return found
+        brains = self.manager.search(when={
+            'query': DateTime(lastCheck),
+            'range': 'min'
+        }, sort_on='when')
+        return brains, None
+
+    def _getUserAction(self, brain):
+        if isinstance(brain, RecentUserAction):
+            return brain
+        return self.manager.get(brain.id)
+
     def _useractionIsCorrect(self, subscription, brain, lastCheck):
         what_whitelist = self.settings.useraction_gatherer_whitelist
         if subscription is None or not subscription.wants:
@@ -104,6 +188,7 @@ class UserActionGathererBackend(BrowserView):
             return False
         if brain.what not in what_whitelist:
             return False
+        count('traversals')
         try:
             self.context.restrictedTraverse(brain.where_path)
         except Unauthorized:
@@ -3,7 +3,12 @@ from zope import component
 
 from plone.registry.interfaces import IRegistry
 
+from collective.whathappened.coalesce import Coalescer
 from collective.whathappened.exceptions import NoBackendException
+from collective.whathappened.instrumentation import timed
+from collective.whathappened.instrumentation import timer
+from collective.whathappened.resolver import resolveBackend
+from collective.whathappened.settings import ISettings
 
 
 class IGathererManager(interface.Interface):
@@ -18,8 +23,24 @@ class IGathererManager(interface.Interface):
     def update():
         """Get the gatherer backends."""
 
+    resumeFrom = interface.Attribute(
+        "Datetime the next gathering should start from when a backend "
+        "stopped early, else None."
+    )
+
+    gatheredUntil = interface.Attribute(
+        "Datetime up to which the last gathering saw all the useractions, "
+        "None if up to when it started."
+    )
+
+    subscriptionCount = interface.Attribute(
+        "Number of subscriptions the last gathering followed, 0 if the "
+        "backends do not tell."
+    )
+
     def getNewNotifications(lastCheck):
-        """Get all new notifications since lastCheck"""
+        """Get all new notifications since lastCheck, merged according to
+        the coalescing settings"""
 
     def setUser(user):
         """Change the user the gather works on"""
@@ -32,32 +53,55 @@ class GathererManager(object):
         self.context = context
         self.request = request
         self.backends = []
+        self.registry = None
+        self.resumeFrom = None
+        self.gatheredUntil = None
+        self.subscriptionCount = 0
+        self.update()
 
     def update(self):
         if not self.backends:
             self.registry = component.queryUtility(IRegistry)
             if self.registry is None:
                 return
-            backend = self.registry.get(
+            name = self.registry.get(
                 'collective.whathappened.gatherer',
                 'collective.whathappened.gatherer.useraction'
             )
-            self.backends = [self.context.restrictedTraverse(backend)]
+            backend = resolveBackend(self.context, self.request, name)
             if backend is None:
                 raise NoBackendException('Gatherer')
-
-    def __getattribute__(self, name):
-        """Automatically call self.update() when other methods are called"""
-        if name not in ['update', 'registry', 'backends',
-                        'context', 'request']:
-            self.update()
-        return object.__getattribute__(self, name)
+            self.backends = [backend]
 
     def getNewNotifications(self, lastCheck):
         notifications = []
+        self.resumeFrom = None
+        self.gatheredUntil = None
+        self.subscriptionCount = 0
         for backend in self.backends:
-            notifications += backend.getNewNotifications(lastCheck)
-        return notifications
+            with timer('gatherer.%s' % backend.getId()):
+                notifications += backend.getNewNotifications(lastCheck)
+            resumeFrom = getattr(backend, 'resumeFrom', None)
+            if resumeFrom is not None and (self.resumeFrom is None or
+                                           resumeFrom < self.resumeFrom):
+                self.resumeFrom = resumeFrom
+            gatheredUntil = getattr(backend, 'gatheredUntil', None)
+            if gatheredUntil is not None and (
+                    self.gatheredUntil is None or
+                    gatheredUntil < self.gatheredUntil):
+                self.gatheredUntil = gatheredUntil
+            self.subscriptionCount += len(getattr(backend, 'subscriptions',
+                                                  ()))
+        return self.coalesce(notifications)
+
+    @timed('gatherer.coalesce')
+    def coalesce(self, notifications):
+        if self.registry is None:
+            return notifications
+        settings = self.registry.forInterface(ISettings, check=False)
+        window = settings.coalesce_window or 0
+        coalescer = Coalescer(settings.coalesce_keys or [], window * 60)
+        return coalescer.coalesce(notifications)
 
     def setUser(self, user):
         for backend in self.backends:
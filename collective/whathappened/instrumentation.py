@@ -0,0 +1,199 @@
+import functools
+import logging
+import random
+import threading
+import time
+
+from AccessControl import getSecurityManager
+from plone.registry.interfaces import IRegistry
+from zope import component
+from zope import interface
+
+from collective.whathappened.settings import ISettings
+
+logger = logging.getLogger('collective.whathappened')
+
+HEADER = 'X-Whathappened-Timing'
+
+_local = threading.local()
+
+
+class IMetricsSink(interface.Interface):
+    """A metrics sink is a utility receiving the statistics of every sampled
+    request. All the registered sinks are called."""
+
+    def emit(stats):
+        """Handle the RequestStats of a finished request."""
+
+
+class RequestStats(object):
+    """Timings and counters collected during one request."""
+
+    def __init__(self, url, user):
+        self.url = url
+        self.user = user
+        self.start = time.time()
+        self.duration = None
+        self.timings = {}
+        self.counters = {}
+
+    def add(self, name, duration):
+        timing = self.timings.setdefault(name, [0, 0.0])
+        timing[0] += 1
+        timing[1] += duration
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self):
+        self.duration = time.time() - self.start
+
+    def header(self):
+        values = ['%s;calls=%d;ms=%.1f' % (name, calls, total * 1000)
+                  for name, (calls, total) in sorted(self.timings.items())]
+        values += ['%s=%d' % item for item in sorted(self.counters.items())]
+        return ', '.join(values)
+
+    def asDict(self):
+        return {
+            'url': self.url,
+            'user': self.user,
+            'start': self.start,
+            'duration': self.duration,
+            'timings': dict((name, {'calls': calls, 'total': total})
+                            for name, (calls, total)
+                            in self.timings.items()),
+            'counters': dict(self.counters),
+        }
+
+
+class LoggingSink(object):
+    """Log one line per sampled request."""
+    interface.implements(IMetricsSink)
+
+    def emit(self, stats):
+        logger.info('%s user=%s %.1fms %s' % (stats.url, stats.user,
+                                              stats.duration * 1000,
+                                              stats.header()))
+
+
+class UserTimingsSink(object):
+    """Keep the request durations of the users, to find the slowest ones."""
+    interface.implements(IMetricsSink)
+
+    size = 1000
+
+    def __init__(self):
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def emit(self, stats):
+        if stats.user is None:
+            return
+        with self.lock:
+            timing = self.users.get(stats.user)
+            if timing is None:
+                if len(self.users) >= self.size:
+                    fastest = min(self.users,
+                                  key=lambda u: self.users[u]['total'] /
+                                  self.users[u]['requests'])
+                    del self.users[fastest]
+                timing = self.users[stats.user] = {
+                    'requests': 0,
+                    'total': 0.0,
+                    'max': 0.0,
+                    'queries': 0,
+                }
+            timing['requests'] += 1
+            timing['total'] += stats.duration
+            timing['max'] = max(timing['max'], stats.duration)
+            timing['queries'] += stats.counters.get('queries', 0)
+
+    def slowest(self, limit=10):
+        with self.lock:
+            users = [dict(timing, user=user, mean=timing['total'] /
+                          timing['requests'])
+                     for user, timing in self.users.items()]
+        users.sort(key=lambda timing: timing['mean'], reverse=True)
+        return users[:limit]
+
+
+def count(name, value=1):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.count(name, value)
+
+
+class timer(object):
+    """Context manager adding the duration of its block to the request
+    statistics under 'name'."""
+
+    def __init__(self, name):
+        self.name = name
+        self.stats = None
+
+    def __enter__(self):
+        self.stats = getattr(_local, 'stats', None)
+        if self.stats is not None:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.stats is not None:
+            self.stats.add(self.name, time.time() - self.start)
+
+
+def timed(name):
+    """Decorator adding the duration of each call to the request statistics
+    under 'name'. Calls cost a thread local lookup when not sampled."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = getattr(_local, 'stats', None)
+            if stats is None:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.add(name, time.time() - start)
+        return wrapper
+    return decorator
+
+
+def _sampleRate():
+    registry = component.queryUtility(IRegistry)
+    if registry is None:
+        return 0
+    settings = registry.forInterface(ISettings, check=False)
+    return getattr(settings, 'instrumentation_sample_rate', None) or 0
+
+
+def start(event):
+    """Start sampling the request once the site is known."""
+    _local.stats = None
+    rate = _sampleRate()
+    if rate <= 0 or random.random() >= rate:
+        return
+    user = getSecurityManager().getUser()
+    _local.stats = RequestStats(event.request.get('ACTUAL_URL', ''),
+                                user.getId() if user is not None else None)
+
+
+def finish(event):
+    """Send the statistics of the request to the sinks."""
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        return
+    _local.stats = None
+    stats.finish()
+    event.request.response.setHeader(HEADER, stats.header())
+    for sink in component.getAllUtilitiesRegisteredFor(IMetricsSink):
+        try:
+            sink.emit(stats)
+        except Exception:
+            logger.exception('Metrics sink %r failed' % sink)
+
+
+def abort(event):
+    _local.stats = None
@@ -0,0 +1,362 @@
+"""Versioned schema migrations of the sqlite user storages.
+
+Every storage records the last migration applied to it in its
+schema_version table. Storages are migrated when they are opened, or all
+at once with the whathappened-migrate script, e.g.::
+
+    bin/whathappened-migrate var/sqlite --processes 4 --checkpoint migrate.json
+
+The script can be stopped and run again: the storages recorded as up to
+date in the checkpoint file are skipped. Migrations only see the schema
+they were written for, so they are kept as they are once released.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import sys
+import uuid
+
+from collective.whathappened.codec import infoHash
+
+logger = logging.getLogger('collective.whathappened')
+
+CREATE_SCHEMA_VERSION = """
+    CREATE TABLE IF NOT EXISTS schema_version(
+    `version`   INTEGER)
+"""
+
+
+def _columns(db, table):
+    return [row[1] for row in db.execute("PRAGMA table_info(%s)" % table)]
+
+
+def _addInfo(db):
+    if 'info' not in _columns(db, 'notifications'):
+        db.execute("ALTER TABLE notifications ADD `info` TEXT")
+
+
+def _addCount(db):
+    if 'count' not in _columns(db, 'notifications'):
+        db.execute("ALTER TABLE notifications ADD `count` INTEGER DEFAULT 1")
+
+
+def _internActors(db):
+    if 'who' not in _columns(db, 'notifications_who'):
+        return
+    db.execute("ALTER TABLE notifications RENAME TO notifications_old")
+    db.execute("ALTER TABLE notifications_who RENAME TO notifications_who_old")
+    db.execute("""
+        CREATE TABLE notifications(
+        `id`        INTEGER PRIMARY KEY,
+        `what`      TEXT,
+        `when`      INTEGER,
+        `where`     TEXT,
+        `seen`      INTEGER,
+        `gatherer`  TEXT,
+        `info`      TEXT,
+        `count`     INTEGER DEFAULT 1,
+        UNIQUE(`what`, `when`, `where`))
+    """)
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS actors(
+        `id`        INTEGER PRIMARY KEY,
+        `name`      TEXT UNIQUE)
+    """)
+    db.execute("""
+        CREATE TABLE notifications_who(
+        `notification`  INTEGER REFERENCES notifications(`id`)
+                        ON DELETE CASCADE,
+        `actor`         INTEGER REFERENCES actors(`id`),
+        PRIMARY KEY(`notification`, `actor`)) WITHOUT ROWID
+    """)
+    db.execute("""INSERT INTO notifications (`what`, `when`, `where`, `seen`,
+                                             `gatherer`, `info`, `count`)
+                  SELECT `what`, `when`, `where`, `seen`,
+                         `gatherer`, `info`, `count`
+                  FROM notifications_old""")
+    db.execute("""INSERT OR IGNORE INTO actors (`name`)
+                  SELECT DISTINCT `who` FROM notifications_who_old""")
+    db.execute("""INSERT OR IGNORE INTO notifications_who (`notification`,
+                                                           `actor`)
+                  SELECT n.`id`, a.`id`
+                  FROM notifications_who_old o
+                  INNER JOIN notifications n
+                      ON n.`what` = o.`what`
+                      AND n.`when` = o.`when`
+                      AND n.`where` = o.`where`
+                  INNER JOIN actors a ON a.`name` = o.`who`""")
+    db.execute("DROP TABLE notifications_who_old")
+    db.execute("DROP TABLE notifications_old")
+
+
+def _addMeta(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS meta(
+        `key`       TEXT PRIMARY KEY,
+        `value`)
+    """)
+
+
+def _addPathIndexes(db):
+    db.execute("""
+        CREATE INDEX IF NOT EXISTS notifications_where
+        ON notifications(`where`)
+    """)
+    db.execute("""
+        CREATE INDEX IF NOT EXISTS notifications_unseen_where
+        ON notifications(`where`) WHERE `seen` = 0
+    """)
+    # Remove the who rows left over by the notifications deleted before the
+    # foreign key cascade.
+    db.execute("""DELETE FROM notifications_who WHERE `notification` NOT IN
+                  (SELECT `id` FROM notifications)""")
+
+
+def _addArchive(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS archive(
+        `id`        INTEGER PRIMARY KEY,
+        `what`      TEXT,
+        `when`      INTEGER,
+        `where`     TEXT,
+        `payload`   BLOB,
+        UNIQUE(`where`, `when`, `what`))
+    """)
+    db.execute("""
+        CREATE INDEX IF NOT EXISTS archive_when
+        ON archive(`when`)
+    """)
+
+
+def _addInfoHash(db):
+    if 'info_hash' not in _columns(db, 'notifications'):
+        db.execute("ALTER TABLE notifications ADD `info_hash` INTEGER")
+    # Only unseen notifications are looked up by hash, to merge the new
+    # ones into them, so the seen ones are left without a hash
+    rows = db.execute("SELECT `id`, `info` FROM notifications "
+                      "WHERE `seen` = 0").fetchall()
+    db.executemany("UPDATE notifications SET `info_hash` = ? WHERE `id` = ?",
+                   [(infoHash(json.loads(info or 'null')), notificationId)
+                    for notificationId, info in rows])
+
+
+def _addMailed(db):
+    if 'mailed' not in _columns(db, 'notifications'):
+        db.execute("ALTER TABLE notifications ADD `mailed` INTEGER DEFAULT 0")
+    # The digests used to record the id of the last notification mailed
+    row = db.execute("SELECT `value` FROM meta "
+                     "WHERE `key` = 'mailed_until'").fetchone()
+    if row is not None:
+        db.execute("UPDATE notifications SET `mailed` = 1 WHERE `id` <= ?",
+                   [row[0]])
+        db.execute("DELETE FROM meta WHERE `key` = 'mailed_until'")
+    db.execute("""
+        CREATE INDEX IF NOT EXISTS notifications_unmailed
+        ON notifications(`id`) WHERE `seen` = 0 AND `mailed` = 0
+    """)
+
+
+def _addStorageId(db):
+    # Tells the storage apart from one created again at the same path
+    db.execute("INSERT OR IGNORE INTO meta (`key`, `value`) "
+               "VALUES ('storage_id', ?)", [uuid.uuid4().hex])
+
+
+# (version, migration), in order. Storages created with the current schema
+# start at the last version.
+MIGRATIONS = [
+    (1, _addInfo),
+    (2, _addCount),
+    (3, _internActors),
+    (4, _addMeta),
+    (5, _addPathIndexes),
+    (6, _addArchive),
+    (7, _addInfoHash),
+    (8, _addMailed),
+    (9, _addStorageId),
+]
+
+VERSION = MIGRATIONS[-1][0]
+
+# Storages known to be at VERSION in this process
+_current = set()
+
+
+def getVersion(db):
+    """Return the schema version of the storage, or None if it is new."""
+    try:
+        row = db.execute("SELECT `version` FROM schema_version").fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    if row is not None:
+        return row[0]
+    tables = db.execute("SELECT COUNT(*) FROM sqlite_master "
+                        "WHERE `name` = 'notifications'").fetchone()[0]
+    if tables:
+        # Created before the schema version was recorded
+        return 0
+    return None
+
+
+def _setVersion(db, version):
+    db.execute(CREATE_SCHEMA_VERSION)
+    db.execute("DELETE FROM schema_version")
+    db.execute("INSERT INTO schema_version (`version`) VALUES (?)",
+               [version])
+
+
+def migrate(db, dryRun=False, create=None):
+    """Apply the pending migrations to the storage in one transaction and
+    return the versions before and after. A new storage gets the current
+    schema from 'create' if given. With dryRun, the transaction is rolled
+    back."""
+    isolationLevel = db.isolation_level
+    # Handle the transaction ourselves so the schema changes are rolled back
+    # too on error.
+    db.isolation_level = None
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        migrated = False
+        try:
+            version = getVersion(db)
+            if version is None:
+                if create is not None:
+                    create(db)
+                before = after = VERSION
+            else:
+                before = after = version
+                for number, migration in MIGRATIONS:
+                    if number > version:
+                        migration(db)
+                        after = number
+            if after != version:
+                _setVersion(db, after)
+            migrated = True
+        finally:
+            if dryRun or not migrated:
+                db.execute("ROLLBACK")
+        if not dryRun:
+            db.execute("COMMIT")
+    finally:
+        db.isolation_level = isolationLevel
+    return before, after
+
+
+def _isEmpty(db):
+    return db.execute("PRAGMA schema_version").fetchone()[0] == 0
+
+
+def ensureCurrent(db, db_path, create=None):
+    """Migrate the storage opened as 'db' if it is not up to date, or create
+    its schema with 'create' if it is new."""
+    # The storage may have been removed and created again since
+    if db_path in _current and not _isEmpty(db):
+        return
+    if getVersion(db) != VERSION:
+        before, after = migrate(db, create=create)
+        logger.info("Migrated %s from version %s to %s"
+                    % (db_path, before, after))
+    _current.add(db_path)
+
+
+def migrateFile(args):
+    """Migrate one storage file, for the process pool. Return (path, before,
+    after, error)."""
+    path, dryRun = args
+    try:
+        db = sqlite3.connect(path, timeout=30)
+        try:
+            before, after = migrate(db, dryRun)
+        finally:
+            db.close()
+    except Exception as e:
+        return path, None, None, '%s: %s' % (e.__class__.__name__, e)
+    return path, before, after, None
+
+
+def _loadCheckpoint(checkpoint):
+    """Return the schema versions by path recorded in the checkpoint."""
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return {}
+    with open(checkpoint) as f:
+        return json.load(f)
+
+
+def _saveCheckpoint(checkpoint, done):
+    if checkpoint is None:
+        return
+    with open(checkpoint + '.tmp', 'w') as f:
+        json.dump(done, f, sort_keys=True)
+    os.rename(checkpoint + '.tmp', checkpoint)
+
+
+def run(directory, processes=None, checkpoint=None, dryRun=False,
+        out=sys.stdout):
+    """Migrate all the storages of the directory and return the failures as
+    a dict of error messages by path."""
+    done = _loadCheckpoint(checkpoint)
+    paths = sorted(os.path.join(directory, file_name)
+                   for file_name in os.listdir(directory)
+                   if file_name.endswith('.sqlite'))
+    pending = [path for path in paths if done.get(path) != VERSION]
+    out.write("%d storages, %d to migrate\n" % (len(paths), len(pending)))
+    failures = {}
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.imap_unordered(
+            migrateFile, [(path, dryRun) for path in pending], chunksize=16
+        )
+        for i, (path, before, after, error) in enumerate(results):
+            if error is not None:
+                failures[path] = error
+                out.write("FAILED %s: %s\n" % (path, error))
+            else:
+                if before != after:
+                    out.write("%s: %s -> %s\n" % (path, before, after))
+                if not dryRun:
+                    done[path] = after
+            if not dryRun and i % 100 == 99:
+                _saveCheckpoint(checkpoint, done)
+    finally:
+        pool.close()
+        pool.join()
+        if not dryRun:
+            _saveCheckpoint(checkpoint, done)
+    out.write("%d migrated, %d failed%s\n" % (
+        len(pending) - len(failures), len(failures),
+        " (dry run, nothing was changed)" if dryRun else ""
+    ))
+    return failures
+
+
+def parse(argv):
+    parser = argparse.ArgumentParser(
+        description="Migrate the whathappened sqlite storages to the current "
+                    "schema version (%d)." % VERSION)
+    parser.add_argument(
+        'directory', nargs='?',
+        default=os.environ.get('collective_whathappened_sqlite_directory'),
+        help="Directory of the storages, collective_whathappened_sqlite"
+             "_directory by default.")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="Number of processes, one per CPU by default.")
+    parser.add_argument('--checkpoint', default=None,
+                        help="File recording the migrated storages, to "
+                             "resume an interrupted migration.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Run the migrations and roll them back.")
+    options = parser.parse_args(argv)
+    if options.directory is None:
+        parser.error("the directory of the storages is required")
+    return options
+
+
+def main(argv=None):
+    options = parse(argv)
+    failures = run(options.directory, options.processes, options.checkpoint,
+                   options.dry_run)
+    if failures:
+        sys.exit(1)
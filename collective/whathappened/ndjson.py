@@ -0,0 +1,237 @@
+"""Export the user storages as NDJSON and import them back.
+
+Every line is a JSON record of a user: their subscriptions first, then the
+values about their storage, e.g. up to when they gathered, then their
+notifications, with whether they were mailed in a digest. Storages are read
+and written one record at a time through the storage API, so any backend
+can be exported to any other one, e.g. to move a site::
+
+    bin/instance whathappened-export Plone --output whathappened.ndjson
+    bin/instance whathappened-import Plone --input whathappened.ndjson
+
+Importing again the same records does not duplicate the notifications nor
+add up their counts.
+"""
+import argparse
+import json
+import sys
+
+from collective.whathappened.notification import Notification
+from collective.whathappened.storage_backend import GATHER_CURSOR
+from collective.whathappened.storage_backend import GATHERED_UNTIL
+from collective.whathappened.storage_backend import LAST_ARCHIVE
+from collective.whathappened.storage_backend import LAST_GATHER
+from collective.whathappened.subscription import Subscription
+
+SUBSCRIPTION = 'subscription'
+META = 'meta'
+NOTIFICATION = 'notification'
+
+# All the meta keys but STORAGE_ID, which tells apart the storage files and
+# is given a new value by the storage imported into.
+META_KEYS = [LAST_GATHER, GATHER_CURSOR, GATHERED_UNTIL, LAST_ARCHIVE]
+
+
+def _dumpNotification(user, notification):
+    return {
+        'type': NOTIFICATION,
+        'user': user,
+        'what': notification.what,
+        'when': notification.getWhenTimestamp(),
+        'where': notification.where,
+        'who': notification.who,
+        'gatherer': notification.gatherer,
+        'seen': bool(notification.seen),
+        'info': notification.info,
+        'count': notification.count,
+        'mailed': bool(notification.mailed),
+    }
+
+
+def _loadNotification(record):
+    return Notification(
+        record['what'],
+        record['where'],
+        record['when'],
+        record['who'],
+        record['user'],
+        record['gatherer'],
+        record['seen'],
+        info=record['info'],
+        count=record['count'],
+        mailed=record.get('mailed', False),
+    )
+
+
+def iterRecords(storage, users):
+    """Iterate over the records of the storages of the users."""
+    for user in users:
+        storage.setUser(user)
+        storage.initialize()
+        try:
+            for subscription in storage.iterSubscriptions():
+                yield {
+                    'type': SUBSCRIPTION,
+                    'user': user,
+                    'where': subscription.where,
+                    'wants': subscription.wants,
+                }
+            for key in META_KEYS:
+                value = storage.getMeta(key)
+                if value is not None:
+                    yield {
+                        'type': META,
+                        'user': user,
+                        'key': key,
+                        'value': value,
+                    }
+            for notification in storage.iterNotifications():
+                yield _dumpNotification(user, notification)
+        finally:
+            storage.terminate()
+
+
+def exportStorages(storage, users, out):
+    """Write the records of the users to 'out', return their number."""
+    count = 0
+    for record in iterRecords(storage, users):
+        out.write(json.dumps(record, sort_keys=True))
+        out.write('\n')
+        count += 1
+    return count
+
+
+class Importer(object):
+    """Store records read from an export. The records of a user must be
+    consecutive, in the order they were exported."""
+
+    def __init__(self, storage, batch=500):
+        self.storage = storage
+        # Records stored per storage transaction
+        self.batch = batch
+        self.user = None
+        self.subscriptions = []
+        self.pending = 0
+
+    def importRecords(self, records):
+        """Store the records, return their number."""
+        count = 0
+        try:
+            for record in records:
+                self.importRecord(record)
+                count += 1
+        finally:
+            self.close()
+        return count
+
+    def importRecord(self, record):
+        if record['user'] != self.user:
+            self.close()
+            self.user = record['user']
+            self.storage.setUser(self.user)
+            self.storage.initialize()
+        if record['type'] == SUBSCRIPTION:
+            self.subscriptions.append(Subscription(record['where'],
+                                                   record['wants']))
+        else:
+            # Blacklists purge notifications, save them before.
+            self._saveSubscriptions()
+            if record['type'] == META:
+                self.storage.setMeta(record['key'], record['value'])
+            elif record['type'] == NOTIFICATION:
+                self.storage.storeNotification(_loadNotification(record),
+                                               replace=True)
+            else:
+                raise ValueError("Unknown record type %r" % record['type'])
+        self.pending += 1
+        if self.pending >= self.batch:
+            self._saveSubscriptions()
+            # Commit the storage transaction
+            self.storage.terminate()
+            self.storage.initialize()
+            self.pending = 0
+
+    def _saveSubscriptions(self):
+        if self.subscriptions:
+            self.storage.saveSubscriptions(self.subscriptions)
+            self.subscriptions = []
+
+    def close(self):
+        if self.user is None:
+            return
+        self._saveSubscriptions()
+        self.storage.terminate()
+        self.user = None
+        self.pending = 0
+
+
+def importStorages(storage, lines, batch=500):
+    """Store the records of the NDJSON lines, return their number."""
+    records = (json.loads(line) for line in lines if line.strip())
+    return Importer(storage, batch).importRecords(records)
+
+
+def _setUp(app, site):
+    from AccessControl.SecurityManagement import newSecurityManager
+    from AccessControl.SpecialUsers import system
+    from Testing.makerequest import makerequest
+    from zope.component.hooks import setSite
+    from collective.whathappened.storage_manager import StorageManager
+
+    app = makerequest(app)
+    site = app.unrestrictedTraverse(site)
+    setSite(site)
+    newSecurityManager(None, system)
+    return StorageManager(site, app.REQUEST)
+
+
+def parseExport(argv):
+    parser = argparse.ArgumentParser(
+        prog='whathappened-export',
+        description="Export the whathappened storages as NDJSON.")
+    parser.add_argument('site', help="Path of the Plone site in Zope.")
+    parser.add_argument('--output', default='-',
+                        help="File to write, the standard output by "
+                             "default.")
+    parser.add_argument('--users', nargs='+', default=None,
+                        help="Users to export, all of them by default.")
+    return parser.parse_args(argv)
+
+
+def exportMain(app, args):
+    """zopectl command, see the module docstring."""
+    options = parseExport(args)
+    storage = _setUp(app, options.site)
+    users = options.users
+    if users is None:
+        users = storage.listUsers()
+    if options.output == '-':
+        count = exportStorages(storage, users, sys.stdout)
+    else:
+        with open(options.output, 'w') as out:
+            count = exportStorages(storage, users, out)
+    sys.stderr.write("%d records exported\n" % count)
+
+
+def parseImport(argv):
+    parser = argparse.ArgumentParser(
+        prog='whathappened-import',
+        description="Import whathappened storages exported as NDJSON.")
+    parser.add_argument('site', help="Path of the Plone site in Zope.")
+    parser.add_argument('--input', default='-',
+                        help="File to read, the standard input by default.")
+    parser.add_argument('--batch', type=int, default=500,
+                        help="Records stored per storage transaction.")
+    return parser.parse_args(argv)
+
+
+def importMain(app, args):
+    """zopectl command, see the module docstring."""
+    options = parseImport(args)
+    storage = _setUp(app, options.site)
+    if options.input == '-':
+        count = importStorages(storage, sys.stdin, options.batch)
+    else:
+        with open(options.input) as lines:
+            count = importStorages(storage, lines, options.batch)
+    sys.stderr.write("%d records imported\n" % count)
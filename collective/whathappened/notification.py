@@ -1,8 +1,11 @@
+import datetime
 import time
 
 from zope import interface
 from zope import schema
 
+from collective.whathappened.codec import decode
+
 
 class INotification(interface.Interface):
     """A notification is a set of useractions sharing the same what/where,
@@ -23,6 +26,9 @@ class INotification(interface.Interface):
                        key_type=schema.ASCIILine(),
                        value_type=schema.ASCIILine())
     gatherer = schema.ASCIILine(title=u"Gatherer")
+    count = schema.Int(title=u"Count",
+                       description=u"Number of contents merged into the "
+                                   u"notification")
 
     def getId():
         """Get the unique id of the notification"""
@@ -31,26 +37,109 @@ class INotification(interface.Interface):
         """Return a human friendly string explaining the notification."""
 
 
+ID_DATE_FORMAT = "%Y-%m-%d-%H-%M-%S"
+
+
+def parseId(id):
+    """Return the what (lower case), epoch timestamp and where of a
+    notification id."""
+    date, rest = id[:19], id[20:]
+    what, _, where = rest.partition('-/')
+    when = int(time.mktime(time.strptime(date, ID_DATE_FORMAT)))
+    return what, when, '/' + where
+
+
+_interned = {}
+
+
+def _intern(value):
+    """Share one instance of the few distinct what/gatherer strings.
+
+    The builtin intern() only accepts byte strings while sqlite returns
+    unicode, so a plain dictionary is used instead."""
+    if value is None:
+        return value
+    return _interned.setdefault(value, value)
+
+
 class Notification(object):
     interface.implements(INotification)
 
+    __slots__ = ('what', 'where', 'who', 'user', 'gatherer', 'seen', 'count',
+                 'mailed', '_when', '_timestamp', '_id', '_info', '_rawInfo')
+
     def __init__(self, what, where, when, who, user, gatherer,
-                 seen=False, info=None):
-        self.what = what
+                 seen=False, info=None, rawInfo=None, count=1, mailed=False):
+        """when is either a datetime or an epoch timestamp; the other
+        representation is only computed when it is asked for."""
+        self.what = _intern(what)
         self.where = where
-        self.when = when
         self.who = who
-        title = "%s" % self.when.strftime("%Y-%m-%d-%H-%M-%S")
-        title += "-%s" % self.what.lower()
-        title += "-%s" % self.where
-        self.id = title
         self.seen = seen
+        # Whether it was mailed in a digest, see storage_backend.setMailed
+        self.mailed = mailed
         self.user = user
-        self.info = info
-        self.gatherer = gatherer
+        self.gatherer = _intern(gatherer)
+        self.count = count
+        self._setWhen(when)
+        self._id = None
+        self._info = info
+        # Info as stored by a backend, see codec, decoded on first access
+        self._rawInfo = rawInfo
+
+    def _getWhen(self):
+        if self._when is None:
+            self._when = datetime.datetime.fromtimestamp(self._timestamp)
+        return self._when
+
+    def _setWhen(self, when):
+        if isinstance(when, datetime.datetime):
+            self._when = when
+            self._timestamp = None
+        else:
+            self._when = None
+            self._timestamp = int(when)
+
+    when = property(_getWhen, _setWhen)
+
+    def _getId(self):
+        if self._id is None:
+            self._id = "%s-%s-%s" % (
+                self.when.strftime(ID_DATE_FORMAT),
+                self.what.lower(),
+                self.where,
+            )
+        return self._id
+
+    def _setId(self, id):
+        self._id = id
+
+    id = property(_getId, _setId)
+
+    def _getInfo(self):
+        if self._rawInfo is not None:
+            self._info = decode(self._rawInfo)
+            self._rawInfo = None
+        return self._info
+
+    def _setInfo(self, info):
+        self._info = info
+        self._rawInfo = None
+
+    info = property(_getInfo, _setInfo)
+
+    def __getstate__(self):
+        # Slotted objects have no __dict__ for the pickle protocols 0 and 1
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def getId(self):
         return self.id
 
     def getWhenTimestamp(self):
-        return time.mktime(self.when.timetuple())
+        if self._timestamp is None:
+            self._timestamp = int(time.mktime(self._when.timetuple()))
+        return self._timestamp
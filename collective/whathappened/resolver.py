@@ -0,0 +1,46 @@
+import logging
+import threading
+
+logger = logging.getLogger('collective.whathappened')
+
+# Validation of the backends by name, True when valid
+_validated = {}
+_lock = threading.Lock()
+
+
+def resolveBackend(context, request, name, validate=None, fallback=None):
+    """Return the backend registered as the view 'name'.
+
+    The view is traversed on every call, so that it is acquisition wrapped
+    and its permission checked. It is only validated with 'validate', if
+    given, the first time it is asked for, the outcome being cached for the
+    whole process until a whathappened record of the registry changes.
+    If the validation fails, an instance of 'fallback' is returned
+    instead."""
+    if request is None:
+        request = getattr(context, 'REQUEST', None)
+    valid = _validated.get(name)
+    if valid is False:
+        return fallback(context, request)
+    backend = context.restrictedTraverse(name)
+    if backend is None or valid:
+        return backend
+    valid = validate is None or bool(validate(backend))
+    with _lock:
+        _validated[name] = valid
+    if not valid:
+        logger.warning('Backend %s is not valid, using %s instead.'
+                       % (name, fallback.__name__))
+        return fallback(context, request)
+    return backend
+
+
+def invalidate():
+    with _lock:
+        _validated.clear()
+
+
+def registryChanged(event):
+    """Resolve and validate the backends again once the registry changed."""
+    if event.record.__name__.startswith('collective.whathappened.'):
+        invalidate()
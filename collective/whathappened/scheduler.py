@@ -0,0 +1,136 @@
+"""Choose when to gather the notifications of each user.
+
+Gathering on every page view makes users who reload often gather
+constantly. The scheduler keeps a few activity signals per user instead:
+when they last viewed a page and gathered, how often their recent
+gatherings found notifications and how many subscriptions they have. Users
+whose gatherings keep finding notifications, or who follow many contents,
+gather every 'minInterval' seconds, the others back off up to
+'maxInterval'. A user coming back after a while gathers eagerly again,
+and users who view no page never gather.
+
+The gatherings of all the users are also capped to 'limit' per minute, the
+users over the cap show their stored notifications and gather on a later
+page. There is a scheduler per site and process.
+"""
+import threading
+import time
+
+from collections import OrderedDict
+
+from Products.CMFCore.utils import getToolByName
+
+# Weight of the last gathering in the hit rate
+HIT_WEIGHT = 0.3
+# Subscriptions making the interval twice shorter
+SUBSCRIPTIONS_SCALE = 20.0
+# Seconds the gatherings are counted over for the cap
+CAP_PERIOD = 60
+
+
+class UserActivity(object):
+
+    __slots__ = ('lastSeen', 'lastGather', 'hitRate', 'subscriptions')
+
+    def __init__(self):
+        self.lastSeen = None
+        self.lastGather = None
+        # Gather eagerly until the gatherings tell otherwise
+        self.hitRate = 1.0
+        self.subscriptions = 0
+
+
+class GatherScheduler(object):
+    """The activity of the last 'size' users seen, and the gatherings of the
+    current minute."""
+
+    def __init__(self, minInterval=10, maxInterval=600, limit=0, size=10000,
+                 clock=time.time):
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        # Gatherings per minute, 0 means no limit
+        self.limit = limit
+        self.size = size
+        self.clock = clock
+        self.users = OrderedDict()
+        self.periodStart = None
+        self.periodCount = 0
+        self.lock = threading.Lock()
+
+    def _getActivity(self, user):
+        activity = self.users.pop(user, None)
+        if activity is None:
+            activity = UserActivity()
+            if len(self.users) >= self.size:
+                self.users.popitem(last=False)
+        # Most recently used last
+        self.users[user] = activity
+        return activity
+
+    def interval(self, activity):
+        """Return the seconds between two gatherings of a user."""
+        span = (self.maxInterval - self.minInterval) * (1 - activity.hitRate)
+        span /= 1 + activity.subscriptions / SUBSCRIPTIONS_SCALE
+        return self.minInterval + span
+
+    def due(self, user):
+        """Record a page view of the user, return True if they should gather
+        now."""
+        now = self.clock()
+        with self.lock:
+            activity = self._getActivity(user)
+            if activity.lastSeen is not None and \
+                    now - activity.lastSeen >= self.maxInterval:
+                # Back after a while, they likely have notifications again
+                activity.hitRate = 1.0
+            activity.lastSeen = now
+            if activity.lastGather is not None and \
+                    now - activity.lastGather < self.interval(activity):
+                return False
+            if not self._take(now):
+                return False
+            activity.lastGather = now
+            return True
+
+    def _take(self, now):
+        """Count a gathering, return False if the cap is reached."""
+        if not self.limit:
+            return True
+        if self.periodStart is None or now - self.periodStart >= CAP_PERIOD:
+            self.periodStart = now
+            self.periodCount = 0
+        if self.periodCount >= self.limit:
+            return False
+        self.periodCount += 1
+        return True
+
+    def record(self, user, hit, subscriptions):
+        """Record a gathering of the user, 'hit' tells if it found
+        notifications."""
+        with self.lock:
+            activity = self._getActivity(user)
+            activity.lastGather = self.clock()
+            activity.hitRate *= 1 - HIT_WEIGHT
+            if hit:
+                activity.hitRate += HIT_WEIGHT
+            activity.subscriptions = subscriptions
+
+    def configure(self, minInterval, maxInterval, limit):
+        self.minInterval = minInterval
+        self.maxInterval = max(minInterval, maxInterval)
+        self.limit = limit
+
+
+# Schedulers by site path
+_schedulers = {}
+_lock = threading.Lock()
+
+
+def getScheduler(context):
+    """Return the scheduler of the site of context."""
+    path = getToolByName(context, 'portal_url').getPortalPath()
+    scheduler = _schedulers.get(path)
+    if scheduler is None:
+        with _lock:
+            scheduler = _schedulers.setdefault(path, GatherScheduler())
+    return scheduler
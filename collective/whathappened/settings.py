@@ -12,3 +12,92 @@ class ISettings(interface.Interface):
                       u" One what per line."),
         value_type=schema.TextLine(),
     )
+
+    coalesce_keys = schema.List(
+        title=_(u"Merge notifications"),
+        description=_(u"New notifications about the same action are merged "
+                      u"into one when they share all these criteria."),
+        value_type=schema.Choice(
+            vocabulary="collective.whathappened.vocabularies.coalesce_keys"
+        ),
+        required=False,
+    )
+
+    coalesce_window = schema.Int(
+        title=_(u"Merge window"),
+        description=_(u"Only notifications happening within this number of "
+                      u"minutes are merged. 0 disables merging."),
+        min=0,
+        default=60,
+    )
+
+    gather_max_useractions = schema.Int(
+        title=_(u"Useractions gathered per request"),
+        description=_(u"Gathering stops after this number of useractions "
+                      u"and resumes from there on the next request. "
+                      u"0 means no limit."),
+        min=0,
+        default=1000,
+    )
+
+    gather_max_time = schema.Int(
+        title=_(u"Gathering time per request"),
+        description=_(u"Gathering stops after this number of milliseconds "
+                      u"and resumes from there on the next request. "
+                      u"0 means no limit."),
+        min=0,
+        default=500,
+    )
+
+    gather_min_interval = schema.Int(
+        title=_(u"Minimum gathering interval"),
+        description=_(u"Seconds between two gatherings of the users whose "
+                      u"gatherings keep finding notifications."),
+        min=0,
+        default=10,
+    )
+
+    gather_max_interval = schema.Int(
+        title=_(u"Maximum gathering interval"),
+        description=_(u"Seconds between two gatherings of the users whose "
+                      u"gatherings find nothing. Users coming back after "
+                      u"this time gather on their first page."),
+        min=0,
+        default=600,
+    )
+
+    gather_max_per_minute = schema.Int(
+        title=_(u"Gatherings per minute"),
+        description=_(u"Gatherings of all the users per minute and process, "
+                      u"the next users show their stored notifications. "
+                      u"0 means no limit."),
+        min=0,
+        default=0,
+    )
+
+    deferred_gathering = schema.Bool(
+        title=_(u"Gather after the response"),
+        description=_(u"The personal bar only shows the stored "
+                      u"notifications and the new ones are gathered once "
+                      u"the page is sent. They show up on the next page."),
+        default=False,
+    )
+
+    archive_after_days = schema.Int(
+        title=_(u"Archive after"),
+        description=_(u"Seen notifications older than this number of days "
+                      u"are archived. They are only listed on demand, which "
+                      u"keeps the listings fast. 0 disables archiving."),
+        min=0,
+        default=30,
+    )
+
+    instrumentation_sample_rate = schema.Float(
+        title=_(u"Instrumentation sample rate"),
+        description=_(u"Share of the requests, between 0 and 1, whose "
+                      u"gathering, storage and rendering times are measured "
+                      u"and sent to the metrics sinks."),
+        min=0.0,
+        max=1.0,
+        default=0.0,
+    )
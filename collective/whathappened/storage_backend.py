@@ -1,27 +1,328 @@
+import collections
 import datetime
 import json
 import logging
 import time
 import os
 import sqlite3
+import uuid
+import zlib
 
 from zope import event
 from zope import interface
 from Products.CMFCore.utils import getToolByName
 
+from .codec import decode
+from .codec import encode
+from .instrumentation import count
+from .migrations import ensureCurrent
 from .notification import Notification
+from .notification import parseId
 from .subscription import Subscription
+from .subscription import parentPaths
 from .event import SubscribedEvent
 from .event import BlacklistedEvent
+from .event import SubscriptionsChangedEvent
 
 logger = logging.getLogger('collective.whathappened')
 
 
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+CREATE_NOTIFICATIONS = """
+    CREATE TABLE IF NOT EXISTS notifications(
+    `id`        INTEGER PRIMARY KEY,
+    `what`      TEXT,
+    `when`      INTEGER,
+    `where`     TEXT,
+    `seen`      INTEGER,
+    `gatherer`  TEXT,
+    `info`      TEXT,
+    `count`     INTEGER DEFAULT 1,
+    `info_hash` INTEGER,
+    `mailed`    INTEGER DEFAULT 0,
+    UNIQUE(`what`, `when`, `where`))
+"""
+
+# Users acting on contents, each one stored once per database.
+CREATE_ACTORS = """
+    CREATE TABLE IF NOT EXISTS actors(
+    `id`        INTEGER PRIMARY KEY,
+    `name`      TEXT UNIQUE)
+"""
+
+CREATE_NOTIFICATIONS_WHO = """
+    CREATE TABLE IF NOT EXISTS notifications_who(
+    `notification`  INTEGER REFERENCES notifications(`id`)
+                      ON DELETE CASCADE,
+    `actor`         INTEGER REFERENCES actors(`id`),
+    PRIMARY KEY(`notification`, `actor`))
+    WITHOUT ROWID
+"""
+
+# Subtrees of notifications are looked up by path range, to be purged.
+CREATE_WHERE_INDEX = """
+    CREATE INDEX IF NOT EXISTS notifications_where
+    ON notifications(`where`)
+"""
+
+# Unseen notifications are counted and set as seen on every page view. Seen
+# ones are left out of this index so it stays small.
+CREATE_UNSEEN_INDEX = """
+    CREATE INDEX IF NOT EXISTS notifications_unseen_where
+    ON notifications(`where`) WHERE `seen` = 0
+"""
+
+# Unseen notifications to mail in the digests, see getUnmailedNotifications
+CREATE_UNMAILED_INDEX = """
+    CREATE INDEX IF NOT EXISTS notifications_unmailed
+    ON notifications(`id`) WHERE `seen` = 0 AND `mailed` = 0
+"""
+
+CREATE_SUBSCRIPTIONS = """
+    CREATE TABLE IF NOT EXISTS subscriptions(
+    `where`     TEXT PRIMARY KEY,
+    `wants`     INTEGER)
+"""
+
+# Subscriptions of groups and roles, stored once for all their members in a
+# database shared by the users of the directory.
+PRINCIPALS_DB = 'principals.db'
+CREATE_SHARED_SUBSCRIPTIONS = """
+    CREATE TABLE IF NOT EXISTS shared_subscriptions(
+    `principal` TEXT,
+    `where`     TEXT,
+    `wants`     INTEGER,
+    PRIMARY KEY(`principal`, `where`))
+"""
+
+# Seen notifications older than the archive_after_days setting are moved out
+# of the notifications table, which stays small. Only what is needed to list
+# and purge them is kept in columns, the rest is compressed JSON.
+CREATE_ARCHIVE = """
+    CREATE TABLE IF NOT EXISTS archive(
+    `id`        INTEGER PRIMARY KEY,
+    `what`      TEXT,
+    `when`      INTEGER,
+    `where`     TEXT,
+    `payload`   BLOB,
+    UNIQUE(`where`, `when`, `what`))
+"""
+
+CREATE_ARCHIVE_WHEN_INDEX = """
+    CREATE INDEX IF NOT EXISTS archive_when
+    ON archive(`when`)
+"""
+
+# Values about the user storage, e.g. when notifications were last gathered.
+LAST_GATHER = 'last_gather'
+STORAGE_ID = 'storage_id'
+# Time the next gathering resumes from when the last one stopped early
+GATHER_CURSOR = 'gather_cursor'
+# Time up to which the last gathering saw all the useractions
+GATHERED_UNTIL = 'gathered_until'
+LAST_ARCHIVE = 'last_archive'
+CREATE_META = """
+    CREATE TABLE IF NOT EXISTS meta(
+    `key`       TEXT PRIMARY KEY,
+    `value`)
+"""
+
+# Every notification listing goes through this statement. Keeping the SQL
+# text constant lets sqlite3 reuse the prepared statement from the
+# connection statement cache instead of compiling it on each call.
+SELECT_NOTIFICATIONS = """
+    SELECT
+        n.`what`,
+        n.`when`,
+        n.`where`,
+        GROUP_CONCAT(nw.`actor`),
+        n.`gatherer`,
+        n.`seen`,
+        n.`info`,
+        n.`count`
+    FROM notifications n
+    LEFT JOIN notifications_who nw
+        ON nw.`notification` = n.`id`
+    WHERE n.`seen` <= :max_seen
+    GROUP BY n.`id`
+    ORDER BY CASE WHEN :seen_first THEN n.`seen` ELSE 0 END ASC,
+             n.`when` DESC
+    LIMIT :limit
+"""
+
+# The same, about a path and the paths below it, see _subtree. Without
+# statistics, sqlite would rather scan the table in id order for the GROUP BY
+# than use the index.
+SELECT_TREE_NOTIFICATIONS = """
+    SELECT
+        n.`what`,
+        n.`when`,
+        n.`where`,
+        GROUP_CONCAT(nw.`actor`),
+        n.`gatherer`,
+        n.`seen`,
+        n.`info`,
+        n.`count`
+    FROM notifications n INDEXED BY notifications_where
+    LEFT JOIN notifications_who nw
+        ON nw.`notification` = n.`id`
+    WHERE n.`seen` <= :max_seen
+        AND n.`where` >= :path AND n.`where` < :path_end
+        AND (n.`where` = :path OR n.`where` >= :path_children)
+    GROUP BY n.`id`
+    ORDER BY CASE WHEN :seen_first THEN n.`seen` ELSE 0 END ASC,
+             n.`when` DESC
+    LIMIT :limit
+"""
+
+# Unseen notifications not mailed yet, in the order they were stored.
+# Merging a notification sets it as not mailed again.
+SELECT_UNMAILED = """
+    SELECT
+        n.`what`,
+        n.`when`,
+        n.`where`,
+        GROUP_CONCAT(nw.`actor`),
+        n.`gatherer`,
+        n.`seen`,
+        n.`info`,
+        n.`count`
+    FROM notifications n INDEXED BY notifications_unmailed
+    LEFT JOIN notifications_who nw
+        ON nw.`notification` = n.`id`
+    WHERE n.`seen` = 0 AND n.`mailed` = 0 AND n.`when` >= :since
+    GROUP BY n.`id`
+    ORDER BY n.`id`
+    LIMIT :limit
+"""
+
+# All the notifications, by batches in the order they were stored, for
+# iterNotifications.
+SELECT_BATCH = """
+    SELECT
+        n.`what`,
+        n.`when`,
+        n.`where`,
+        GROUP_CONCAT(nw.`actor`),
+        n.`gatherer`,
+        n.`seen`,
+        n.`info`,
+        n.`count`,
+        n.`mailed`,
+        n.`id`
+    FROM notifications n
+    LEFT JOIN notifications_who nw
+        ON nw.`notification` = n.`id`
+    WHERE n.`id` > :after
+    GROUP BY n.`id`
+    ORDER BY n.`id`
+    LIMIT :limit
+"""
+
+# Seen notifications to archive, by batches.
+SELECT_ARCHIVABLE = """
+    SELECT
+        n.`what`,
+        n.`when`,
+        n.`where`,
+        GROUP_CONCAT(nw.`actor`),
+        n.`gatherer`,
+        n.`seen`,
+        n.`info`,
+        n.`count`,
+        n.`id`
+    FROM notifications n
+    LEFT JOIN notifications_who nw
+        ON nw.`notification` = n.`id`
+    WHERE n.`seen` = 1 AND n.`when` < :before
+    GROUP BY n.`id`
+    ORDER BY n.`id`
+    LIMIT :limit
+"""
+
+# Actor names by id and ids by name, per database. Databases are told apart
+# by the random STORAGE_ID stored in them rather than by file, since a
+# recreated file may get the path and the inode of the removed one.
+_actors = collections.OrderedDict()
+_ACTORS_CACHE_SIZE = 100
+# Stay below the default SQLITE_MAX_VARIABLE_NUMBER
+_MAX_VARIABLES = 500
+
+
+class _Cursor(sqlite3.Cursor):
+    """Cursor counting the queries of the sampled requests."""
+
+    def execute(self, *args):
+        count('queries')
+        return sqlite3.Cursor.execute(self, *args)
+
+    def executemany(self, *args):
+        count('queries')
+        return sqlite3.Cursor.executemany(self, *args)
+
+
+class _Connection(sqlite3.Connection):
+
+    def cursor(self, factory=_Cursor):
+        # Connection.execute goes through this method too
+        return sqlite3.Connection.cursor(self, factory)
+
+
+# Statistics by database file, with the mtime and size they were computed for
+_stats = {}
+
+
+def _bounds(path):
+    """Return the bounds of the paths below 'path': they are between
+    path + '/' included and path + '0' excluded, '0' being the character
+    following '/'."""
+    return path + '/', path + '0'
+
+
+def _subtree(path):
+    """Return a clause matching 'path' and the paths below it, and its
+    parameters. The range on `where` lets sqlite use an index."""
+    clause = ("(`where` >= ? AND `where` < ? "
+              "AND (`where` = ? OR `where` >= ?))")
+    children, end = _bounds(path)
+    return clause, [path, end, path, children]
+
+
+def _pack(who, gatherer, info, count):
+    """Return the archive payload of a notification."""
+    payload = json.dumps({
+        'who': who,
+        'gatherer': gatherer,
+        'info': info,
+        'count': count,
+    })
+    return sqlite3.Binary(zlib.compress(payload))
+
+
+def _unpack(payload):
+    return json.loads(zlib.decompress(str(payload)))
+
+
+def _createSchema(db):
+    """Create the tables of a new storage, see migrations.ensureCurrent."""
+    for statement in (CREATE_NOTIFICATIONS, CREATE_ACTORS,
+                      CREATE_NOTIFICATIONS_WHO, CREATE_WHERE_INDEX,
+                      CREATE_UNSEEN_INDEX, CREATE_UNMAILED_INDEX,
+                      CREATE_SUBSCRIPTIONS, CREATE_META, CREATE_ARCHIVE,
+                      CREATE_ARCHIVE_WHEN_INDEX):
+        db.execute(statement)
+    db.execute("INSERT INTO meta (`key`, `value`) VALUES (?, ?)",
+               [STORAGE_ID, uuid.uuid4().hex])
+
+
+def _getActorsCache(db_path, storageId):
+    key = (db_path, storageId)
+    cache = _actors.pop(key, None)
+    if cache is None:
+        cache = ({}, {})
+        if len(_actors) >= _ACTORS_CACHE_SIZE:
+            _actors.popitem(last=False)
+    _actors[key] = cache
+    return cache
 
 
 class IStorageBackend(interface.Interface):
@@ -44,28 +345,60 @@ class IStorageBackend(interface.Interface):
     def getUser():
         """get the user the storage is working on."""
 
-    def storeNotification(notification):
-        """Store a notification."""
+    def storeNotification(notification, replace=False):
+        """Store a notification. It is merged into the unseen notification
+        about the same thing if any, or replaces its time and count if
+        'replace' is true, e.g. when importing it again."""
 
     def removeNotification(notification):
         """Remove a notification"""
 
+    def removeNotifications(path):
+        """Remove the notifications about path and the paths below it."""
+
     def getHotNotifications():
         """Get all "hot" notifications. Hot notifications are notifications the
         user may be the more interested in."""
 
-    def getAllNotifications():
-        """Get all notifications."""
+    def getAllNotifications(path=None):
+        """Get all notifications, or only the ones about path and the paths
+        below it."""
 
     def getUnseenNotifications():
         """Get all unseen notifications."""
 
-    def setSeen(path):
-        """Set seen to true for the given path,
-        or all notifications if no path is given."""
+    def iterNotifications(batch=500):
+        """Iterate over all the notifications, seen and archived ones
+        included, reading at most 'batch' of them at once."""
+
+    def archiveNotifications(before):
+        """Archive the seen notifications which happened before the
+        'before' timestamp, return their number. Archived notifications are
+        only listed by getArchivedNotifications."""
+
+    def getArchivedNotifications(limit=50, path=None):
+        """Get up to 'limit' archived notifications, the newest first, only
+        the ones about path and the paths below it if path is given."""
+
+    def hasArchivedNotifications(path=None):
+        """Tell if there are archived notifications, only about path and the
+        paths below it if path is given, without reading them."""
+
+    def iterSubscriptions():
+        """Iterate over all the subscriptions of the user."""
 
-    def getUnseenCount():
-        """Get number of unseen notification."""
+    def setSeen(path=None, subtree=False, ids=None):
+        """Set seen to true for the given path, and the paths below it if
+        subtree is True, or for the notifications with the given ids
+        (see INotification.getId). Set all notifications as seen if neither
+        path nor ids are given.
+
+        This is called on every content view, and should be cheap when there
+        is nothing to set as seen."""
+
+    def getUnseenCount(path=None):
+        """Get number of unseen notification, only the ones about path and
+        the paths below it if path is given."""
 
     def getLastNotificationTime():
         """Get the date and time of the last notification.
@@ -79,12 +412,59 @@ class IStorageBackend(interface.Interface):
     def saveSubscription(subscription):
         """Store a subscription or update it."""
 
+    def saveSubscriptions(subscriptions):
+        """Store, update or remove (when wants is None) many subscriptions at
+        once. The subscriptions which do not change anything are skipped,
+        the others are returned and notified with one
+        SubscriptionsChangedEvent instead of an event per subscription."""
+
     def getSubscription(where):
         """Get the subscription corresponding to 'where'."""
 
     def getSubscriptions():
         """Get all subscriptions of the user."""
 
+    def getUnmailedNotifications(since=0, limit=100):
+        """Get up to 'limit' unseen notifications which happened after the
+        'since' timestamp and were not mailed yet, in the order they were
+        stored. Set them as mailed with setMailed once they are mailed, the
+        notifications merged with new ones afterwards are not mailed
+        anymore."""
+
+    def setMailed(ids):
+        """Set the unseen notifications with the given ids (see
+        INotification.getId) as mailed."""
+
+    def getSubscriptionsInTree(path):
+        """Get the subscriptions of 'path' and of the paths containing it,
+        as a dict by path."""
+
+    def saveSharedSubscriptions(principal, subscriptions):
+        """Store, update or remove (when wants is None) subscriptions shared
+        by all the members of a group or role, see subscription.GROUP and
+        subscription.ROLE. The storage does not need to be initialized.
+        Return the subscriptions which changed."""
+
+    def getSharedSubscriptions(principals):
+        """Get the (principal, subscription) shared with the given groups
+        and roles."""
+
+    def getMeta(key, default=None):
+        """Get a value stored for the user under 'key' by setMeta."""
+
+    def setMeta(key, value):
+        """Store a value (integer or string) for the user under 'key'."""
+
+    def listUsers():
+        """Get the ids of all the users having a storage."""
+
+    def getStats(refresh=True):
+        """Get a dict of statistics about the storage of the user, or None if
+        the user has no storage. The storage does not need to be initialized.
+
+        If refresh is False, statistics which are not up to date yet may be
+        returned, and None if no statistics were computed before."""
+
 
 class SqliteStorageBackend(object):
     interface.implements(IStorageBackend)
@@ -98,50 +478,35 @@ class SqliteStorageBackend(object):
             'collective_whathappened_sqlite_directory', None)
         self.db_path = None
         self.db = None
+        self.actorNames = None
+        self.actorIds = None
+        # Actors added by the current session, shared once it is committed
+        self.newActorNames = {}
+        self.newActorIds = {}
 
     def initialize(self):
         if self.db is not None or self.user is None:
             return
         self.db_path = os.path.join(self.directory, '%s.sqlite' % self.user)
-        self.db = sqlite3.connect(self.db_path)
-        self.db.row_factory = dict_factory
-        self.db.execute(
-            '''
-            CREATE TABLE IF NOT EXISTS notifications(
-            `what`      TEXT,
-            `when`      INTEGER,
-            `where`     TEXT,
-            `seen`      INTEGER,
-            `gatherer`  TEXT,
-            `info`      TEXT,
-            PRIMARY KEY(`what`, `when`, `where`))
-            '''
-        )
-        self.db.execute(
-            '''
-            CREATE TABLE IF NOT EXISTS notifications_who(
-            `what`      TEXT,
-            `when`      INTEGER,
-            `where`     TEXT,
-            `who`       INTEGER,
-            PRIMARY KEY(`what`, `when`, `where`, `who`),
-            FOREIGN KEY(`what`, `when`, `where`)
-              REFERENCES notifications(`what`, `when`, `where`)
-              ON DELETE CASCADE)
-            '''
-        )
-        self.db.execute(
-            '''
-            CREATE TABLE IF NOT EXISTS subscriptions(
-            `where`     TEXT PRIMARY KEY,
-            `wants`     INTEGER)
-            '''
-        )
+        self.db = sqlite3.connect(self.db_path, factory=_Connection)
+        ensureCurrent(self.db, self.db_path, _createSchema)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA foreign_keys = ON')
+        storageId = self.getMeta(STORAGE_ID)
+        self.actorNames, self.actorIds = _getActorsCache(self.db_path,
+                                                         storageId)
+        self.newActorNames = {}
+        self.newActorIds = {}
 
     def terminate(self):
         if self.db is None:
             return
         self.db.commit()
+        # The ids of a rolled back session may be given to other actors
+        self.actorNames.update(self.newActorNames)
+        self.actorIds.update(self.newActorIds)
+        self.newActorNames = {}
+        self.newActorIds = {}
         self.db.close()
         self.db = None
 
@@ -155,77 +520,114 @@ class SqliteStorageBackend(object):
             logger.error(e)
             return False
 
-    def _notificationExist(self, notification):
-        count = self.db.execute("""
-            SELECT COUNT(*)
+    def _findNotification(self, notification, infoHash):
+        """Return the `id`, `when` and `count` of the unseen notification the
+        given one should be merged into, or None."""
+        return self.db.execute("""
+            SELECT `id`, `when`, `count`
             FROM notifications
-            WHERE `what` = ? AND `where` = ? AND `info` = ? AND seen = 0
+            WHERE `what` = ? AND `where` = ? AND `info_hash` = ? AND seen = 0
+            ORDER BY `when` DESC
+            LIMIT 1
         """, [notification.what,
               notification.where,
-              json.dumps(notification.info)]).fetchone()['COUNT(*)']
-        if count > 0:
-            return True
-        return False
-
-    def _updateNotification(self, notification):
-        self.db.execute("""
-            SELECT `when`
-            FROM notifications
-            WHERE `what` = ? AND `where` = ? and seen = 0
-        """, [notification.what, notification.where]).fetchone()['when']
-        for who in notification.who:
-            try:
-                self.db.execute(
-                    """
-                    INSERT INTO notifications_who (`what`, `when`,
-                                                   `where`, `who`)
-                    VALUES (?, ?, ?, ?)
-                    """,
-                    [
-                        notification.what,
-                        notification.getWhenTimestamp(),
-                        notification.where,
-                        who,
-                    ]
-                )
-            except sqlite3.IntegrityError:
-                pass
+              infoHash]).fetchone()
+
+    def _getActorId(self, name):
+        actorId = self.actorIds.get(name, self.newActorIds.get(name))
+        if actorId is not None:
+            return actorId
+        self.db.execute("INSERT OR IGNORE INTO actors (`name`) VALUES (?)",
+                        [name])
+        actorId = self.db.execute("SELECT `id` FROM actors WHERE `name` = ?",
+                                  [name]).fetchone()[0]
+        self.newActorNames[actorId] = name
+        self.newActorIds[name] = actorId
+        return actorId
+
+    def _getActorNames(self, actorIds):
+        missing = [i for i in actorIds if i not in self.actorNames and
+                   i not in self.newActorNames]
+        while missing:
+            chunk = missing[:_MAX_VARIABLES]
+            missing = missing[_MAX_VARIABLES:]
+            results = self.db.execute(
+                "SELECT `id`, `name` FROM actors WHERE `id` IN (%s)"
+                % ', '.join('?' * len(chunk)),
+                chunk
+            )
+            # Committed ones, the session's own are in newActorNames
+            for actorId, name in results:
+                self.actorNames[actorId] = name
+                self.actorIds[name] = actorId
+        return [self.actorNames.get(i, self.newActorNames.get(i))
+                for i in actorIds]
+
+    def _addWho(self, notificationId, who):
+        self.db.executemany(
+            """
+                INSERT OR IGNORE INTO notifications_who (`notification`,
+                                                         `actor`)
+                VALUES (?, ?)
+            """,
+            [(notificationId, self._getActorId(name)) for name in who]
+        )
 
-    def _createNotification(self, notification):
+    def _updateNotification(self, notification, existing, replace=False):
+        notificationId, when, count = existing
+        # Mailed again with the new who and count
+        mailed = False
+        if replace:
+            when = notification.getWhenTimestamp()
+            count = notification.count
+            mailed = notification.mailed
+        elif notification.count > 1:
+            # Merged notifications stand for other contents of the same tree
+            count += notification.count
+        else:
+            count = max(count, notification.count)
         self.db.execute(
+            "UPDATE notifications SET `when` = ?, `count` = ?, `mailed` = ? "
+            "WHERE `id` = ?",
+            [max(when, notification.getWhenTimestamp()), count, mailed,
+             notificationId]
+        )
+        self._addWho(notificationId, notification.who)
+
+    def _createNotification(self, notification, info, infoHash):
+        cursor = self.db.execute(
             """
                 INSERT INTO notifications (`what`, `when`, `where`,
-                                           `seen`, `gatherer`, `info`)
-                VALUES (?, ?, ?, ?, ?, ?)
+                                           `seen`, `gatherer`, `info`,
+                                           `count`, `info_hash`, `mailed`)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
             [notification.what,
              notification.getWhenTimestamp(),
              notification.where,
              notification.seen,
              notification.gatherer,
-             json.dumps(notification.info)]
+             info,
+             notification.count,
+             infoHash,
+             notification.mailed]
         )
-        for who in notification.who:
-            self.db.execute(
-                """
-                    INSERT INTO notifications_who (`what`, `when`,
-                                                   `where`, `who`)
-                    VALUES (?, ?, ?, ?)
-                """,
-                [notification.what,
-                 notification.getWhenTimestamp(),
-                 notification.where,
-                 who]
-            )
+        self._addWho(cursor.lastrowid, notification.who)
 
-    def storeNotification(self, notification):
+    def storeNotification(self, notification, replace=False):
         if self.db is None:
             return
         try:
-            if self._notificationExist(notification):
-                self._updateNotification(notification)
+            info, infoHash = encode(notification.info)
+            existing = None
+            if not notification.seen:
+                # Only unseen notifications are merged, e.g. seen ones are
+                # imported as they are.
+                existing = self._findNotification(notification, infoHash)
+            if existing is not None:
+                self._updateNotification(notification, existing, replace)
             else:
-                self._createNotification(notification)
+                self._createNotification(notification, info, infoHash)
         except sqlite3.IntegrityError:
             pass
 
@@ -233,128 +635,213 @@ class SqliteStorageBackend(object):
         if self.db is None:
             return
         try:
-            self.db.execute(
-                """DELETE FROM notifications
-                   WHERE `what` = ? AND `when` = ? AND `where` = ?""",
-                [notification.what,
-                 notification.getWhenTimestamp(),
-                 notification.where]
-            )
+            for table in ('notifications', 'archive'):
+                self.db.execute(
+                    """DELETE FROM %s
+                       WHERE `what` = ? AND `when` = ? AND `where` = ?"""
+                    % table,
+                    [notification.what,
+                     notification.getWhenTimestamp(),
+                     notification.where]
+                )
         except sqlite3.IntegrityError:
             pass
 
+    def removeNotifications(self, path):
+        clause, params = _subtree(path)
+        # The who rows are removed by the foreign key cascade
+        self.db.execute("DELETE FROM notifications WHERE " + clause, params)
+        self.db.execute("DELETE FROM archive WHERE " + clause, params)
+
     def _createNotificationFromResult(self, result):
-        if result['who'] is None:
-            who = []
-        else:
-            who = result['who'].split(', ')
-        if result['info'] is None:
-            info = None
-        else:
-            info = json.loads(result['info'])
+        what, when, where, who, gatherer, seen, info, count = result
         notification = Notification(
-            result['what'],
-            result['where'],
-            datetime.datetime.fromtimestamp(result['when']),
-            who,
+            what,
+            where,
+            when,
+            self._getActorNames(who),
             self.user,
-            result['gatherer'],
-            result['seen'],
-            info,
+            gatherer,
+            seen,
+            rawInfo=info,
+            count=count,
         )
         return notification
 
-    def getHotNotifications(self):
+    def _getNotifications(self, unseenOnly=False, seenFirst=False,
+                          limit=-1, path=None):
         if self.db is None:
             return []
-        results = self.db.execute(
-            """
-            SELECT
-                n.`what`,
-                n.`when`,
-                n.`where`,
-                GROUP_CONCAT(nw.`who`, ', ') as `who`,
-                n.`gatherer`,
-                n.`seen`,
-                n.`info`
-            FROM notifications n
-            LEFT JOIN notifications_who nw
-                ON n.`what` = nw.`what`
-                AND n.`when` = nw.`when`
-                AND n.`where` = nw.`where`
-            GROUP BY n.`what`, n.`when`, n.`where`
-            ORDER BY n.`seen` ASC, n.`when` DESC
-            LIMIT 5
-            """
-        ).fetchall()
-        notifications = []
-        for result in results:
-            notifications.append(self._createNotificationFromResult(result))
-        return notifications
+        cursor = self.db.cursor()
+        # Plain tuples are cheaper to build than sqlite3.Row objects.
+        cursor.row_factory = None
+        params = {
+            'max_seen': 0 if unseenOnly else 1,
+            'seen_first': 1 if seenFirst else 0,
+            'limit': limit,
+        }
+        if path is None:
+            cursor.execute(SELECT_NOTIFICATIONS, params)
+        else:
+            params['path'] = path
+            params['path_children'], params['path_end'] = _bounds(path)
+            cursor.execute(SELECT_TREE_NOTIFICATIONS, params)
+        return [self._createNotificationFromResult(result)
+                for result in self._readResults(cursor)]
+
+    def _readResults(self, cursor):
+        results = []
+        for result in cursor:
+            result = list(result)
+            if result[3] is None:
+                result[3] = []
+            else:
+                result[3] = [int(i) for i in result[3].split(',')]
+            results.append(result)
+        # Fetch the names unknown to the cache in one query
+        self._getActorNames(list(set(i for r in results for i in r[3])))
+        return results
 
-    def getAllNotifications(self):
+    def getUnmailedNotifications(self, since=0, limit=100):
         if self.db is None:
             return []
-        results = self.db.execute(
-            """
-            SELECT
-                n.`what`,
-                n.`when`,
-                n.`where`,
-                GROUP_CONCAT(nw.`who`, ', ') as `who`,
-                n.`gatherer`,
-                n.`seen`,
-                n.`info`
-            FROM notifications n
-            INNER JOIN notifications_who nw
-                ON n.`what` = nw.`what`
-                AND n.`when` = nw.`when`
-                AND n.`where` = nw.`where`
-            GROUP BY n.`what`, n.`when`, n.`where`
-            ORDER BY n.`when` DESC
-            """
-        ).fetchall()
-        notifications = []
-        for result in results:
-            notifications.append(self._createNotificationFromResult(result))
-        return notifications
+        cursor = self.db.cursor()
+        cursor.row_factory = None
+        cursor.execute(SELECT_UNMAILED, {
+            'since': since,
+            'limit': limit,
+        })
+        return [self._createNotificationFromResult(result)
+                for result in self._readResults(cursor)]
+
+    def setMailed(self, ids):
+        self.db.executemany(
+            "UPDATE notifications SET `mailed` = 1 WHERE `seen` = 0 "
+            "AND `where` = ? AND `when` = ? AND LOWER(`what`) = ?",
+            [(where, when, what) for what, when, where
+             in (parseId(id) for id in ids)]
+        )
+
+    def getHotNotifications(self):
+        return self._getNotifications(seenFirst=True, limit=5)
+
+    def getAllNotifications(self, path=None):
+        return self._getNotifications(path=path)
 
     def getUnseenNotifications(self):
+        return self._getNotifications(unseenOnly=True)
+
+    def iterNotifications(self, batch=500):
+        if self.db is None:
+            return
+        after = 0
+        while True:
+            cursor = self.db.cursor()
+            cursor.row_factory = None
+            cursor.execute(SELECT_BATCH, {'after': after, 'limit': batch})
+            results = self._readResults(cursor)
+            if not results:
+                break
+            for result in results:
+                notification = self._createNotificationFromResult(result[:8])
+                notification.mailed = bool(result[8])
+                yield notification
+            after = results[-1][9]
+        after = 0
+        while True:
+            results = self.db.execute(
+                "SELECT `id`, `what`, `when`, `where`, `payload` "
+                "FROM archive WHERE `id` > ? ORDER BY `id` LIMIT ?",
+                [after, batch]
+            ).fetchall()
+            if not results:
+                break
+            for result in results:
+                yield self._createNotificationFromArchive(result)
+            after = results[-1]['id']
+
+    def archiveNotifications(self, before, batch=500):
+        archived = 0
+        while True:
+            cursor = self.db.cursor()
+            cursor.row_factory = None
+            cursor.execute(SELECT_ARCHIVABLE, {'before': before,
+                                               'limit': batch})
+            results = self._readResults(cursor)
+            if not results:
+                return archived
+            self.db.executemany(
+                "INSERT OR IGNORE INTO archive (`what`, `when`, `where`, "
+                "`payload`) VALUES (?, ?, ?, ?)",
+                [(what, when, where,
+                  _pack(self._getActorNames(who), gatherer,
+                        decode(info), count))
+                 for what, when, where, who, gatherer, seen, info, count, _
+                 in results]
+            )
+            # The who rows are removed by the foreign key cascade
+            self.db.executemany("DELETE FROM notifications WHERE `id` = ?",
+                                [(result[8],) for result in results])
+            archived += len(results)
+
+    def _createNotificationFromArchive(self, result):
+        payload = _unpack(result['payload'])
+        return Notification(
+            result['what'],
+            result['where'],
+            result['when'],
+            payload['who'],
+            self.user,
+            payload['gatherer'],
+            True,
+            info=payload['info'],
+            count=payload['count'],
+        )
+
+    def getArchivedNotifications(self, limit=50, path=None):
         if self.db is None:
             return []
+        clause, params = "1", []
+        if path is not None:
+            clause, params = _subtree(path)
         results = self.db.execute(
-            """
-            SELECT
-                n.`what`,
-                n.`when`,
-                n.`where`,
-                GROUP_CONCAT(nw.`who`, ', ') as `who`,
-                n.`gatherer`,
-                n.`seen`,
-                n.`info`
-            FROM notifications n
-            INNER JOIN notifications_who nw
-                ON n.`what` = nw.`what`
-                AND n.`when` = nw.`when`
-                AND n.`where` = nw.`where`
-            WHERE n.`seen` = 0
-            GROUP BY n.`what`, n.`when`, n.`where`
-            ORDER BY n.`when` DESC
-            """
-        ).fetchall()
-        notifications = []
-        for result in results:
-            notifications.append(self._createNotificationFromResult(result))
-        return notifications
+            "SELECT `what`, `when`, `where`, `payload` FROM archive "
+            "WHERE " + clause + " ORDER BY `when` DESC LIMIT ?",
+            params + [limit]
+        )
+        return [self._createNotificationFromArchive(result)
+                for result in results]
 
-    def setSeen(self, path=None):
-        if path is None:
-            self.db.execute("UPDATE notifications SET seen = 1")
-        else:
-            self.db.execute(
-                "UPDATE notifications SET seen = 1 WHERE `where` = ?",
-                [path]
+    def hasArchivedNotifications(self, path=None):
+        if self.db is None:
+            return False
+        clause, params = "1", []
+        if path is not None:
+            clause, params = _subtree(path)
+        query = self.db.execute(
+            "SELECT EXISTS (SELECT 1 FROM archive WHERE " + clause + ")",
+            params
+        )
+        return query.fetchone()[0] == 1
+
+    def setSeen(self, path=None, subtree=False, ids=None):
+        if ids is not None:
+            self.db.executemany(
+                "UPDATE notifications SET seen = 1 WHERE `seen` = 0 "
+                "AND `where` = ? AND `when` = ? AND LOWER(`what`) = ?",
+                [(where, when, what) for what, when, where
+                 in (parseId(id) for id in ids)]
             )
+        elif path is None:
+            self.db.execute("UPDATE notifications SET seen = 1 "
+                            "WHERE `seen` = 0")
+        elif subtree:
+            clause, params = _subtree(path)
+            self.db.execute("UPDATE notifications SET seen = 1 "
+                            "WHERE `seen` = 0 AND " + clause, params)
+        else:
+            self.db.execute("UPDATE notifications SET seen = 1 "
+                            "WHERE `seen` = 0 AND `where` = ?", [path])
 
     def clean(self):
         lastWeek = datetime.datetime.now() - datetime.timedelta(7)
@@ -362,12 +849,17 @@ class SqliteStorageBackend(object):
         self.db.execute("REMOVE FROM notifications WHERE `when` < ?",
                         [timestamp])
 
-    def getUnseenCount(self):
+    def getUnseenCount(self, path=None):
         if self.db is None:
             return 0
-        query = self.db.execute("SELECT COUNT(*) FROM notifications "
-                                "WHERE `seen` = 0")
-        unseen = query.fetchone()['COUNT(*)']
+        if path is None:
+            query = self.db.execute("SELECT COUNT(*) FROM notifications "
+                                    "WHERE `seen` = 0")
+        else:
+            clause, params = _subtree(path)
+            query = self.db.execute("SELECT COUNT(*) FROM notifications "
+                                    "WHERE `seen` = 0 AND " + clause, params)
+        unseen = query.fetchone()[0]
         return unseen
 
     def getLastNotificationTime(self):
@@ -394,8 +886,7 @@ class SqliteStorageBackend(object):
                             "WHERE `where` = ?",
                             [subscription.wants, subscription.where])
         if subscription is None or not subscription.wants:
-            self.db.execute("DELETE FROM notifications WHERE `where` LIKE ?",
-                            ['%s%%' % subscription.where])
+            self.removeNotifications(subscription.where)
         if subscription is None:
             pass
         elif subscription.wants:
@@ -403,6 +894,36 @@ class SqliteStorageBackend(object):
         else:
             event.notify(BlacklistedEvent(subscription.where))
 
+    def saveSubscriptions(self, subscriptions):
+        existing = dict((s.where, s.wants) for s in self.getSubscriptions())
+        changed = []
+        for subscription in subscriptions:
+            if existing.get(subscription.where) == subscription.wants:
+                continue
+            existing[subscription.where] = subscription.wants
+            changed.append(subscription)
+        if not changed:
+            return changed
+        self.db.executemany(
+            "DELETE FROM subscriptions WHERE `where` = ?",
+            [(s.where,) for s in changed if s.wants is None]
+        )
+        self.db.executemany(
+            "INSERT OR REPLACE INTO subscriptions (`where`, `wants`) "
+            "VALUES (?, ?)",
+            [(s.where, s.wants) for s in changed if s.wants is not None]
+        )
+        # One purge per subtree, the paths below a purged one are in it.
+        purged = None
+        for path in sorted(s.where for s in changed if not s.wants):
+            if purged is not None and (path == purged or
+                                       path.startswith(purged + '/')):
+                continue
+            self.removeNotifications(path)
+            purged = path
+        event.notify(SubscriptionsChangedEvent(self.user, changed))
+        return changed
+
     def _createSubscriptionFromResult(self, result):
         wants = result['wants'] == 1
         subscription = Subscription(result['where'], wants)
@@ -423,6 +944,140 @@ class SqliteStorageBackend(object):
             subscriptions.append(self._createSubscriptionFromResult(result))
         return subscriptions
 
+    def iterSubscriptions(self):
+        for result in self.db.execute("SELECT * FROM subscriptions "
+                                      "ORDER BY `where`"):
+            yield self._createSubscriptionFromResult(result)
+
+    def getSubscriptionsInTree(self, path):
+        paths = [path] + parentPaths(path)
+        results = self.db.execute(
+            "SELECT * FROM subscriptions WHERE `where` IN (%s)"
+            % ', '.join('?' * len(paths)),
+            paths
+        )
+        subscriptions = {}
+        for result in results:
+            subscription = self._createSubscriptionFromResult(result)
+            subscriptions[subscription.where] = subscription
+        return subscriptions
+
+    def _connectShared(self):
+        db = sqlite3.connect(os.path.join(self.directory, PRINCIPALS_DB),
+                             factory=_Connection)
+        db.execute(CREATE_SHARED_SUBSCRIPTIONS)
+        return db
+
+    def saveSharedSubscriptions(self, principal, subscriptions):
+        db = self._connectShared()
+        try:
+            existing = dict(db.execute(
+                "SELECT `where`, `wants` FROM shared_subscriptions "
+                "WHERE `principal` = ?", [principal]
+            ).fetchall())
+            changed = []
+            for subscription in subscriptions:
+                wants = subscription.wants
+                if wants is not None:
+                    wants = int(wants)
+                if existing.get(subscription.where) == wants:
+                    continue
+                existing[subscription.where] = wants
+                changed.append(subscription)
+            db.executemany(
+                "DELETE FROM shared_subscriptions "
+                "WHERE `principal` = ? AND `where` = ?",
+                [(principal, s.where) for s in changed if s.wants is None]
+            )
+            db.executemany(
+                "INSERT OR REPLACE INTO shared_subscriptions "
+                "(`principal`, `where`, `wants`) VALUES (?, ?, ?)",
+                [(principal, s.where, s.wants)
+                 for s in changed if s.wants is not None]
+            )
+            db.commit()
+        finally:
+            db.close()
+        return changed
+
+    def getSharedSubscriptions(self, principals):
+        if not principals:
+            return []
+        db = self._connectShared()
+        try:
+            results = db.execute(
+                "SELECT `principal`, `where`, `wants` "
+                "FROM shared_subscriptions WHERE `principal` IN (%s)"
+                % ', '.join('?' * len(principals)),
+                list(principals)
+            ).fetchall()
+        finally:
+            db.close()
+        return [(principal, Subscription(where, wants == 1))
+                for principal, where, wants in results]
+
+    def getMeta(self, key, default=None):
+        result = self.db.execute("SELECT `value` FROM meta WHERE `key` = ?",
+                                 [key]).fetchone()
+        if result is None:
+            return default
+        return result[0]
+
+    def setMeta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (`key`, `value`) "
+                        "VALUES (?, ?)", [key, value])
+
+    def listUsers(self):
+        return [file_name[:-len('.sqlite')]
+                for file_name in os.listdir(self.directory)
+                if file_name.endswith('.sqlite')]
+
+    def _computeStats(self, db_path):
+        db = sqlite3.connect(db_path)
+        try:
+            notifications, unseen, oldestUnseen = db.execute("""
+                SELECT COUNT(*),
+                       SUM(`seen` = 0),
+                       MIN(CASE WHEN `seen` = 0 THEN `when` END)
+                FROM notifications
+            """).fetchone()
+            subscriptions = db.execute(
+                "SELECT COUNT(*) FROM subscriptions").fetchone()[0]
+            try:
+                lastGather = db.execute(
+                    "SELECT `value` FROM meta WHERE `key` = ?", [LAST_GATHER]
+                ).fetchone()
+            except sqlite3.OperationalError:
+                # The storage was never opened since meta was added
+                lastGather = None
+        finally:
+            db.close()
+        return {
+            'notifications': notifications,
+            'unseen': unseen or 0,
+            'oldest_unseen': oldestUnseen,
+            'subscriptions': subscriptions,
+            'last_gather': lastGather[0] if lastGather else None,
+        }
+
+    def getStats(self, refresh=True):
+        db_path = os.path.join(self.directory, '%s.sqlite' % self.user)
+        try:
+            stat = os.stat(db_path)
+        except OSError:
+            return None
+        version = (stat.st_mtime, stat.st_size)
+        cached = _stats.get(db_path)
+        if cached is not None and (cached[0] == version or not refresh):
+            return cached[1]
+        if not refresh:
+            return None
+        stats = self._computeStats(db_path)
+        stats['user'] = self.user
+        stats['size'] = stat.st_size
+        _stats[db_path] = (version, stats)
+        return stats
+
     def setUser(self, user):
         if self.db is not None:
             return
@@ -436,6 +1091,9 @@ class NullBackend(object):
     """ Null backend used in case the other backend is not valid."""
     interface.implements(IStorageBackend)
 
+    def __init__(self, context=None, request=None):
+        pass
+
     def initialize(self):
         pass
 
@@ -451,25 +1109,40 @@ class NullBackend(object):
     def getUser(self):
         return ''
 
-    def storeNotification(self, notification):
+    def storeNotification(self, notification, replace=False):
         pass
 
     def removeNotification(self, notification):
         pass
 
+    def removeNotifications(self, path):
+        pass
+
     def getHotNotifications(self):
         return []
 
-    def getAllNotifications(self):
+    def getAllNotifications(self, path=None):
         return []
 
     def getUnseenNotifications(self):
         return []
 
-    def setSeen(self, path=None):
+    def iterNotifications(self, batch=500):
+        return iter([])
+
+    def archiveNotifications(self, before):
+        return 0
+
+    def getArchivedNotifications(self, limit=50, path=None):
+        return []
+
+    def hasArchivedNotifications(self, path=None):
+        return False
+
+    def setSeen(self, path=None, subtree=False, ids=None):
         pass
 
-    def getUnseenCount(self):
+    def getUnseenCount(self, path=None):
         return 0
 
     def getLastNotificationTime(self):
@@ -481,8 +1154,41 @@ class NullBackend(object):
     def saveSubscription(self, subscription):
         pass
 
+    def saveSubscriptions(self, subscriptions):
+        return []
+
     def getSubscription(self, where):
         return None
 
     def getSubscriptions(self):
         return []
+
+    def iterSubscriptions(self):
+        return iter([])
+
+    def getSubscriptionsInTree(self, path):
+        return {}
+
+    def getUnmailedNotifications(self, since=0, limit=100):
+        return []
+
+    def setMailed(self, ids):
+        pass
+
+    def saveSharedSubscriptions(self, principal, subscriptions):
+        return []
+
+    def getSharedSubscriptions(self, principals):
+        return []
+
+    def getMeta(self, key, default=None):
+        return default
+
+    def setMeta(self, key, value):
+        pass
+
+    def listUsers(self):
+        return []
+
+    def getStats(self, refresh=True):
+        return None
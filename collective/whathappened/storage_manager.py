@@ -1,15 +1,18 @@
-import logging
-
 from zope import interface
 from zope import schema
 from zope import component
+from zope.annotation.interfaces import IAnnotations
 
 from plone.registry.interfaces import IRegistry
 
 from collective.whathappened import storage_backend
 from collective.whathappened.exceptions import NoBackendException
+from collective.whathappened.instrumentation import timed
+from collective.whathappened.resolver import resolveBackend
+from collective.whathappened.subscription import Subscription
+
 
-logger = logging.getLogger('collective.whathappened')
+ANNOTATION = 'collective.whathappened.storage'
 
 
 class IStorageManager(storage_backend.IStorageBackend):
@@ -23,6 +26,17 @@ class IStorageManager(storage_backend.IStorageBackend):
 
     backend = schema.TextLine(title=u"Backend name")
 
+    def subscribe(paths):
+        """Subscribe to all the given paths, see saveSubscriptions."""
+
+    def unsubscribe(paths):
+        """Remove the subscriptions, or blacklists, of all the given
+        paths."""
+
+
+def _validate(backend):
+    return backend.validateBackend()
+
 
 class StorageManager(object):
     interface.implements(IStorageManager)
@@ -32,10 +46,11 @@ class StorageManager(object):
         self.request = request
         self.backend = None
         self.registry = None
+        self.update()
 
     def update(self):
-        """update is called automatically on every methods called.
-        See __getattribute__"""
+        """Get the storage backend. It is only validated once per process,
+        see resolver.resolveBackend"""
         if self.backend is None:
             self.registry = component.queryUtility(IRegistry)
             if self.registry is None:
@@ -44,64 +59,163 @@ class StorageManager(object):
                 'collective.whathappened.backend',
                 'collective.whathappened.backend.sqlite',
             )
-            self.backend = self.context.restrictedTraverse(backend)
+            self.backend = resolveBackend(
+                self.context, self.request, backend,
+                validate=_validate,
+                fallback=storage_backend.NullBackend,
+            )
             if self.backend is None:
                 raise NoBackendException('Storage')
-            if not self.backend.validateBackend():
-                logger.warning('Storage backend is not valid,'
-                               ' using NullBackend instead.')
-                self.backend = storage_backend.NullBackend()
-
-    def __getattribute__(self, name):
-        """Automatically call self.update() when other methods are called"""
-        if name not in ['update', 'backend', 'registry', 'context']:
-            self.update()
-        return object.__getattribute__(self, name)
 
+    @timed('storage.initialize')
     def initialize(self):
         return self.backend.initialize()
 
+    @timed('storage.terminate')
     def terminate(self):
         return self.backend.terminate()
 
-    def storeNotification(self, notification):
-        return self.backend.storeNotification(notification)
+    @timed('storage.storeNotification')
+    def storeNotification(self, notification, replace=False):
+        return self.backend.storeNotification(notification, replace)
 
+    @timed('storage.removeNotification')
     def removeNotification(self, notification):
         return self.backend.removeNotification(notification)
 
+    @timed('storage.removeNotifications')
+    def removeNotifications(self, path):
+        return self.backend.removeNotifications(path)
+
+    @timed('storage.getHotNotifications')
     def getHotNotifications(self):
         return self.backend.getHotNotifications()
 
-    def getAllNotifications(self):
-        return self.backend.getAllNotifications()
+    @timed('storage.getAllNotifications')
+    def getAllNotifications(self, path=None):
+        return self.backend.getAllNotifications(path)
 
+    @timed('storage.getUnseenNotifications')
     def getUnseenNotifications(self):
         return self.backend.getUnseenNotifications()
 
-    def setSeen(self, path=None):
-        return self.backend.setSeen(path)
+    def iterNotifications(self, batch=500):
+        return self.backend.iterNotifications(batch)
+
+    @timed('storage.archiveNotifications')
+    def archiveNotifications(self, before):
+        return self.backend.archiveNotifications(before)
+
+    @timed('storage.getArchivedNotifications')
+    def getArchivedNotifications(self, limit=50, path=None):
+        return self.backend.getArchivedNotifications(limit, path)
+
+    @timed('storage.hasArchivedNotifications')
+    def hasArchivedNotifications(self, path=None):
+        return self.backend.hasArchivedNotifications(path)
 
+    @timed('storage.setSeen')
+    def setSeen(self, path=None, subtree=False, ids=None):
+        return self.backend.setSeen(path, subtree, ids)
+
+    @timed('storage.clean')
     def clean(self):
         return self.backend.clean()
 
-    def getUnseenCount(self):
-        return self.backend.getUnseenCount()
+    @timed('storage.getUnseenCount')
+    def getUnseenCount(self, path=None):
+        return self.backend.getUnseenCount(path)
 
+    @timed('storage.getLastNotificationTime')
     def getLastNotificationTime(self):
         return self.backend.getLastNotificationTime()
 
+    @timed('storage.setUser')
     def setUser(self, user):
         return self.backend.setUser(user)
 
+    @timed('storage.getUser')
     def getUser(self):
         return self.backend.getUser()
 
+    @timed('storage.saveSubscription')
     def saveSubscription(self, subscription):
         return self.backend.saveSubscription(subscription)
 
+    @timed('storage.saveSubscriptions')
+    def saveSubscriptions(self, subscriptions):
+        return self.backend.saveSubscriptions(subscriptions)
+
+    def subscribe(self, paths):
+        return self.saveSubscriptions([Subscription(path, True)
+                                       for path in paths])
+
+    def unsubscribe(self, paths):
+        return self.saveSubscriptions([Subscription(path, None)
+                                       for path in paths])
+
+    @timed('storage.getSubscription')
     def getSubscription(self, where):
         return self.backend.getSubscription(where)
 
+    @timed('storage.getSubscriptions')
     def getSubscriptions(self):
         return self.backend.getSubscriptions()
+
+    def iterSubscriptions(self):
+        return self.backend.iterSubscriptions()
+
+    @timed('storage.getUnmailedNotifications')
+    def getUnmailedNotifications(self, since=0, limit=100):
+        return self.backend.getUnmailedNotifications(since, limit)
+
+    @timed('storage.setMailed')
+    def setMailed(self, ids):
+        return self.backend.setMailed(ids)
+
+    @timed('storage.getSubscriptionsInTree')
+    def getSubscriptionsInTree(self, path):
+        return self.backend.getSubscriptionsInTree(path)
+
+    @timed('storage.saveSharedSubscriptions')
+    def saveSharedSubscriptions(self, principal, subscriptions):
+        return self.backend.saveSharedSubscriptions(principal, subscriptions)
+
+    @timed('storage.getSharedSubscriptions')
+    def getSharedSubscriptions(self, principals):
+        return self.backend.getSharedSubscriptions(principals)
+
+    @timed('storage.getMeta')
+    def getMeta(self, key, default=None):
+        return self.backend.getMeta(key, default)
+
+    @timed('storage.setMeta')
+    def setMeta(self, key, value):
+        return self.backend.setMeta(key, value)
+
+    @timed('storage.listUsers')
+    def listUsers(self):
+        return self.backend.listUsers()
+
+    @timed('storage.getStats')
+    def getStats(self, refresh=True):
+        return self.backend.getStats(refresh)
+
+
+def getRequestStorage(context, request):
+    """Return the storage of the current user, initialized. It is opened once
+    per request and terminated when the request ends, so the views and
+    viewlets of a page share it and must not terminate it."""
+    annotations = IAnnotations(request)
+    storage = annotations.get(ANNOTATION)
+    if storage is None:
+        storage = annotations[ANNOTATION] = StorageManager(context, request)
+    storage.initialize()
+    return storage
+
+
+def requestEnded(event):
+    """Terminate the storage opened for the request, if any."""
+    storage = IAnnotations(event.request).get(ANNOTATION)
+    if storage is not None:
+        storage.terminate()
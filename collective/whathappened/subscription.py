@@ -10,9 +10,65 @@ class ISubscription(interface.Interface):
     wants = schema.Bool(title=u"wants")
 
 
+# Principal ids of the shared subscriptions
+GROUP = 'group:%s'
+ROLE = 'role:%s'
+
+
+def parentPaths(path):
+    """Return the paths containing 'path', the nearest first."""
+    parents = []
+    path = path.rpartition('/')[0]
+    while path:
+        parents.append(path)
+        path = path.rpartition('/')[0]
+    return parents
+
+
 class Subscription(object):
     interface.implements(ISubscription)
 
+    __slots__ = ('where', 'wants')
+
     def __init__(self, where, wants):
         self.where = where
         self.wants = wants
+
+    def __getstate__(self):
+        # Slotted objects have no __dict__ for the pickle protocols 0 and 1
+        return {'where': self.where, 'wants': self.wants}
+
+    def __setstate__(self, state):
+        self.where = state['where']
+        self.wants = state['wants']
+
+
+def mergeShared(subscriptions):
+    """Merge the (principal, subscription) of the groups and roles of a user
+    into a dict by path. A blacklist wins over a subscription to the same
+    path."""
+    merged = {}
+    for principal, subscription in subscriptions:
+        current = merged.get(subscription.where)
+        if current is None or current.wants:
+            merged[subscription.where] = subscription
+    return merged
+
+
+def findSubscription(path, own, shared=None):
+    """Return the subscription applying to 'path' from the user's own
+    subscriptions and the shared ones, both dicts by path.
+
+    The nearest subscription wins, the user's own one first. A shared
+    subscription nearer than the user's own blacklist still loses to it."""
+    shared = shared or {}
+    found = None
+    for where in [path] + parentPaths(path):
+        subscription = own.get(where)
+        if subscription is not None:
+            if found is None or not subscription.wants:
+                return subscription
+            return found
+        if found is None:
+            found = shared.get(where)
+    return found
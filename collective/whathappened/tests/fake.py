@@ -1,6 +1,122 @@
+import bisect
+
+from DateTime import DateTime
 from zope import interface
 from zope.component.interfaces import IObjectEvent
 
+from collective.history.useraction import IUserAction
+
+
+class FakeRequest(object):
+    def __init__(self):
+        self.ACTUAL_URL = 'http://nohost'
+
+
+class FakeMember(object):
+    def __init__(self):
+        self.id = 'admin'
+        self.groups = []
+        self.roles = ['Member', 'Authenticated']
+
+    def getId(self):
+        return self.id
+
+    def getGroups(self):
+        return self.groups
+
+    def getRoles(self):
+        return self.roles
+
+
+class FakeMTool(object):
+    def __init__(self):
+        self.member = FakeMember()
+
+    def getAuthenticatedMember(self):
+        return self.member
+
+    def getMemberById(self, id):
+        if id == self.member.id:
+            return self.member
+
+
+class FakeURLTool(object):
+    def getPortalPath(self):
+        return '/plone'
+
+
+class FakeUserAction(object):
+    """Stand-in for collective.history useractions and their brains."""
+    interface.implements(IUserAction)
+
+    def __init__(self, id, what, when, where_path, who, what_info='{}'):
+        self.id = id
+        self.what = what
+        self.when = when
+        self.where_path = where_path
+        self.who = who
+        self.what_info = what_info
+
+
+class FakeUserActionManager(object):
+    """Stand-in for collective.history's UserActionManager, searching an in
+    memory list of useractions."""
+
+    def __init__(self, useractions=None):
+        self.useractions = []
+        self.whens = []
+        self.byId = {}
+        for useraction in useractions or []:
+            self.add(useraction)
+
+    def update(self):
+        pass
+
+    def add(self, useraction):
+        index = bisect.bisect_right(self.whens, useraction.when)
+        self.whens.insert(index, useraction.when)
+        self.useractions.insert(index, useraction)
+        self.byId[useraction.id] = useraction
+
+    def search(self, when=None, **query):
+        if when is None:
+            return list(self.useractions)
+        start = when['query']
+        if isinstance(start, DateTime):
+            start = start.asdatetime().replace(tzinfo=None)
+        index = bisect.bisect_left(self.whens, start)
+        return self.useractions[index:]
+
+    def get(self, id):
+        return self.byId[id]
+
+
+class FakeSettings(object):
+    def __init__(self, whitelist=None):
+        self.useraction_gatherer_whitelist = set(whitelist or ['created'])
+        self.coalesce_keys = []
+        self.coalesce_window = 0
+        self.gather_max_useractions = 0
+        self.gather_max_time = 0
+
+
+class FakeSite(object):
+    """Site with a flat set of content paths the user is allowed to view."""
+
+    def __init__(self, paths=(), settings=None):
+        self.paths = set(paths)
+        self.settings = settings or FakeSettings()
+        self.portal_membership = FakeMTool()
+        self.portal_url = FakeURLTool()
+        self.REQUEST = FakeRequest()
+
+    def restrictedTraverse(self, path):
+        if path == '@@get-whathappened-settings':
+            return lambda: self.settings
+        if path not in self.paths:
+            raise KeyError(path)
+        return self
+
 
 class IFakeEvent(IObjectEvent):
     """fake event"""
@@ -16,11 +132,6 @@ class FakeContext(object):
         return self.physical_path
 
 
-class FakeRequest(object):
-    def __init__(self):
-        self.ACTUAL_URL = 'http://nohost'
-
-
 class FakeEvent(object):
     interface.implements(IFakeEvent)
 
@@ -34,17 +145,17 @@ class FakeHandler(object):
         self.mtool = FakeMTool()
 
 
-class FakeMember(object):
-    def __init__(self):
-        self.id = 'admin'
+class FakeMailHost(object):
+    """Stand-in for the MailHost, keeping the mails it is asked to send."""
 
-    def getId(self):
-        return self.id
-
-
-class FakeMTool(object):
     def __init__(self):
-        self.member = FakeMember()
-
-    def getAuthenticatedMember(self):
-        return self.member
+        self.messages = []
+
+    def send(self, messageText, mto=None, mfrom=None, subject=None,
+             **kwargs):
+        self.messages.append({
+            'text': messageText,
+            'mto': mto,
+            'mfrom': mfrom,
+            'subject': subject,
+        })
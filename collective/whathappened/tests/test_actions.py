@@ -0,0 +1,97 @@
+import os
+
+import transaction
+import unittest2 as unittest
+
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+from zope import event
+from zope.lifecycleevent import ObjectModifiedEvent
+
+from collective.whathappened.tests import base
+from collective.whathappened.actions.subscription import SubscriptionAction
+from collective.whathappened.actions.subscription import \
+    SubscriptionActionExecutor
+from collective.whathappened.event import ISubscriptionsChangedEvent
+from collective.whathappened.storage_manager import StorageManager
+
+
+class TestSubscriptionAction(base.FunctionalTestCase):
+
+    def setUp(self):
+        super(TestSubscriptionAction, self).setUp()
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        for i in range(3):
+            self.portal.invokeFactory('Document', 'doc%d' % i)
+        transaction.commit()
+        self.storage = StorageManager(self.portal, self.request)
+        self.storage.setUser(TEST_USER_ID)
+
+    def tearDown(self):
+        self.storage.initialize()
+        db_path = self.storage.backend.db_path
+        self.storage.terminate()
+        os.remove(db_path)
+
+    def execute(self, obj, subscription='subscribe'):
+        element = SubscriptionAction()
+        element.subscription = subscription
+        executor = SubscriptionActionExecutor(self.portal, element,
+                                              ObjectModifiedEvent(obj))
+        return executor()
+
+    def getSubscriptions(self):
+        self.storage.initialize()
+        subscriptions = dict((s.where, s.wants)
+                             for s in self.storage.getSubscriptions())
+        self.storage.terminate()
+        return subscriptions
+
+    def path(self, obj):
+        return '/'.join(obj.getPhysicalPath())
+
+    def test_saved_at_commit(self):
+        for i in range(3):
+            self.assertTrue(self.execute(self.portal['doc%d' % i]))
+        self.execute(self.portal.doc2, 'unsubscribe')
+        self.assertEqual(self.getSubscriptions(), {})
+        transaction.commit()
+        self.assertEqual(self.getSubscriptions(), {
+            self.path(self.portal.doc0): True,
+            self.path(self.portal.doc1): True,
+            self.path(self.portal.doc2): False,
+        })
+
+    def test_dropped_on_abort(self):
+        self.execute(self.portal.doc0)
+        transaction.abort()
+        self.execute(self.portal.doc1)
+        transaction.commit()
+        self.assertEqual(self.getSubscriptions(), {
+            self.path(self.portal.doc1): True,
+        })
+
+    def test_one_event_in_transaction(self):
+        notified = []
+
+        def handler(changed):
+            if ISubscriptionsChangedEvent.providedBy(changed):
+                notified.append((changed, transaction.get()))
+
+        for i in range(3):
+            self.execute(self.portal['doc%d' % i])
+        txn = transaction.get()
+        event.subscribers.append(handler)
+        try:
+            transaction.commit()
+        finally:
+            event.subscribers.remove(handler)
+        self.assertEqual(len(notified), 1)
+        changed, current = notified[0]
+        self.assertEqual(len(changed.subscriptions), 3)
+        # Notified before the commit, the rules can still change contents
+        self.assertIs(current, txn)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
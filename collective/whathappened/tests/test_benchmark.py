@@ -0,0 +1,25 @@
+import unittest2 as unittest
+
+from collective.whathappened.tests import base
+from collective.whathappened import benchmark
+
+
+class TestBenchmark(base.UnitTestCase):
+
+    def test_run(self):
+        options = benchmark.parse([
+            '--users', '3', '--subscriptions', '2', '--sections', '2',
+            '--folders', '2', '--documents', '2', '--actions', '50',
+            '--coalesce', '60',
+        ])
+        results = benchmark.run(options)
+        self.assertEqual(results['results']['getNewNotifications']['calls'],
+                         3)
+        self.assertIn('storeNotification', results['results'])
+        for stats in results['results'].values():
+            self.assertEqual(sorted(stats.keys()),
+                             ['calls', 'max', 'mean', 'total'])
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,84 @@
+import datetime
+
+import unittest2 as unittest
+
+from collective.whathappened.tests import base
+from collective.whathappened.coalesce import Coalescer
+from collective.whathappened.notification import Notification
+
+
+class TestCoalescer(base.UnitTestCase):
+
+    def setUp(self):
+        super(TestCoalescer, self).setUp()
+        self.now = datetime.datetime(2014, 1, 1, 12)
+
+    def _notification(self, where, minutes=0, who='alice', what='modified'):
+        return Notification(
+            what,
+            where,
+            self.now + datetime.timedelta(minutes=minutes),
+            [who],
+            'admin',
+            'useraction',
+        )
+
+    def test_bulk_edit_in_folder(self):
+        notifications = [
+            self._notification('/plone/folder/doc%d' % i, minutes=i % 30,
+                               who='alice' if i % 2 else 'bob')
+            for i in range(500)
+        ]
+        merged = Coalescer(['parent'], 3600).coalesce(notifications)
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(merged[0].where, '/plone/folder')
+        self.assertEqual(merged[0].count, 500)
+        self.assertEqual(sorted(merged[0].who), ['alice', 'bob'])
+        self.assertEqual(merged[0].when,
+                         self.now + datetime.timedelta(minutes=29))
+
+    def test_window(self):
+        notifications = [
+            self._notification('/plone/folder/doc1'),
+            self._notification('/plone/folder/doc2', minutes=30),
+            self._notification('/plone/folder/doc3', minutes=90),
+        ]
+        merged = Coalescer(['parent'], 3600).coalesce(notifications)
+        self.assertEqual([n.count for n in merged], [2, 1])
+        self.assertEqual(merged[1].where, '/plone/folder/doc3')
+
+    def test_keys(self):
+        notifications = [
+            self._notification('/plone/folder/doc1'),
+            self._notification('/plone/folder/doc1', who='bob'),
+            self._notification('/plone/folder/doc2'),
+            self._notification('/plone/folder/doc2', what='created'),
+        ]
+        merged = Coalescer(['where'], 3600).coalesce(notifications)
+        self.assertEqual(len(merged), 3)
+        self.assertEqual(merged[0].who, ['alice', 'bob'])
+        self.assertEqual(merged[0].count, 1)
+        merged = Coalescer(['parent', 'who'], 3600).coalesce(notifications)
+        self.assertEqual(len(merged), 3)
+
+    def test_location_key(self):
+        notifications = [
+            self._notification('/plone/folder/doc1'),
+            self._notification('/plone/folder/doc2'),
+            self._notification('/plone/other/doc3'),
+        ]
+        merged = Coalescer(['who'], 3600).coalesce(notifications)
+        self.assertEqual([n.where for n in merged],
+                         ['/plone/folder', '/plone/other/doc3'])
+
+    def test_disabled(self):
+        notifications = [
+            self._notification('/plone/folder/doc1'),
+            self._notification('/plone/folder/doc2'),
+        ]
+        merged = Coalescer(['parent'], 0).coalesce(notifications)
+        self.assertEqual(len(merged), 2)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,34 @@
+import unittest2 as unittest
+
+from collective.whathappened.tests import base
+from collective.whathappened import codec
+
+
+class TestCodec(base.UnitTestCase):
+
+    def test_round_trip(self):
+        for info in [None, {}, {'title': u'Caf\xe9'},
+                     {'title': 'x' * codec.COMPRESS_MIN}]:
+            value, infoHash = codec.encode(info)
+            self.assertEqual(codec.decode(value), info)
+            self.assertEqual(infoHash, codec.infoHash(info))
+
+    def test_compressed(self):
+        value, infoHash = codec.encode({'title': 'Doc'})
+        self.assertIsInstance(value, str)
+        value, infoHash = codec.encode({'title': 'x' * codec.COMPRESS_MIN})
+        self.assertIsInstance(value, buffer)
+        self.assertLess(len(value), codec.COMPRESS_MIN)
+
+    def test_hash(self):
+        self.assertEqual(codec.infoHash({'a': 1, 'b': 2}),
+                         codec.infoHash({'b': 2, 'a': 1}))
+        self.assertNotEqual(codec.infoHash({'a': 1}),
+                            codec.infoHash({'a': 2}))
+
+    def test_plain_json(self):
+        self.assertEqual(codec.decode(u'{"title": "Doc"}'), {'title': 'Doc'})
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
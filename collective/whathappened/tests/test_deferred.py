@@ -0,0 +1,97 @@
+import threading
+
+import unittest2 as unittest
+
+from collective.whathappened.deferred import GatheringPool
+from collective.whathappened.deferred import getUser
+from collective.whathappened.tests import base
+
+
+class TestGatheringPool(base.UnitTestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.running = threading.Event()
+        self.release = threading.Event()
+
+    def _gather(self, site, user):
+        self.running.set()
+        self.release.wait(5)
+        self.calls.append((site, user))
+
+    def test_submit(self):
+        pool = GatheringPool(self._gather, workers=1)
+        self.assertTrue(pool.submit('/plone', 'bob'))
+        self.running.wait(5)
+        # Queued again while running
+        self.assertFalse(pool.submit('/plone', 'bob'))
+        self.assertTrue(pool.submit('/plone', 'alice'))
+        self.assertFalse(pool.submit('/plone', 'alice'))
+        self.release.set()
+        pool.join()
+        self.assertEqual(self.calls, [('/plone', 'bob'), ('/plone', 'alice')])
+        self.assertTrue(pool.submit('/plone', 'bob'))
+        pool.join()
+        self.assertEqual(len(self.calls), 3)
+
+    def test_queue_full(self):
+        pool = GatheringPool(self._gather, workers=1, size=1)
+        pool.submit('/plone', 'bob')
+        self.running.wait(5)
+        self.assertTrue(pool.submit('/plone', 'alice'))
+        self.assertFalse(pool.submit('/plone', 'carol'))
+        self.release.set()
+        pool.join()
+        self.assertEqual(len(self.calls), 2)
+
+    def test_failure(self):
+        def fail(site, user):
+            raise ValueError(user)
+        pool = GatheringPool(fail, workers=1)
+        pool.submit('/plone', 'bob')
+        pool.join()
+        self.assertEqual(pool.pending, set())
+        self.assertTrue(pool.submit('/plone', 'bob'))
+        pool.join()
+
+
+class FakeUser(object):
+
+    def __init__(self, userId):
+        self.userId = userId
+
+    def __of__(self, parent):
+        self.parent = parent
+        return self
+
+
+class FakeUserFolder(object):
+
+    def __init__(self, *userIds):
+        self.users = dict((userId, FakeUser(userId)) for userId in userIds)
+
+    def getUserById(self, userId):
+        return self.users.get(userId)
+
+
+class FakeContainer(object):
+
+    def __init__(self, acl_users):
+        self.acl_users = acl_users
+
+
+class TestGetUser(base.UnitTestCase):
+
+    def test_get_user(self):
+        site = FakeContainer(FakeUserFolder('bob'))
+        app = FakeContainer(FakeUserFolder('admin', 'bob'))
+        bob = getUser(site, app, 'bob')
+        self.assertIs(bob.parent, site.acl_users)
+        # Zope root managers are not in the site
+        admin = getUser(site, app, 'admin')
+        self.assertIs(admin.parent, app.acl_users)
+        self.assertIsNone(getUser(site, app, 'carol'))
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,103 @@
+import datetime
+import os
+
+import unittest2 as unittest
+
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+
+from collective.whathappened.tests import base
+from collective.whathappened.tests.fake import FakeMailHost
+from collective.whathappened.digest import DigestSender
+from collective.whathappened.notification import Notification
+from collective.whathappened.storage_manager import StorageManager
+
+
+class GatheringDigestSender(DigestSender):
+    """Gathers a notification about the document, as the user."""
+
+    def gather(self):
+        mtool = self.portal.portal_membership
+        self.gatheredBy = mtool.getAuthenticatedMember().getId()
+        storage = StorageManager(self.portal, self.request)
+        storage.initialize()
+        storage.storeNotification(Notification(
+            'modified',
+            '/'.join(self.portal.doc.getPhysicalPath()),
+            datetime.datetime.now(),
+            ['bob'],
+            self.gatheredBy,
+            'useraction',
+        ))
+        storage.terminate()
+
+
+class TestDigest(base.IntegrationTestCase):
+
+    def setUp(self):
+        super(TestDigest, self).setUp()
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        self.portal.invokeFactory('Document', 'doc', title='Document')
+        self.portal._updateProperty('email_from_address', 'site@example.com')
+        member = self.portal.portal_membership.getMemberById(TEST_USER_ID)
+        member.setMemberProperties({'email': 'user@example.com'})
+        self.portal.MailHost = FakeMailHost()
+        self.storage = StorageManager(self.portal, self.request)
+        self.storage.setUser(TEST_USER_ID)
+        self.storage.initialize()
+        self.db_path = self.storage.backend.db_path
+        path = '/'.join(self.portal.doc.getPhysicalPath())
+        for minutes in range(3):
+            self.storage.storeNotification(Notification(
+                'created',
+                path,
+                datetime.datetime.now() - datetime.timedelta(minutes=minutes),
+                ['alice'],
+                TEST_USER_ID,
+                'useraction',
+            ))
+        self.storage.terminate()
+
+    def tearDown(self):
+        os.remove(self.db_path)
+
+    def test_digest(self):
+        sender = DigestSender(self.portal, self.request, limit=2,
+                              sleep=lambda seconds: None)
+        self.assertEqual(sender.run(), 1)
+        messages = self.portal.MailHost.messages
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['mto'], 'user@example.com')
+        self.assertIn('/doc', messages[0]['text'])
+        # The third notification is left for the next digest
+        self.assertEqual(sender.run(), 1)
+        self.assertEqual(sender.run(), 0)
+        self.assertEqual(len(messages), 2)
+
+    def test_throttle(self):
+        waits = []
+        sender = DigestSender(self.portal, self.request, rate=1, batch=1,
+                              sleep=waits.append)
+        sender.run()
+        self.assertEqual(len(waits), 1)
+        self.assertTrue(0 < waits[0] <= 1)
+
+    def test_no_rate(self):
+        waits = []
+        sender = DigestSender(self.portal, self.request, rate=0, batch=1,
+                              sleep=waits.append)
+        self.assertEqual(sender.run(), 1)
+        self.assertEqual(waits, [])
+
+    def test_gathered_first(self):
+        sender = GatheringDigestSender(self.portal, self.request, limit=10,
+                                       sleep=lambda seconds: None)
+        self.assertEqual(sender.run(), 1)
+        self.assertEqual(sender.gatheredBy, TEST_USER_ID)
+        # The gathered notification is mailed with the stored ones
+        self.assertEqual(self.portal.MailHost.messages[0]['text'].count(
+            '/doc'), 4)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
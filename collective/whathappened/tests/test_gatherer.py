@@ -0,0 +1,140 @@
+import datetime
+import shutil
+import tempfile
+
+import unittest2 as unittest
+
+from collective.whathappened.tests import base
+from collective.whathappened.tests.fake import FakeRequest
+from collective.whathappened.tests.fake import FakeSettings
+from collective.whathappened.tests.fake import FakeSite
+from collective.whathappened.tests.fake import FakeUserAction
+from collective.whathappened.tests.fake import FakeUserActionManager
+from collective.whathappened.gatherer_backend import UserActionGathererBackend
+from collective.whathappened.storage_backend import SqliteStorageBackend
+from collective.whathappened.subscription import Subscription
+from collective.whathappened.useraction_window import UserActionWindow
+
+
+class TestGatherBudget(base.UnitTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.start = datetime.datetime(2014, 1, 1)
+        paths = ['/plone/doc%d' % i for i in range(10)]
+        self.manager = FakeUserActionManager([
+            FakeUserAction(i, 'created',
+                           self.start + datetime.timedelta(minutes=i),
+                           paths[i], 'bob')
+            for i in range(10)
+        ])
+        self.settings = FakeSettings()
+        site = FakeSite(paths, self.settings)
+        storage = SqliteStorageBackend(site, FakeRequest())
+        storage.directory = self.directory
+        storage.initialize()
+        storage.saveSubscription(Subscription('/plone', True))
+        storage.terminate()
+        self.gatherer = UserActionGathererBackend(site, FakeRequest(),
+                                                  self.manager, storage,
+                                                  window=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unlimited(self):
+        notifications = self.gatherer.getNewNotifications(self.start)
+        self.assertEqual(len(notifications), 10)
+        self.assertIsNone(self.gatherer.resumeFrom)
+        self.assertIsNone(self.gatherer.gatheredUntil)
+
+    def test_resume(self):
+        self.settings.gather_max_useractions = 4
+        notifications = self.gatherer.getNewNotifications(self.start)
+        self.assertEqual([n.where for n in notifications],
+                         ['/plone/doc%d' % i for i in range(4)])
+        resumeFrom = self.gatherer.resumeFrom
+        self.assertEqual(resumeFrom,
+                         self.start + datetime.timedelta(minutes=4))
+        notifications = self.gatherer.getNewNotifications(resumeFrom)
+        self.assertEqual(notifications[0].where, '/plone/doc4')
+        self.assertEqual(len(notifications), 4)
+
+    def test_no_overlap(self):
+        self.settings.gather_max_useractions = 4
+        self.manager.add(FakeUserAction(
+            10, 'created', self.start + datetime.timedelta(minutes=3),
+            '/plone/doc9', 'alice'
+        ))
+        gathered = []
+        since = self.start
+        while since is not None:
+            gathered += self.gatherer.getNewNotifications(since)
+            since = self.gatherer.resumeFrom
+        self.assertEqual(len(gathered), 11)
+
+    def test_same_second(self):
+        # Stopping would resume from where it started
+        self.settings.gather_max_useractions = 1
+        for i in range(10, 13):
+            self.manager.add(FakeUserAction(i, 'created', self.start,
+                                            '/plone/doc%d' % (i - 10),
+                                            'alice'))
+        notifications = self.gatherer.getNewNotifications(self.start)
+        self.assertEqual(len(notifications), 4)
+        self.assertEqual(self.gatherer.resumeFrom,
+                         self.start + datetime.timedelta(minutes=1))
+
+
+class TestGatherWindow(base.UnitTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.start = datetime.datetime.now() - datetime.timedelta(minutes=10)
+        paths = ['/plone/doc%d' % i for i in range(6)]
+        self.manager = FakeUserActionManager([
+            FakeUserAction(i, 'created',
+                           self.start + datetime.timedelta(minutes=i),
+                           paths[i], 'bob')
+            for i in range(5)
+        ])
+        self.settings = FakeSettings()
+        site = FakeSite(paths, self.settings)
+        storage = SqliteStorageBackend(site, FakeRequest())
+        storage.directory = self.directory
+        storage.initialize()
+        storage.saveSubscription(Subscription('/plone', True))
+        storage.terminate()
+        self.window = UserActionWindow(window=3600, interval=60)
+        self.gatherer = UserActionGathererBackend(site, FakeRequest(),
+                                                  self.manager, storage,
+                                                  self.window)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_window(self):
+        notifications = self.gatherer.getNewNotifications(self.start)
+        self.assertEqual(len(notifications), 5)
+        self.assertIsNone(self.gatherer.resumeFrom)
+        gatheredUntil = self.gatherer.gatheredUntil
+        self.assertTrue(gatheredUntil > self.start)
+        # Stored after the refresh of the window
+        self.manager.add(FakeUserAction(5, 'created', gatheredUntil,
+                                        '/plone/doc5', 'bob'))
+        self.window.interval = 0
+        notifications = self.gatherer.getNewNotifications(gatheredUntil)
+        self.assertEqual([n.where for n in notifications], ['/plone/doc5'])
+        self.assertTrue(self.gatherer.gatheredUntil >= gatheredUntil)
+
+    def test_budget(self):
+        self.settings.gather_max_useractions = 2
+        notifications = self.gatherer.getNewNotifications(self.start)
+        self.assertEqual(len(notifications), 2)
+        self.assertEqual(self.gatherer.resumeFrom,
+                         self.start + datetime.timedelta(minutes=2))
+        self.assertIsNone(self.gatherer.gatheredUntil)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
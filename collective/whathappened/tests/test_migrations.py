@@ -0,0 +1,118 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import unittest2 as unittest
+
+from collective.whathappened.tests import base
+from collective.whathappened import migrations
+
+OLD_SCHEMA = """
+    CREATE TABLE notifications(`what` TEXT, `when` INTEGER, `where` TEXT,
+                               `seen` INTEGER, `gatherer` TEXT,
+                               PRIMARY KEY(`what`, `when`, `where`));
+    CREATE TABLE notifications_who(`what` TEXT, `when` INTEGER,
+                                   `where` TEXT, `who` TEXT,
+                                   PRIMARY KEY(`what`, `when`, `where`,
+                                               `who`));
+    CREATE TABLE subscriptions(`where` TEXT PRIMARY KEY, `wants` INTEGER);
+    INSERT INTO notifications VALUES ('created', 100, '/plone/doc', 0,
+                                      'useraction');
+    INSERT INTO notifications_who VALUES ('created', 100, '/plone/doc',
+                                          'alice');
+"""
+
+
+class TestMigrations(base.UnitTestCase):
+
+    def setUp(self):
+        super(TestMigrations, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'alice.sqlite')
+        db = sqlite3.connect(self.path)
+        db.executescript(OLD_SCHEMA)
+        db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _version(self, path):
+        db = sqlite3.connect(path)
+        try:
+            return migrations.getVersion(db)
+        finally:
+            db.close()
+
+    def test_migrate(self):
+        db = sqlite3.connect(self.path)
+        self.assertEqual(migrations.migrate(db), (0, migrations.VERSION))
+        self.assertEqual(migrations.migrate(db),
+                         (migrations.VERSION, migrations.VERSION))
+        who = db.execute("""SELECT a.`name` FROM notifications_who nw
+                            INNER JOIN actors a ON a.`id` = nw.`actor`
+                         """).fetchall()
+        self.assertEqual(who, [('alice',)])
+        db.close()
+
+    def test_mailed(self):
+        db = sqlite3.connect(self.path)
+        for number, migration in migrations.MIGRATIONS:
+            if number < 8:
+                migration(db)
+        db.execute("""INSERT INTO notifications (`what`, `when`, `where`,
+                                                 `seen`)
+                      VALUES ('created', 200, '/plone/new', 0)""")
+        db.execute("INSERT INTO meta VALUES ('mailed_until', 1)")
+        migrations._addMailed(db)
+        mailed = db.execute("SELECT `where`, `mailed` FROM notifications "
+                            "ORDER BY `id`").fetchall()
+        self.assertEqual(mailed, [('/plone/doc', 1), ('/plone/new', 0)])
+        self.assertEqual(db.execute("SELECT * FROM meta").fetchall(), [])
+        db.close()
+
+    def test_new_storage(self):
+        db = sqlite3.connect(os.path.join(self.directory, 'bob.sqlite'))
+        self.assertEqual(migrations.getVersion(db), None)
+        migrations.migrate(db)
+        self.assertEqual(migrations.getVersion(db), migrations.VERSION)
+        db.close()
+
+    def test_storage_id(self):
+        db = sqlite3.connect(self.path)
+        migrations.migrate(db)
+        storageId = db.execute("SELECT `value` FROM meta "
+                               "WHERE `key` = 'storage_id'").fetchone()
+        self.assertNotEqual(storageId, None)
+        db.close()
+
+    def test_created_again(self):
+        created = []
+        path = os.path.join(self.directory, 'bob.sqlite')
+        for i in range(2):
+            db = sqlite3.connect(path)
+            migrations.ensureCurrent(db, path, created.append)
+            migrations.ensureCurrent(db, path, created.append)
+            db.close()
+            os.remove(path)
+        self.assertEqual(len(created), 2)
+
+    def test_run(self):
+        with open(os.path.join(self.directory, 'broken.sqlite'), 'w') as f:
+            f.write('not a database' * 100)
+        checkpoint = os.path.join(self.directory, 'checkpoint.json')
+        out = open(os.devnull, 'w')
+        failures = migrations.run(self.directory, 1, checkpoint, dryRun=True,
+                                  out=out)
+        self.assertEqual(failures.keys(),
+                         [os.path.join(self.directory, 'broken.sqlite')])
+        self.assertEqual(self._version(self.path), 0)
+        migrations.run(self.directory, 1, checkpoint, out=out)
+        self.assertEqual(self._version(self.path), migrations.VERSION)
+        self.assertEqual(migrations._loadCheckpoint(checkpoint),
+                         {self.path: migrations.VERSION})
+        out.close()
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
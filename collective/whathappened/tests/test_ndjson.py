@@ -0,0 +1,78 @@
+import datetime
+import os
+import StringIO
+
+import unittest2 as unittest
+
+from collective.whathappened.tests import base
+from collective.whathappened.ndjson import exportStorages
+from collective.whathappened.ndjson import importStorages
+from collective.whathappened.notification import Notification
+from collective.whathappened.storage_backend import GATHERED_UNTIL
+from collective.whathappened.storage_backend import LAST_GATHER
+from collective.whathappened.storage_manager import StorageManager
+from collective.whathappened.subscription import Subscription
+
+
+class TestNDJSON(base.IntegrationTestCase):
+
+    def setUp(self):
+        super(TestNDJSON, self).setUp()
+        self.storage = StorageManager(self.portal, self.request)
+        self.storage.setUser('test_ndjson_user')
+        self.storage.initialize()
+        self.db_path = self.storage.backend.db_path
+        self.storage.saveSubscriptions([Subscription('/plone/a', True),
+                                        Subscription('/plone/b', False)])
+        now = datetime.datetime.now()
+        for i in range(5):
+            self.storage.storeNotification(Notification(
+                'created',
+                '/plone/a/doc%d' % i,
+                now - datetime.timedelta(minutes=i),
+                ['alice', 'bob'],
+                'test_ndjson_user',
+                'useraction',
+                info={'title': 'Document %d' % i},
+                # A coalesced notification
+                count=3 if i == 4 else 1,
+            ))
+        self.storage.setSeen('/plone/a/doc0')
+        mailed = self.storage.getUnmailedNotifications(limit=2)
+        self.storage.setMailed([n.id for n in mailed])
+        self.storage.setMeta(LAST_GATHER, 1234)
+        self.storage.setMeta(GATHERED_UNTIL, '2015-01-02 03:04:05.000006')
+        self.storage.terminate()
+
+    def tearDown(self):
+        os.remove(self.db_path)
+
+    def export(self):
+        out = StringIO.StringIO()
+        exportStorages(self.storage, ['test_ndjson_user'], out)
+        return out.getvalue()
+
+    def test_round_trip(self):
+        exported = self.export()
+        self.assertEqual(len(exported.splitlines()), 9)
+        os.remove(self.db_path)
+        self.assertEqual(importStorages(self.storage,
+                                        StringIO.StringIO(exported),
+                                        batch=3), 9)
+        self.assertEqual(self.export(), exported)
+        self.storage.initialize()
+        self.assertEqual(self.storage.getUnseenCount(), 4)
+        self.assertEqual(len(self.storage.getUnmailedNotifications()), 2)
+        self.assertEqual(self.storage.getMeta(LAST_GATHER), 1234)
+        self.assertEqual(self.storage.getMeta(GATHERED_UNTIL),
+                         '2015-01-02 03:04:05.000006')
+        self.storage.terminate()
+
+    def test_import_twice(self):
+        exported = self.export()
+        importStorages(self.storage, StringIO.StringIO(exported))
+        self.assertEqual(self.export(), exported)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
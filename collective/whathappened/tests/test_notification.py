@@ -0,0 +1,83 @@
+import datetime
+import pickle
+import time
+
+import unittest2 as unittest
+
+from collective.whathappened.codec import encode
+from collective.whathappened.notification import Notification
+from collective.whathappened.notification import parseId
+from collective.whathappened.subscription import Subscription
+from collective.whathappened.tests import base
+
+
+class TestNotification(base.UnitTestCase):
+
+    def setUp(self):
+        self.when = datetime.datetime(2015, 3, 4, 5, 6, 7)
+        self.timestamp = int(time.mktime(self.when.timetuple()))
+
+    def _notification(self, when, **kwargs):
+        return Notification('Created', '/plone/folder/doc-1', when,
+                            ['alice'], 'bob', 'useraction', **kwargs)
+
+    def test_lazy_when(self):
+        notification = self._notification(self.timestamp)
+        self.assertIsNone(notification._when)
+        self.assertEqual(notification.getWhenTimestamp(), self.timestamp)
+        self.assertEqual(notification.when, self.when)
+        notification = self._notification(self.when)
+        self.assertIsNone(notification._timestamp)
+        self.assertEqual(notification.getWhenTimestamp(), self.timestamp)
+
+    def test_lazy_id(self):
+        notification = self._notification(self.timestamp)
+        self.assertIsNone(notification._id)
+        self.assertEqual(notification.id,
+                         '2015-03-04-05-06-07-created-/plone/folder/doc-1')
+        self.assertEqual(notification.getId(), notification.id)
+
+    def test_lazy_info(self):
+        info, infoHash = encode({'title': 'Doc'})
+        notification = self._notification(self.timestamp, rawInfo=info)
+        self.assertIsNone(notification._info)
+        self.assertEqual(notification.info, {'title': 'Doc'})
+        self.assertIsNone(notification._rawInfo)
+        notification.info = {'title': 'Other'}
+        self.assertEqual(notification.info, {'title': 'Other'})
+
+    def test_parse_id(self):
+        notification = self._notification(self.timestamp)
+        self.assertEqual(parseId(notification.id),
+                         ('created', self.timestamp, '/plone/folder/doc-1'))
+
+    def test_equality(self):
+        notification = self._notification(self.timestamp)
+        other = self._notification(self.timestamp)
+        # Compared by identity, like before they were slotted
+        self.assertEqual(notification, notification)
+        self.assertNotEqual(notification, other)
+        self.assertEqual(notification.id, other.id)
+        self.assertFalse(hasattr(notification, '__dict__'))
+
+    def test_pickle(self):
+        info, infoHash = encode({'title': 'Doc'})
+        notification = self._notification(self.timestamp, rawInfo=info,
+                                          count=3, mailed=True)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            loaded = pickle.loads(pickle.dumps(notification, protocol))
+            self.assertEqual(loaded.id, notification.id)
+            self.assertEqual(loaded.when, self.when)
+            self.assertEqual(loaded.who, ['alice'])
+            self.assertEqual(loaded.info, {'title': 'Doc'})
+            self.assertEqual(loaded.count, 3)
+            self.assertTrue(loaded.mailed)
+        subscription = Subscription('/plone/folder', True)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            loaded = pickle.loads(pickle.dumps(subscription, protocol))
+            self.assertEqual((loaded.where, loaded.wants),
+                             ('/plone/folder', True))
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,71 @@
+import unittest2 as unittest
+
+from collective.whathappened import resolver
+from collective.whathappened.tests import base
+
+
+class FakeBackend(object):
+
+    def __init__(self, valid=True):
+        self.valid = valid
+
+
+class FakeFallback(object):
+
+    def __init__(self, context, request):
+        self.context = context
+
+
+class FakeContext(object):
+    REQUEST = None
+
+    def __init__(self, valid=True):
+        self.valid = valid
+        self.traversed = []
+
+    def restrictedTraverse(self, name):
+        self.traversed.append(name)
+        return FakeBackend(self.valid)
+
+
+def validate(backend):
+    validate.calls += 1
+    return backend.valid
+
+
+class TestResolveBackend(base.UnitTestCase):
+
+    def setUp(self):
+        resolver.invalidate()
+        validate.calls = 0
+
+    def tearDown(self):
+        resolver.invalidate()
+
+    def resolve(self, context):
+        return resolver.resolveBackend(context, None, 'backend',
+                                       validate=validate,
+                                       fallback=FakeFallback)
+
+    def test_traversed_each_time(self):
+        context = FakeContext()
+        first = self.resolve(context)
+        second = self.resolve(context)
+        self.assertIsInstance(first, FakeBackend)
+        self.assertIsNot(first, second)
+        self.assertEqual(context.traversed, ['backend', 'backend'])
+        # Only validated once
+        self.assertEqual(validate.calls, 1)
+
+    def test_fallback(self):
+        context = FakeContext(valid=False)
+        self.assertIsInstance(self.resolve(context), FakeFallback)
+        self.assertIsInstance(self.resolve(context), FakeFallback)
+        self.assertEqual(context.traversed, ['backend'])
+        resolver.invalidate()
+        context.valid = True
+        self.assertIsInstance(self.resolve(context), FakeBackend)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
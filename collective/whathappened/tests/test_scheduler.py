@@ -0,0 +1,131 @@
+import datetime
+import shutil
+import tempfile
+
+import unittest2 as unittest
+
+from collective.whathappened import scheduler
+from collective.whathappened.browser.notifications import \
+    _updateNotifications
+from collective.whathappened.gatherer_backend import UserActionGathererBackend
+from collective.whathappened.gatherer_manager import GathererManager
+from collective.whathappened.scheduler import GatherScheduler
+from collective.whathappened.storage_backend import GATHER_CURSOR
+from collective.whathappened.storage_backend import SqliteStorageBackend
+from collective.whathappened.subscription import Subscription
+from collective.whathappened.tests import base
+from collective.whathappened.tests.fake import FakeRequest
+from collective.whathappened.tests.fake import FakeSite
+from collective.whathappened.tests.fake import FakeUserAction
+from collective.whathappened.tests.fake import FakeUserActionManager
+from collective.whathappened.useraction_window import UserActionWindow
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestGatherScheduler(base.UnitTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = GatherScheduler(minInterval=10, maxInterval=600,
+                                         clock=self.clock)
+
+    def _gather(self, user, hit, subscriptions=0):
+        if self.scheduler.due(user):
+            self.scheduler.record(user, hit, subscriptions)
+            return True
+        return False
+
+    def test_active_user(self):
+        self.assertTrue(self._gather('bob', True))
+        self.clock.now += 5
+        self.assertFalse(self._gather('bob', True))
+        self.clock.now += 5
+        self.assertTrue(self._gather('bob', True))
+
+    def test_back_off(self):
+        self.assertTrue(self._gather('bob', False))
+        for i in range(10):
+            self.scheduler.record('bob', False, 0)
+        activity = self.scheduler.users['bob']
+        self.assertTrue(self.scheduler.interval(activity) > 500)
+        self.clock.now += 60
+        self.assertFalse(self._gather('bob', False))
+        # Many subscriptions gather more often
+        activity.subscriptions = 200
+        self.assertTrue(self.scheduler.interval(activity) < 100)
+
+    def test_back_after_a_while(self):
+        for i in range(10):
+            self.scheduler.record('bob', False, 0)
+        self.assertFalse(self.scheduler.due('bob'))
+        self.clock.now += 600
+        self.assertTrue(self.scheduler.due('bob'))
+        self.assertEqual(self.scheduler.users['bob'].hitRate, 1.0)
+
+    def test_limit(self):
+        self.scheduler.limit = 2
+        self.assertTrue(self._gather('alice', True))
+        self.assertTrue(self._gather('bob', True))
+        self.assertFalse(self._gather('carol', True))
+        self.clock.now += 60
+        self.assertTrue(self._gather('carol', True))
+
+    def test_size(self):
+        self.scheduler.size = 2
+        for user in ['alice', 'bob', 'alice', 'carol']:
+            self.scheduler.due(user)
+        self.assertEqual(list(self.scheduler.users), ['alice', 'carol'])
+
+
+class TestScheduledGathering(base.UnitTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        when = datetime.datetime.now() - datetime.timedelta(minutes=5)
+        manager = FakeUserActionManager([
+            FakeUserAction(1, 'created', when, '/plone/doc', 'bob')
+        ])
+        self.site = FakeSite(['/plone/doc'])
+        self.storage = SqliteStorageBackend(self.site, FakeRequest())
+        self.storage.directory = self.directory
+        self.storage.initialize()
+        self.storage.saveSubscription(Subscription('/plone', True))
+        self.storage.terminate()
+        self.storage.initialize()
+        storage = SqliteStorageBackend(self.site, FakeRequest())
+        storage.directory = self.directory
+        backend = UserActionGathererBackend(self.site, FakeRequest(),
+                                            manager, storage,
+                                            UserActionWindow(interval=0))
+        self.gatherer = GathererManager(self.site, FakeRequest())
+        self.gatherer.backends = [backend]
+        scheduler._schedulers.clear()
+        self.scheduler = scheduler.getScheduler(self.site)
+
+    def tearDown(self):
+        self.storage.terminate()
+        shutil.rmtree(self.directory)
+        scheduler._schedulers.clear()
+
+    def test_idle_user_backs_off(self):
+        _updateNotifications(self.site, self.storage, self.gatherer)
+        self.assertEqual(len(self.storage.getAllNotifications()), 1)
+        activity = self.scheduler.users['admin']
+        interval = self.scheduler.interval(activity)
+        # The window gathers nothing new
+        for i in range(5):
+            _updateNotifications(self.site, self.storage, self.gatherer)
+        self.assertIsNone(self.storage.getMeta(GATHER_CURSOR))
+        self.assertTrue(self.scheduler.interval(activity) > interval * 10)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,294 @@
+import datetime
+import os
+import time
+
+import unittest2 as unittest
+
+from ZPublisher.pubevents import PubSuccess
+
+from collective.whathappened.tests import base
+from collective.whathappened.notification import Notification
+from collective.whathappened.storage_manager import getRequestStorage
+from collective.whathappened.storage_manager import requestEnded
+from collective.whathappened.subscription import Subscription
+
+
+class TestSqliteStorage(base.IntegrationTestCase):
+    """Test the sqlite storage backend against a throwaway user store."""
+
+    def setUp(self):
+        super(TestSqliteStorage, self).setUp()
+        self.storage = self.portal.restrictedTraverse(
+            'collective.whathappened.backend.sqlite'
+        )
+        self.storage.setUser('test_storage_user')
+        self.storage.initialize()
+        self.now = datetime.datetime.now().replace(microsecond=0)
+
+    def tearDown(self):
+        self.storage.terminate()
+        os.remove(self.storage.db_path)
+
+    def _notification(self, where, minutes=0, who=None, info=None):
+        return Notification(
+            'created',
+            where,
+            self.now - datetime.timedelta(minutes=minutes),
+            who or ['alice'],
+            'test_storage_user',
+            'useraction',
+            info=info,
+        )
+
+    def test_get_notifications(self):
+        for i in range(7):
+            self.storage.storeNotification(
+                self._notification('/plone/doc%d' % i, minutes=i)
+            )
+        self.storage.setSeen('/plone/doc0')
+        hot = self.storage.getHotNotifications()
+        self.assertEqual(len(hot), 5)
+        self.assertEqual(hot[0].where, '/plone/doc1')
+        self.assertFalse(any(n.seen for n in hot))
+        self.assertEqual(len(self.storage.getAllNotifications()), 7)
+        self.assertEqual(len(self.storage.getUnseenNotifications()), 6)
+        self.assertEqual(self.storage.getUnseenCount(), 6)
+
+    def test_who_and_info(self):
+        self.storage.storeNotification(
+            self._notification('/plone/doc', who=['alice', 'bob'],
+                               info={'title': 'Doc'})
+        )
+        notification = self.storage.getAllNotifications()[0]
+        self.assertEqual(sorted(notification.who), ['alice', 'bob'])
+        self.assertEqual(notification.info, {'title': 'Doc'})
+        self.assertEqual(notification.when, self.now)
+
+    def test_actors_of_rolled_back_session(self):
+        # Commit the storage id
+        self.storage.terminate()
+        self.storage.initialize()
+        self.storage.storeNotification(
+            self._notification('/plone/doc1', who=['carol'])
+        )
+        self.storage.db.rollback()
+        self.storage.db.close()
+        self.storage.db = None
+        self.storage.initialize()
+        # carol's id, never committed, is given to dave
+        self.storage.storeNotification(
+            self._notification('/plone/doc2', who=['dave'])
+        )
+        self.storage.storeNotification(
+            self._notification('/plone/doc3', who=['carol'])
+        )
+        self.storage.terminate()
+        self.storage.initialize()
+        who = dict((n.where, n.who)
+                   for n in self.storage.getAllNotifications())
+        self.assertEqual(who, {'/plone/doc2': ['dave'],
+                               '/plone/doc3': ['carol']})
+
+    def test_unmailed(self):
+        for i in range(3):
+            self.storage.storeNotification(
+                self._notification('/plone/doc%d' % i, minutes=i)
+            )
+        unmailed = self.storage.getUnmailedNotifications(limit=2)
+        self.assertEqual([n.where for n in unmailed],
+                         ['/plone/doc0', '/plone/doc1'])
+        self.storage.setMailed([n.id for n in unmailed])
+        unmailed = self.storage.getUnmailedNotifications()
+        self.assertEqual([n.where for n in unmailed], ['/plone/doc2'])
+        # Merged with a new one, it is mailed again
+        self.storage.storeNotification(
+            self._notification('/plone/doc0', who=['bob'])
+        )
+        unmailed = self.storage.getUnmailedNotifications()
+        self.assertEqual([n.where for n in unmailed],
+                         ['/plone/doc0', '/plone/doc2'])
+        self.assertEqual(sorted(unmailed[0].who), ['alice', 'bob'])
+
+    def test_iter_notifications(self):
+        for i in range(5):
+            self.storage.storeNotification(
+                self._notification('/plone/doc%d' % i, minutes=i)
+            )
+        self.storage.setSeen('/plone/doc0')
+        notifications = list(self.storage.iterNotifications(batch=2))
+        self.assertEqual([n.where for n in notifications],
+                         ['/plone/doc%d' % i for i in range(5)])
+        self.assertTrue(notifications[0].seen)
+
+    def test_archive(self):
+        for i in range(4):
+            self.storage.storeNotification(self._notification(
+                '/plone/folder%d/doc' % (i % 2), minutes=i * 60 * 24,
+                who=['alice', 'bob'], info={'title': 'Doc %d' % i}
+            ))
+        self.storage.setSeen()
+        self.storage.storeNotification(
+            self._notification('/plone/unseen', minutes=10 * 60 * 24)
+        )
+        before = time.mktime(self.now.timetuple()) - 36 * 3600
+        self.assertFalse(self.storage.hasArchivedNotifications())
+        self.assertEqual(self.storage.archiveNotifications(before), 2)
+        self.assertTrue(self.storage.hasArchivedNotifications())
+        self.assertTrue(
+            self.storage.hasArchivedNotifications('/plone/folder0')
+        )
+        self.assertFalse(self.storage.hasArchivedNotifications('/plone/un'))
+        remaining = [n.where for n in self.storage.getAllNotifications()]
+        self.assertEqual(remaining, ['/plone/folder0/doc',
+                                     '/plone/folder1/doc', '/plone/unseen'])
+        archived = self.storage.getArchivedNotifications()
+        self.assertEqual([n.info for n in archived],
+                         [{'title': 'Doc 2'}, {'title': 'Doc 3'}])
+        self.assertEqual(sorted(archived[0].who), ['alice', 'bob'])
+        self.assertTrue(archived[0].seen)
+        self.assertEqual(len(list(self.storage.iterNotifications())), 5)
+        self.storage.removeNotifications('/plone/folder1')
+        archived = self.storage.getArchivedNotifications()
+        self.assertEqual([n.info for n in archived], [{'title': 'Doc 2'}])
+
+    def test_tree_notifications(self):
+        for where in ['/plone/folder', '/plone/folder/doc',
+                      '/plone/folder/sub/doc', '/plone/folder-2',
+                      '/plone/folderbis']:
+            self.storage.storeNotification(self._notification(where))
+        tree = [n.where for n in
+                self.storage.getAllNotifications('/plone/folder')]
+        self.assertEqual(sorted(tree), ['/plone/folder', '/plone/folder/doc',
+                                        '/plone/folder/sub/doc'])
+        self.storage.setSeen('/plone/folder/sub', subtree=True)
+        self.assertEqual(self.storage.getUnseenCount('/plone/folder'), 2)
+        self.assertEqual(self.storage.getUnseenCount(), 4)
+        self.storage.setSeen()
+        before = time.mktime(self.now.timetuple()) + 60
+        self.assertEqual(self.storage.archiveNotifications(before), 5)
+        archived = self.storage.getArchivedNotifications(path='/plone/folder')
+        archived = [n.where for n in archived]
+        self.assertEqual(sorted(archived), ['/plone/folder',
+                                            '/plone/folder/doc',
+                                            '/plone/folder/sub/doc'])
+
+    def test_set_seen(self):
+        for where in ['/plone/folder', '/plone/folder/doc',
+                      '/plone/folder-2', '/plone/other']:
+            self.storage.storeNotification(self._notification(where))
+        self.storage.setSeen('/plone/folder', subtree=True)
+        unseen = [n.where for n in self.storage.getUnseenNotifications()]
+        self.assertEqual(sorted(unseen), ['/plone/folder-2', '/plone/other'])
+        notification = self._notification('/plone/other')
+        self.storage.setSeen(ids=[notification.getId()])
+        unseen = [n.where for n in self.storage.getUnseenNotifications()]
+        self.assertEqual(unseen, ['/plone/folder-2'])
+        self.storage.setSeen()
+        self.assertEqual(self.storage.getUnseenCount(), 0)
+
+    def test_blacklist_purges_subtree(self):
+        for where in ['/plone/folder', '/plone/folder/doc',
+                      '/plone/folderbis', '/plone/folder-2']:
+            self.storage.storeNotification(self._notification(where))
+        self.storage.saveSubscription(Subscription('/plone/folder', False))
+        remaining = [n.where for n in self.storage.getAllNotifications()]
+        self.assertEqual(sorted(remaining),
+                         ['/plone/folder-2', '/plone/folderbis'])
+        orphans = self.storage.db.execute(
+            """SELECT COUNT(*) FROM notifications_who WHERE `notification`
+               NOT IN (SELECT `id` FROM notifications)""").fetchone()[0]
+        self.assertEqual(orphans, 0)
+
+    def test_save_subscriptions(self):
+        for where in ['/plone/a/doc', '/plone/a/b/doc', '/plone/c/doc']:
+            self.storage.storeNotification(self._notification(where))
+        self.storage.saveSubscription(Subscription('/plone/c', True))
+        changed = self.storage.saveSubscriptions([
+            Subscription('/plone/a', False),
+            Subscription('/plone/a/b', False),
+            Subscription('/plone/c', True),
+            Subscription('/plone/d', True),
+        ])
+        self.assertEqual([s.where for s in changed],
+                         ['/plone/a', '/plone/a/b', '/plone/d'])
+        remaining = [n.where for n in self.storage.getAllNotifications()]
+        self.assertEqual(remaining, ['/plone/c/doc'])
+        changed = self.storage.saveSubscriptions([
+            Subscription('/plone/a', None),
+            Subscription('/plone/e', None),
+        ])
+        self.assertEqual([s.where for s in changed], ['/plone/a'])
+        subscriptions = self.storage.getSubscriptions()
+        self.assertEqual(sorted(s.where for s in subscriptions),
+                         ['/plone/a/b', '/plone/c', '/plone/d'])
+
+    def test_shared_subscriptions(self):
+        changed = self.storage.saveSharedSubscriptions('group:staff', [
+            Subscription('/plone/a', True),
+            Subscription('/plone/b', False),
+        ])
+        self.assertEqual(len(changed), 2)
+        self.storage.saveSharedSubscriptions('role:Reviewer', [
+            Subscription('/plone/c', True),
+        ])
+        shared = self.storage.getSharedSubscriptions(['group:staff'])
+        self.assertEqual(sorted((p, s.where, s.wants) for p, s in shared),
+                         [('group:staff', '/plone/a', True),
+                          ('group:staff', '/plone/b', False)])
+        self.storage.saveSharedSubscriptions('group:staff', [
+            Subscription('/plone/a', None),
+            Subscription('/plone/b', None),
+        ])
+        self.storage.saveSharedSubscriptions('role:Reviewer', [
+            Subscription('/plone/c', None),
+        ])
+        shared = self.storage.getSharedSubscriptions(['group:staff',
+                                                      'role:Reviewer'])
+        self.assertEqual(shared, [])
+
+    def test_subscriptions_in_tree(self):
+        self.storage.saveSubscription(Subscription('/plone/folder', True))
+        self.storage.saveSubscription(Subscription('/plone/folder/sub/doc',
+                                                   False))
+        self.storage.saveSubscription(Subscription('/plone/other', True))
+        subscriptions = self.storage.getSubscriptionsInTree(
+            '/plone/folder/sub/doc'
+        )
+        self.assertEqual(sorted(subscriptions.keys()),
+                         ['/plone/folder', '/plone/folder/sub/doc'])
+        self.assertFalse(subscriptions['/plone/folder/sub/doc'].wants)
+
+    def test_stats(self):
+        for i in range(3):
+            self.storage.storeNotification(
+                self._notification('/plone/doc%d' % i, minutes=i)
+            )
+        self.storage.setSeen('/plone/doc0')
+        self.storage.setMeta('last_gather', 1000)
+        self.assertEqual(self.storage.getMeta('last_gather'), 1000)
+        self.assertEqual(self.storage.getMeta('missing', 0), 0)
+        self.storage.terminate()
+        self.assertIn('test_storage_user', self.storage.listUsers())
+        stats = self.storage.getStats()
+        self.assertEqual(stats['notifications'], 3)
+        self.assertEqual(stats['unseen'], 2)
+        self.assertEqual(stats['last_gather'], 1000)
+        self.assertEqual(stats['user'], 'test_storage_user')
+        self.assertIs(self.storage.getStats(refresh=False), stats)
+        self.storage.initialize()
+
+
+class TestRequestStorage(base.IntegrationTestCase):
+
+    def test_one_storage_per_request(self):
+        storage = getRequestStorage(self.portal, self.request)
+        self.assertTrue(getRequestStorage(self.portal, self.request)
+                        is storage)
+        self.assertNotEqual(storage.backend.db, None)
+        requestEnded(PubSuccess(self.request))
+        self.assertEqual(storage.backend.db, None)
+        os.remove(storage.backend.db_path)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,47 @@
+import unittest2 as unittest
+
+from collective.whathappened.tests import base
+from collective.whathappened.subscription import Subscription
+from collective.whathappened.subscription import findSubscription
+from collective.whathappened.subscription import mergeShared
+
+
+class TestFindSubscription(base.UnitTestCase):
+
+    def _subscriptions(self, *subscriptions):
+        return dict((where, Subscription(where, wants))
+                    for where, wants in subscriptions)
+
+    def test_own(self):
+        own = self._subscriptions(('/plone/a', True), ('/plone/a/b', False))
+        self.assertFalse(findSubscription('/plone/a/b/doc', own).wants)
+        self.assertTrue(findSubscription('/plone/a/doc', own).wants)
+        self.assertIsNone(findSubscription('/plone/c', own))
+
+    def test_shared(self):
+        own = self._subscriptions(('/plone/a', True))
+        shared = self._subscriptions(('/plone/c', True),
+                                     ('/plone/a/b', False))
+        self.assertTrue(findSubscription('/plone/c/doc', own, shared).wants)
+        self.assertFalse(findSubscription('/plone/a/b/doc', own,
+                                          shared).wants)
+
+    def test_own_blacklist_wins(self):
+        own = self._subscriptions(('/plone/a', False))
+        shared = self._subscriptions(('/plone/a', True),
+                                     ('/plone/a/b', True))
+        self.assertFalse(findSubscription('/plone/a/b/doc', own,
+                                          shared).wants)
+
+    def test_merge_shared(self):
+        merged = mergeShared([
+            ('group:staff', Subscription('/plone/a', True)),
+            ('role:Reviewer', Subscription('/plone/a', False)),
+            ('group:staff', Subscription('/plone/b', True)),
+        ])
+        self.assertFalse(merged['/plone/a'].wants)
+        self.assertTrue(merged['/plone/b'].wants)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,53 @@
+import shutil
+import tempfile
+
+import unittest2 as unittest
+
+from zope import event
+
+from collective.whathappened.event import IBlacklistedEvent
+from collective.whathappened.event import ISubscribedEvent
+from collective.whathappened.event import ISubscriptionsChangedEvent
+from collective.whathappened.storage_backend import SqliteStorageBackend
+from collective.whathappened.subscription import Subscription
+from collective.whathappened.tests import base
+from collective.whathappened.tests.fake import FakeRequest
+from collective.whathappened.tests.fake import FakeSite
+
+
+class TestSubscriptionsChanged(base.UnitTestCase):
+
+    def setUp(self):
+        self.events = []
+        event.subscribers.append(self.events.append)
+        self.directory = tempfile.mkdtemp()
+        self.storage = SqliteStorageBackend(FakeSite([]), FakeRequest())
+        self.storage.directory = self.directory
+        self.storage.initialize()
+
+    def tearDown(self):
+        event.subscribers.remove(self.events.append)
+        self.storage.terminate()
+        shutil.rmtree(self.directory)
+
+    def test_one_event_per_save(self):
+        self.storage.saveSubscriptions([
+            Subscription('/plone/a', True),
+            Subscription('/plone/b', False),
+            Subscription('/plone/c', True),
+        ])
+        self.assertEqual(len(self.events), 1)
+        changed = self.events[0]
+        self.assertTrue(ISubscriptionsChangedEvent.providedBy(changed))
+        self.assertEqual([s.where for s in changed.subscriptions],
+                         ['/plone/a', '/plone/b', '/plone/c'])
+        self.assertFalse([e for e in self.events
+                          if ISubscribedEvent.providedBy(e) or
+                          IBlacklistedEvent.providedBy(e)])
+        # Nothing changed, nothing notified
+        self.storage.saveSubscriptions([Subscription('/plone/a', True)])
+        self.assertEqual(len(self.events), 1)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
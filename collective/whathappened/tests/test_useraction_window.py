@@ -0,0 +1,81 @@
+import datetime
+
+import unittest2 as unittest
+
+from collective.whathappened.tests import base
+from collective.whathappened.tests.fake import FakeUserAction
+from collective.whathappened.tests.fake import FakeUserActionManager
+from collective.whathappened.useraction_window import UserActionWindow
+
+
+class CountingManager(FakeUserActionManager):
+
+    searches = 0
+    window = None
+
+    def search(self, when=None, **query):
+        self.searches += 1
+        # The other gatherings are not blocked by the search
+        if self.window is not None:
+            assert not self.window.lock.locked()
+        return super(CountingManager, self).search(when, **query)
+
+
+class TestUserActionWindow(base.UnitTestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime.now()
+        self.manager = CountingManager([
+            self._useraction(i, minutes=10 - i) for i in range(10)
+        ])
+        self.window = UserActionWindow(window=3600, interval=0, margin=0)
+        self.manager.window = self.window
+
+    def _useraction(self, id, minutes):
+        return FakeUserAction(id, 'created',
+                              self.now - datetime.timedelta(minutes=minutes),
+                              '/plone/doc%d' % id, 'bob')
+
+    def _search(self, minutes):
+        since = self.now - datetime.timedelta(minutes=minutes)
+        return self.window.search(self.manager, since)
+
+    def test_search(self):
+        useractions, complete = self._search(5)
+        self.assertEqual([u.id for u in useractions], [5, 6, 7, 8, 9])
+        self.assertEqual(useractions[0].who, 'bob')
+        self.assertTrue(complete >= self.now)
+        self.assertIsNone(self._search(120))
+
+    def test_refresh(self):
+        self._search(5)
+        self.manager.add(self._useraction(10, minutes=0))
+        useractions, complete = self._search(5)
+        self.assertEqual([u.id for u in useractions], [5, 6, 7, 8, 9, 10])
+        self.assertEqual(self.manager.searches, 2)
+        self.window.interval = 60
+        self._search(5)
+        self.assertEqual(self.manager.searches, 2)
+
+    def test_margin(self):
+        self.window.margin = 150
+        useractions, complete = self._search(5)
+        # The useractions of the last 150 seconds may be committed late
+        self.assertEqual([u.id for u in useractions], [5, 6, 7])
+        self.assertTrue(complete < self.now)
+        self.manager.add(self._useraction(10, minutes=1.5))
+        useractions, complete = self._search(5)
+        self.assertEqual([u.id for u in self.window.useractions],
+                         [0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 9])
+        self.assertEqual([u.id for u in useractions], [5, 6, 7])
+
+    def test_size(self):
+        self.window.size = 4
+        useractions, complete = self._search(3)
+        self.assertEqual([u.id for u in useractions], [7, 8, 9])
+        # The older useractions are not cached anymore
+        self.assertIsNone(self._search(5))
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
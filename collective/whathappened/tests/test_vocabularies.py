@@ -0,0 +1,57 @@
+import unittest2 as unittest
+
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+
+from collective.whathappened.tests import base
+from collective.whathappened.storage_manager import StorageManager
+from collective.whathappened.subscription import Subscription
+from collective.whathappened.vocabularies import subscriptions
+
+
+class TestSubscriptionsVocabulary(base.IntegrationTestCase):
+
+    def setUp(self):
+        super(TestSubscriptionsVocabulary, self).setUp()
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        self.portal.invokeFactory('Folder', 'folder', title='Folder')
+        self.portal.invokeFactory('Document', 'doc', title='Document')
+        self.storage = StorageManager(self.portal, self.request)
+        self.storage.initialize()
+        self.portal_path = '/'.join(self.portal.getPhysicalPath())
+        for where, wants in [('', True), ('/folder', True), ('/doc', False),
+                             ('/removed', True)]:
+            self.storage.saveSubscription(
+                Subscription(self.portal_path + where, wants)
+            )
+        self.storage.terminate()
+
+    def tearDown(self):
+        self.storage.initialize()
+        for subscription in self.storage.getSubscriptions():
+            subscription.wants = None
+            self.storage.saveSubscription(subscription)
+        self.storage.terminate()
+
+    def test_titles(self):
+        vocabulary = subscriptions(self.portal)
+        paths = sorted(term.value for term in vocabulary)
+        self.assertEqual(paths, [self.portal_path,
+                                 self.portal_path + '/doc',
+                                 self.portal_path + '/folder'])
+        term = vocabulary.getTerm(self.portal_path + '/folder')
+        self.assertEqual(term.title, u'Folder')
+        term = vocabulary.getTerm(self.portal_path + '/doc')
+        self.assertEqual(term.title.mapping['title'], u'Document')
+
+    def test_removed_subscriptions_are_pruned(self):
+        subscriptions(self.portal)
+        self.storage.initialize()
+        paths = [s.where for s in self.storage.getSubscriptions()]
+        self.storage.terminate()
+        self.assertNotIn(self.portal_path + '/removed', paths)
+        self.assertEqual(len(paths), 3)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -1,4 +1,5 @@
 from plone.app.contentrules.handlers import execute
+from zope.component.hooks import getSite
 
 
 def subscribed(event):
@@ -9,3 +10,9 @@ def subscribed(event):
 def blacklisted(event):
     obj = event.object
     execute(obj, event)
+
+
+def subscriptionsChanged(event):
+    """Run the rules of the site once for all the subscriptions changed at
+    once, they are listed in event.subscriptions."""
+    execute(getSite(), event)
@@ -1,27 +1,19 @@
-import os
-import sqlite3
+import logging
 
 from Products.CMFCore.utils import getToolByName
 
-from collective.whathappened import config
-
 PROFILE = 'profile-collective.whathappened:default'
 
+logger = logging.getLogger('collective.whathappened')
+
 
 def common(context):
     setup = getToolByName(context, 'portal_setup')
     setup.runAllImportStepsFromProfile(PROFILE)
 
 
-def upgrade_db(context):
-    for file_name in os.listdir(config.sqlite_directory):
-        if file_name.endswith('.sqlite'):
-            try:
-                db = sqlite3.connect('%s/%s' % (config.sqlite_directory,
-                                                file_name))
-                db.execute("""ALTER TABLE notifications ADD
-                              `info` TEXT""")
-                db.commit()
-                db.close()
-            except:
-                pass
+def upgrade_storages(context):
+    """The storages are migrated when they are opened. Run the
+    whathappened-migrate script to migrate all of them at once."""
+    logger.info("Storages will be migrated when opened, or run "
+                "bin/whathappened-migrate to migrate them now.")
@@ -0,0 +1,165 @@
+"""Recent useractions, shared by the gatherings of all the users.
+
+Each gathering used to search the catalog for the useractions since the
+last check of its user, and these windows overlap almost completely. The
+process keeps the recent useractions in memory instead, ordered by time,
+and refreshes them at most every 'interval' seconds.
+Gatherings which start before the cached window search the catalog.
+
+There is a window per site and process, each ZEO client keeps its own.
+"""
+import bisect
+import datetime
+import threading
+import time
+
+from DateTime import DateTime
+from Products.CMFCore.utils import getToolByName
+from zope import interface
+
+from collective.history.useraction import IUserAction
+
+
+class RecentUserAction(object):
+    """The attributes of a useraction the gatherer uses, for its brain and
+    the useraction itself."""
+    interface.implements(IUserAction)
+
+    __slots__ = ('id', 'what', 'when', 'where_path', 'who', 'what_info')
+
+    def __init__(self, brain, useraction):
+        self.id = brain.id
+        self.what = brain.what
+        self.when = brain.when
+        self.where_path = brain.where_path
+        self.who = useraction.who
+        self.what_info = useraction.what_info
+
+
+class UserActionWindow(object):
+    """The useractions of the last 'window' seconds, 'size' at most.
+
+    A useraction is stored with the time it happened but only found once
+    its transaction is committed, which may be later. The useractions of
+    the last 'margin' seconds are searched again at each refresh and only
+    given to the gatherings once older than that."""
+
+    def __init__(self, window=3600, size=20000, interval=5, margin=30):
+        self.window = window
+        self.size = size
+        self.interval = interval
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.useractions = []
+        self.whens = []
+        # All the useractions after this datetime are cached
+        self.since = None
+        self.refreshed = None
+        self.refreshing = False
+
+    def refresh(self, manager):
+        """Add the useractions since the newest cached one or the last
+        refresh less the margin, if it is older than 'interval' seconds.
+        The catalog is searched outside the lock, the other threads
+        meanwhile use the cached useractions."""
+        now = time.time()
+        with self.lock:
+            if self.refreshing or (self.refreshed is not None and
+                                   now - self.refreshed < self.interval):
+                return
+            if self.refreshed is None:
+                start = datetime.datetime.fromtimestamp(now - self.window)
+            else:
+                start = datetime.datetime.fromtimestamp(self.refreshed -
+                                                        self.margin)
+                if self.whens:
+                    start = min(start, self.whens[-1])
+            known = set(useraction.id for useraction
+                        in self.useractions[bisect.bisect_left(self.whens,
+                                                               start):])
+            self.refreshing = True
+        found = None
+        try:
+            found = self._fetch(manager, start, known)
+        finally:
+            with self.lock:
+                self.refreshing = False
+                if found is not None:
+                    self._add(found, start, now)
+
+    def _fetch(self, manager, start, known):
+        """Return the useractions from 'start' which are not 'known'."""
+        found = []
+        brains = manager.search(when={
+            'query': DateTime(start),
+            'range': 'min'
+        }, sort_on='when')
+        for brain in brains:
+            if brain.id in known:
+                continue
+            try:
+                useraction = manager.get(brain.id)
+            except (KeyError, AttributeError):
+                continue
+            found.append(RecentUserAction(brain, useraction))
+        return found
+
+    def _add(self, found, start, now):
+        if self.since is None:
+            self.since = start - datetime.timedelta(microseconds=1)
+        for useraction in found:
+            # Committed late, it may be older than the cached ones
+            index = bisect.bisect_right(self.whens, useraction.when)
+            self.whens.insert(index, useraction.when)
+            self.useractions.insert(index, useraction)
+        self.refreshed = now
+        self._trim(datetime.datetime.fromtimestamp(now - self.window))
+
+    def _trim(self, oldest):
+        """Drop the useractions before 'oldest' and the oldest ones above
+        'size'."""
+        drop = bisect.bisect_left(self.whens, oldest)
+        drop = max(drop, len(self.whens) - self.size)
+        if drop <= 0:
+            return
+        # Drop all the useractions at the same time, so everything after
+        # 'since' is still cached.
+        last = self.whens[drop - 1]
+        drop = bisect.bisect_right(self.whens, last)
+        self.since = max(self.since, last)
+        del self.useractions[:drop]
+        del self.whens[:drop]
+
+    def search(self, manager, since):
+        """Return the useractions from 'since', oldest first, and the
+        datetime up to which they are complete, the last refresh less the
+        margin. Return None if the window does not go back to 'since'."""
+        self.refresh(manager)
+        with self.lock:
+            if self.since is None or since <= self.since:
+                return None
+            complete = datetime.datetime.fromtimestamp(self.refreshed -
+                                                       self.margin)
+            if complete < since:
+                return [], since
+            start = bisect.bisect_left(self.whens, since)
+            end = bisect.bisect_right(self.whens, complete)
+            return self.useractions[start:end], complete
+
+
+# Windows by site path
+_windows = {}
+_lock = threading.Lock()
+
+
+def getWindow(context):
+    """Return the window of the site of context."""
+    path = getToolByName(context, 'portal_url').getPortalPath()
+    window = _windows.get(path)
+    if window is None:
+        with _lock:
+            window = _windows.setdefault(path, UserActionWindow())
+    return window
@@ -27,7 +27,23 @@ class DefaultDisplay(object):
             self.where = where.split('/')[-1]
         self.who = ', '.join(notification.who)
         self.plural = True if len(notification.who) > 1 else False
-        if self.plural:
+        self.count = getattr(notification, 'count', 1)
+        if self.count > 1:
+            if self.plural:
+                return _(u"${who} have ${what} ${count} items in ${where}",
+                         mapping={'who': self.who,
+                                  'what': self.what,
+                                  'count': self.count,
+                                  'where': self.where
+                                  })
+            else:
+                return _(u"${who} has ${what} ${count} items in ${where}",
+                         mapping={'who': self.who,
+                                  'what': self.what,
+                                  'count': self.count,
+                                  'where': self.where
+                                  })
+        elif self.plural:
             return _(u"${who} have ${what} ${where}",
                      mapping={'who': self.who,
                               'what': self.what,
@@ -1,36 +1,94 @@
+from plone.memoize import ram
+from Products.CMFCore.utils import getToolByName
+from Products.CMFPlone.utils import safe_unicode
 from zope.schema.vocabulary import SimpleVocabulary, SimpleTerm
 
 from collective.whathappened.i18n import _
 from collective.whathappened.storage_manager import StorageManager
-from AccessControl.unauthorized import Unauthorized
 
 
-def _getTitle(context, subscription):
-    try:
-        content = context.restrictedTraverse(
-            subscription.where.encode('utf-8')
-        )
-    except Unauthorized:
-        return
-    except KeyError:
-        return
-    if subscription.wants:
-        return content.title
-    else:
-        return _(u'${title} (blocked)',
-                 mapping={'title': content.title})
+def _termsKey(func, context, user, subscriptions):
+    portal_url = getToolByName(context, 'portal_url')
+    catalog = getToolByName(context, 'portal_catalog')
+    # Titles are resolved again once contents changed
+    counter = getattr(catalog, 'getCounter', lambda: None)()
+    return (
+        portal_url.getPortalPath(),
+        user,
+        tuple(sorted((s.where, s.wants) for s in subscriptions)),
+        counter,
+    )
+
+
+def _getTitles(context, paths):
+    """Return the titles by path of the contents the user can view."""
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    portal_path = '/'.join(portal.getPhysicalPath())
+    titles = {}
+    if portal_path in paths:
+        titles[portal_path] = safe_unicode(portal.Title())
+    catalog = getToolByName(context, 'portal_catalog')
+    brains = catalog(path={'query': paths, 'depth': 0})
+    for brain in brains:
+        titles[brain.getPath()] = safe_unicode(brain.Title)
+    return titles
+
+
+def _getRemoved(context, paths):
+    """Return the paths which do not exist anymore, whoever the user is."""
+    catalog = getToolByName(context, 'portal_catalog')
+    brains = catalog.unrestrictedSearchResults(
+        path={'query': paths, 'depth': 0}
+    )
+    existing = set(brain.getPath() for brain in brains)
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    removed = []
+    for path in paths:
+        if path in existing:
+            continue
+        # Contents which are not cataloged, e.g. the portal itself
+        if portal.unrestrictedTraverse(path, None) is None:
+            removed.append(path)
+    return removed
+
+
+@ram.cache(_termsKey)
+def _getTerms(context, user, subscriptions):
+    """Return the (path, title) of the subscriptions to show, and the paths
+    of the subscriptions to removed contents."""
+    paths = [s.where.encode('utf-8') for s in subscriptions]
+    titles = _getTitles(context, paths)
+    terms = []
+    for s in subscriptions:
+        where = s.where.encode('utf-8')
+        title = titles.get(where)
+        if title is None:
+            continue
+        if not s.wants:
+            title = _(u'${title} (blocked)', mapping={'title': title})
+        terms.append((s.where, title))
+    missing = [path for path in paths if path not in titles]
+    removed = _getRemoved(context, missing) if missing else []
+    return terms, removed
 
 
 def subscriptions(context):
     storage = StorageManager(context)
     storage.initialize()
     subscriptions = storage.getSubscriptions()
+    user = storage.getUser()
+    terms, removed = _getTerms(context, user, subscriptions)
+    if removed:
+        storage.unsubscribe(removed)
     storage.terminate()
-    terms = []
-    for s in subscriptions:
-        title = _getTitle(context, s)
-        if title is None:
-            #TODO: delete subscription
-            continue
-        terms.append(SimpleTerm(s.where, s.where, title))
-    return SimpleVocabulary(terms)
+    return SimpleVocabulary([SimpleTerm(where, where, title)
+                             for where, title in terms])
+
+
+def coalesce_keys(context):
+    return SimpleVocabulary([
+        SimpleTerm('where', 'where', _(u"Same content")),
+        SimpleTerm('parent', 'parent', _(u"Same folder")),
+        SimpleTerm('who', 'who', _(u"Same users")),
+        SimpleTerm('gatherer', 'gatherer', _(u"Same gatherer")),
+    ])
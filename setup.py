@@ -44,5 +44,14 @@ setup(name='collective.whathappened',
       # -*- Entry points: -*-
       [z3c.autoinclude.plugin]
       target = plone
+
+      [console_scripts]
+      whathappened-benchmark = collective.whathappened.benchmark:main
+      whathappened-migrate = collective.whathappened.migrations:main
+
+      [zopectl.command]
+      whathappened-digest = collective.whathappened.digest:main
+      whathappened-export = collective.whathappened.ndjson:exportMain
+      whathappened-import = collective.whathappened.ndjson:importMain
       """,
       )